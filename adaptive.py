@@ -0,0 +1,256 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+===========
+adaptive.py
+===========
+
+Adaptive sampling: points kept densely where the signal changes and sparsely
+on the baseline.
+
+The signal is still acquired every sample_delta, and the cycle buffer, peak
+detection and integration see every point. Only the points sent on to the
+plot, the output files and clients are thinned by an AdaptiveGate: a point
+is kept if the smoothed slope of any channel is above a threshold (a
+multiple of the slope noise, as in peaks.py) within a margin before or after
+it, and otherwise only one point per `interval` seconds is kept. Points are
+sent on unthinned until the slope noise is known, `baseline` seconds into
+the cycle. The baseline between kept points is close to a straight line, so
+`reconstruct` recovers the dense trace by linear interpolation closely
+enough to integrate it.
+"""
+
+import numpy
+from peaks import MIN_BASELINE_POINTS, slope_noise
+
+# Slope threshold as a multiple of the slope noise
+ADAPTIVE_THRESHOLD_DEFAULT = 5.0
+# Seconds kept densely before the signal starts and after it stops changing
+ADAPTIVE_PRE_DEFAULT = 0.5
+ADAPTIVE_POST_DEFAULT = 1.0
+# Seconds between the points kept on the baseline
+ADAPTIVE_INTERVAL_DEFAULT = 1.0
+
+
+class AdaptiveGate:
+    """AdaptiveGate
+    Incremental choice of the points of a cycle to keep.
+
+    threshold       : slope threshold as a multiple of the slope noise
+    pre, post       : seconds kept before and after points with a slope
+                      above the threshold
+    interval        : seconds between the points kept on the baseline
+    smooth          : seconds averaged either side of a point for its slope
+    hold            : seconds the slope must stay above the threshold, so
+                      single noise spikes do not count
+    baseline        : seconds at the start of the cycle used for the noise
+    sample_delta    : point spacing (s), by default the median spacing of
+                      the first points of each cycle
+
+    Like PeakDetector, `update` is given the whole cycle so far and only
+    processes the points added since the last call. Until the noise is
+    known every point is kept, after that a point is decided once the
+    slopes up to `pre` seconds after it are known, so the points kept lag
+    the cycle by pre plus smooth seconds.
+    """
+    def __init__(self, threshold=ADAPTIVE_THRESHOLD_DEFAULT,
+                 pre=ADAPTIVE_PRE_DEFAULT, post=ADAPTIVE_POST_DEFAULT,
+                 interval=ADAPTIVE_INTERVAL_DEFAULT, smooth=0.05, hold=0.05,
+                 baseline=2.0, sample_delta=None):
+        self.threshold = threshold
+        self.pre = pre
+        self.post = post
+        self.interval = interval
+        self.smooth = smooth
+        self.hold = hold
+        self.baseline = baseline
+        self.sample_delta = sample_delta
+        self._above = numpy.zeros(1024, dtype=bool)
+        # Runs of hold points above the threshold starting before each index
+        self._runs = numpy.zeros(1025, dtype=int)
+        self.reset()
+
+    def reset(self):
+        """Forget the current cycle"""
+        # Slopes are known up to _next_slope, runs counted up to _n_runs and
+        # points decided up to _next
+        self._next_slope = None
+        self._n_runs = 0
+        self._next = 0
+        self.slope_threshold = None
+        self._above[:] = False
+        # Settings in points, set from the point spacing
+        self._h = self._hold = self._baseline = None
+        self._pre = self._post = self._stride = None
+
+    def _set_intervals(self, t):
+        """Convert the settings to points"""
+        dt = self.sample_delta
+        if dt is None:
+            dt = numpy.median(numpy.diff(t[:MIN_BASELINE_POINTS + 1]))
+        self._h = max(1, int(round(self.smooth/dt)))
+        self._hold = max(1, int(round(self.hold/dt)))
+        self._baseline = max(MIN_BASELINE_POINTS, int(round(self.baseline/dt)))
+        self._pre = int(numpy.ceil(self.pre/dt))
+        self._post = int(numpy.ceil(self.post/dt))
+        self._stride = max(1, int(round(self.interval/dt)))
+        self._next_slope = self._h
+
+    def _slopes(self, t, y, i0, i1):
+        """Smoothed slopes for the point indices [i0, i1), one column per
+        channel
+        """
+        h = self._h
+        y = y.reshape(len(y), -1)
+        cy = numpy.concatenate((numpy.zeros((1, y.shape[1])),
+                                numpy.cumsum(y[i0 - h:i1 + h], axis=0)))
+        ct = numpy.concatenate(([0.0], numpy.cumsum(t[i0 - h:i1 + h])))
+        n = i1 - i0
+        y_before = cy[h:h + n] - cy[:n]
+        y_after = cy[2*h + 1:2*h + 1 + n] - cy[h + 1:h + 1 + n]
+        t_before = ct[h:h + n] - ct[:n]
+        t_after = ct[2*h + 1:2*h + 1 + n] - ct[h + 1:h + 1 + n]
+        return (y_after - y_before)/(t_after - t_before)[:, None]
+
+    def _update_slopes(self, t, y):
+        """Mark the points with a slope above the threshold, of any channel"""
+        if self._baseline is None:
+            if len(t) < MIN_BASELINE_POINTS + 1:
+                return
+            self._set_intervals(t)
+        i0, i1 = self._next_slope, len(t) - self._h
+        if i1 <= i0:
+            return
+        if self.slope_threshold is None and i1 - self._h < self._baseline:
+            return
+        if i1 > len(self._above):
+            size = max(i1, 2*len(self._above))
+            grown = numpy.zeros(size, dtype=bool)
+            grown[:i0] = self._above[:i0]
+            self._above = grown
+            runs = numpy.zeros(size + 1, dtype=int)
+            runs[:self._n_runs + 1] = self._runs[:self._n_runs + 1]
+            self._runs = runs
+        slopes = self._slopes(t, y, i0, i1)
+        if self.slope_threshold is None:
+            # Slope noise from the start of the cycle
+            noise = slope_noise(slopes[:self._baseline])
+            self.slope_threshold = numpy.maximum(self.threshold*noise,
+                                                 numpy.finfo(float).eps)
+        above = numpy.abs(slopes) > self.slope_threshold
+        self._above[i0:i1] = numpy.any(above, axis=1)
+        self._next_slope = i1
+        self._count_runs()
+
+    def _count_runs(self):
+        """Count the runs of hold points above the threshold starting at the
+        indices up to the last one known from the slopes
+        """
+        hold = self._hold
+        j0, j1 = self._n_runs, max(0, self._next_slope - hold + 1)
+        if j1 <= j0:
+            return
+        above = numpy.cumsum(self._above[j0:j1 + hold - 1])
+        above = numpy.concatenate(([0], above))
+        runs = above[hold:] - above[:-hold] == hold
+        self._runs[j0 + 1:j1 + 1] = self._runs[j0] + numpy.cumsum(runs)
+        self._n_runs = j1
+
+    def _decide(self, i1):
+        """Indices of the points kept in [_next, i1)"""
+        i0 = self._next
+        if i1 <= i0:
+            return numpy.empty(0, dtype=int)
+        index = numpy.arange(i0, i1)
+        # Runs covering [i - post, i + pre] of each point
+        upper = numpy.clip(index + self._pre + 1, 0, self._n_runs)
+        lower = numpy.clip(index - self._post - self._hold + 1, 0,
+                           self._n_runs)
+        near = self._runs[upper] - self._runs[lower] > 0
+        self._next = i1
+        return index[near | (index % self._stride == 0)]
+
+    def _pass(self, n):
+        """Indices of the points from _next to n, all kept"""
+        keep = numpy.arange(self._next, n)
+        self._next = max(self._next, n)
+        return keep
+
+    def update(self, t, y):
+        """Indices of the points kept among those decided by this call
+        t, y : all points of the cycle so far
+        """
+        self._update_slopes(t, y)
+        if self.slope_threshold is None:
+            # Nothing to tell the baseline by yet
+            return self._pass(len(t))
+        return self._decide(self._next_slope - self._hold + 1 - self._pre)
+
+    def finish(self, t, y):
+        """Indices of the remaining points kept, including the last point"""
+        self._update_slopes(t, y)
+        n = len(t)
+        if self.slope_threshold is None:
+            # Too short a cycle to tell the baseline, keep it all
+            keep = self._pass(n)
+        else:
+            start = self._next
+            keep = self._decide(n)
+            if n > start and (len(keep) == 0 or keep[-1] != n - 1):
+                keep = numpy.append(keep, n - 1)
+        self.reset()
+        return keep
+
+
+def reconstruct(t, y, grid):
+    """Values at the times of grid interpolated linearly from the points
+    (t, y) kept by an AdaptiveGate, y may have one column per channel
+    """
+    if numpy.ndim(y) == 1:
+        return numpy.interp(grid, t, y)
+    return numpy.column_stack([numpy.interp(grid, t, y[:, i])
+                               for i in range(y.shape[1])])
+
+
+def add_adaptive_arguments(parser):
+    """Add the options of adaptive sampling"""
+    group = parser.add_argument_group("Adaptive sampling")
+    group.add_argument('--adaptive', action="store_true",
+                       help="Send points densely only where the signal "
+                            "changes, sparsely on the baseline")
+    group.add_argument('--adaptive-threshold', type=float,
+                       default=ADAPTIVE_THRESHOLD_DEFAULT,
+                       help="Slope threshold as a multiple of the slope noise")
+    group.add_argument('--adaptive-pre', type=float,
+                       default=ADAPTIVE_PRE_DEFAULT,
+                       help="Seconds kept densely before the signal changes")
+    group.add_argument('--adaptive-post', type=float,
+                       default=ADAPTIVE_POST_DEFAULT,
+                       help="Seconds kept densely after the signal settles")
+    group.add_argument('--adaptive-interval', type=float,
+                       default=ADAPTIVE_INTERVAL_DEFAULT,
+                       help="Seconds between points kept on the baseline")
+
+
+def create_gate(args):
+    """AdaptiveGate configured by the options of add_adaptive_arguments,
+    None without --adaptive
+    """
+    if args.adaptive == False:
+        return None
+    return AdaptiveGate(threshold=args.adaptive_threshold,
+                        pre=args.adaptive_pre, post=args.adaptive_post,
+                        interval=args.adaptive_interval)
@@ -0,0 +1,473 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+===========
+backends.py
+===========
+
+DAQ backends used by chromatographer.py.
+
+A backend covers everything the Chromatographer needs from the hardware: the
+differential analog read, the digital port used for the valves and listing
+the available devices. Two backends are provided:
+
+* nidaqmx   : National Instruments cards through the nidaqmx module
+* simulated : a synthetic chromatograph for testing without hardware
+
+A backend instance reads all of its analog channels on one device together,
+channels on several devices are read through one backend per device, see
+open_devices. Only the first device drives the valves.
+"""
+
+from numpy import arange, asarray, empty, exp, flatnonzero, random
+import threading
+import time
+
+# nidaqmx and the NI system are loaded on first use, importing the driver
+# is a large part of the startup time and is not needed for the simulator
+_nidaqmx = None
+_system = None
+
+
+# Interval (seconds) for checking a running digital output waveform
+WAVEFORM_POLL_INTERVAL = 0.005
+
+
+class BufferedOutputUnsupported(Exception):
+    """The device cannot clock its digital output, valve programs are then
+    timed on the host
+    """
+    pass
+
+
+def import_nidaqmx():
+    """Import and return the nidaqmx module on first use"""
+    global _nidaqmx
+    if _nidaqmx is None:
+        try:
+            import nidaqmx
+            import nidaqmx.constants
+            import nidaqmx.stream_readers
+        except ImportError:
+            raise RuntimeError("nidaqmx module is not installed")
+        _nidaqmx = nidaqmx
+    return _nidaqmx
+
+
+def get_system():
+    """Return the NI system, created on first use"""
+    global _system
+    if _system is None:
+        _system = import_nidaqmx().system.System()
+    return _system
+
+
+def group_channels(channels):
+    """Group physical channels such as "Dev1/ai1" by device
+
+    Returns a list of (device, [channel, ...]) in the order the devices first
+    appear, the channel names are relative to the device, e.g., "ai1".
+    """
+    devices = {}
+    for channel in channels:
+        device, sep, name = channel.strip().partition('/')
+        if sep == '' or name == '':
+            raise ValueError("Channel MUST be device/channel: {}".format(channel))
+        devices.setdefault(device, []).append(name)
+    return list(devices.items())
+
+
+class DAQBackend:
+    """DAQBackend
+    Interface between the Chromatographer and a DAQ device.
+
+    Analog reads return samples from the differential detector channels as
+    (channels, n_samples) arrays, the digital port holds the valve state as an
+    8 bit mask.
+
+    `channels` holds the physical names of the analog channels in the order
+    of the rows of the samples, e.g., ["Dev1/ai1", "Dev1/ai2"].
+    """
+    name = None
+    channels = []
+
+    @classmethod
+    def list_devices(cls):
+        """Return the names of the available devices"""
+        raise NotImplementedError
+
+    @classmethod
+    def shared_options(cls):
+        """Options passed to every device opened together by open_devices"""
+        return {}
+
+    def read_analog(self, n_samples):
+        """Read n_samples from the analog channel (software timed)"""
+        raise NotImplementedError
+
+    def start_buffered(self, rate, block_size, callback):
+        """Start hardware timed acquisition
+        rate       : requested sample rate (Hz)
+        block_size : number of samples passed to each callback
+        callback   : called with a (channels, block_size) array of samples
+
+        Returns the actual sample rate used by the device.
+        """
+        raise NotImplementedError
+
+    def stop_buffered(self):
+        """Stop hardware timed acquisition"""
+        raise NotImplementedError
+
+    def read_port(self):
+        """Read the digital port state"""
+        raise NotImplementedError
+
+    def write_port(self, value):
+        """Write the digital port state"""
+        raise NotImplementedError
+
+    def run_digital_waveform(self, samples, rate, cancel=None):
+        """Write port states on the device sample clock, blocks until done
+        samples : port state for every sample clock tick
+        rate    : sample rate (Hz)
+        cancel  : threading.Event stopping the output early when set
+
+        The port keeps the last state written. Returns False if cancelled.
+        Raises BufferedOutputUnsupported if the device cannot clock its
+        digital output, before any of the waveform is output.
+        """
+        raise BufferedOutputUnsupported("Buffered digital output not supported")
+
+    def close(self):
+        """Release the device"""
+        pass
+
+
+class NidaqmxBackend(DAQBackend):
+    """NidaqmxBackend
+    National Instruments DAQ cards through the nidaqmx module.
+    """
+    name = "nidaqmx"
+
+    @classmethod
+    def list_devices(cls):
+        return get_system().devices.device_names
+
+    def __init__(self, daq_id, channels=("ai1",), digital=True):
+        nidaqmx = import_nidaqmx()
+        termcfg = nidaqmx.constants.TerminalConfiguration
+        # Configure DAQ to use analog input 1 and 9 for differential output as
+        # per the user manual for the DAQ 6014: ai{i, i+8} for differential.
+        # All channels share one task, samples are read interleaved.
+        self.channels = ["{dev}/{ch}".format(dev=daq_id, ch=ch) for ch in channels]
+        self.task_analog = nidaqmx.Task()
+        self.task_analog.ai_channels.add_ai_voltage_chan(",".join(self.channels),
+                                                         terminal_config=termcfg.DIFFERENTIAL)
+        self.task_analog.start()
+
+        # Use digital IO lined 0->7, only on the device driving the valves
+        self.task_digital = None
+        if digital == True:
+            self.task_digital = nidaqmx.Task()
+            self.task_digital.do_channels.add_do_chan('{dev}/port0/line0:7'.format(dev=daq_id))
+            self.task_digital.start()
+
+        self._callback = None
+        self._block = None
+        self._reader = None
+
+    def read_analog(self, n_samples):
+        samples = self.task_analog.read(number_of_samples_per_channel=n_samples)
+        return asarray(samples, dtype=float).reshape(len(self.channels), -1)
+
+    def start_buffered(self, rate, block_size, callback):
+        nidaqmx = import_nidaqmx()
+        AcquisitionType = nidaqmx.constants.AcquisitionType
+        AnalogMultiChannelReader = nidaqmx.stream_readers.AnalogMultiChannelReader
+        self.task_analog.stop()
+        self.task_analog.timing.cfg_samp_clk_timing(
+                rate,
+                sample_mode=AcquisitionType.CONTINUOUS,
+                samps_per_chan=block_size*10)
+        # nidaqmx only allows the buffer event to be registered once per task
+        if self._reader is None:
+            self._reader = AnalogMultiChannelReader(self.task_analog.in_stream)
+            self.task_analog.register_every_n_samples_acquired_into_buffer_event(
+                    block_size, self._on_samples_acquired)
+        self._block = empty((len(self.channels), block_size))
+        self._callback = callback
+        self.task_analog.start()
+        # The device may coerce the requested rate
+        return self.task_analog.timing.samp_clk_rate
+
+    def stop_buffered(self):
+        self.task_analog.stop()
+
+    def _on_samples_acquired(self, task_handle, event_type, n_samples, data):
+        self._reader.read_many_sample(self._block,
+                                      number_of_samples_per_channel=n_samples,
+                                      timeout=0)
+        self._callback(self._block[:, :n_samples])
+        return 0
+
+    def read_port(self):
+        return self.task_digital.read()
+
+    def write_port(self, value):
+        self.task_digital.write([value])
+
+    def run_digital_waveform(self, samples, rate, cancel=None):
+        nidaqmx = import_nidaqmx()
+        AcquisitionType = nidaqmx.constants.AcquisitionType
+        task = self.task_digital
+        task.stop()
+        try:
+            # Cards such as the 6014 only have software timed lines, which
+            # may be refused at any step of setting up the task
+            try:
+                task.timing.cfg_samp_clk_timing(rate,
+                                                sample_mode=AcquisitionType.FINITE,
+                                                samps_per_chan=len(samples))
+                task.write([int(s) for s in samples], auto_start=False)
+                task.start()
+            except nidaqmx.errors.DaqError as err:
+                raise BufferedOutputUnsupported(
+                        "Buffered digital output not supported: {}".format(err))
+            if cancel is None:
+                cancel = threading.Event()
+            timeout = time.monotonic() + len(samples)/rate + 10
+            try:
+                while task.is_task_done() == False:
+                    if cancel.wait(WAVEFORM_POLL_INTERVAL):
+                        return False
+                    if time.monotonic() > timeout:
+                        raise RuntimeError("Digital output waveform timed out")
+            except nidaqmx.errors.DaqError as err:
+                raise RuntimeError("Digital output waveform failed: {}".format(err))
+            return True
+        finally:
+            task.stop()
+            # Back to writing single states for set_valve
+            task.timing.samp_timing_type = nidaqmx.constants.SampleTimingType.ON_DEMAND
+            task.start()
+
+    def close(self):
+        print('Cleaning up DAQ tasks')
+        if self.task_digital is not None:
+            self.task_digital.stop()
+            self.task_digital.close()
+
+        self.task_analog.stop()
+        self.task_analog.close()
+
+
+# Synthetic chromatogram peaks as (retention time (s), height (V), width (s))
+SIM_PEAKS_DEFAULT = [(4.0, 0.8, 0.3), (9.5, 0.35, 0.5), (17.0, 0.6, 0.8)]
+# Sample valves opened by the last priming step, VALVE_3|VALVE_5
+SIM_INJECTION_MASK = 0x28
+SIM_NATIVE_RATE = 10000.0
+
+
+class SimulatedInjection:
+    """Time of the last injection of a simulated sample, shared by the
+    devices whose detectors it feeds
+    """
+    def __init__(self):
+        self.t = None
+
+
+class SimulatedBackend(DAQBackend):
+    """SimulatedBackend
+    Synthetic chromatograph for running without NI hardware.
+
+    The signal is a baseline with linear drift and gaussian noise. Gaussian
+    peaks appear at their retention times after the sample valves
+    (injection_mask) are opened on the digital port, as done by the final
+    step of Chromatographer.prime_valves. Devices opened together by
+    open_devices share an injection, so those opened without the digital
+    port see the injections of the device driving the valves, as if their
+    detectors were fed by the same sample. Channel k of a device sees the
+    peaks at 1/(k + 1) of their height.
+
+    peaks     : list of (retention time (s), height (V), width (s))
+    noise     : standard deviation of the noise (V)
+    drift     : baseline drift (V/s)
+    baseline  : baseline offset (V)
+    latency   : delay added to every analog read and port access (s)
+    max_rate  : highest sample rate the device accepts (Hz)
+    buffered_digital : whether digital output waveforms are supported
+    injection : SimulatedInjection shared with other devices, or None for
+                an injection of its own
+    """
+    name = "simulated"
+
+    @classmethod
+    def list_devices(cls):
+        return ["Sim1"]
+
+    @classmethod
+    def shared_options(cls):
+        return {'injection' : SimulatedInjection()}
+
+    def __init__(self, daq_id="Sim1", channels=("ai1",), digital=True,
+                 peaks=SIM_PEAKS_DEFAULT, noise=0.002,
+                 drift=1e-5, baseline=0.0, latency=0.0, max_rate=1e6,
+                 native_rate=SIM_NATIVE_RATE, buffered_digital=True,
+                 injection_mask=SIM_INJECTION_MASK, injection=None, seed=None):
+        self.daq_id = daq_id
+        self.channels = ["{dev}/{ch}".format(dev=daq_id, ch=ch) for ch in channels]
+        self.digital = digital
+        self._gain = 1.0/(1 + arange(len(self.channels)))[:, None]
+        self.peaks = [tuple(p) for p in peaks]
+        self.noise = noise
+        self.drift = drift
+        self.baseline = baseline
+        self.latency = latency
+        self.max_rate = max_rate
+        self.native_rate = native_rate
+        self.buffered_digital = buffered_digital
+        self.injection_mask = injection_mask
+        if injection is None:
+            injection = SimulatedInjection()
+        self.injection = injection
+
+        self._rng = random.default_rng(seed)
+        self._t0 = time.monotonic()
+        self._port = 0x00
+        self._thread = None
+        self._stop = threading.Event()
+
+    def signal(self, t):
+        """Synthetic signal of all channels at monotonic times t (seconds)"""
+        t = asarray(t, dtype=float)
+        baseline = self.baseline + self.drift*(t - self._t0)
+        peaks = 0.0
+        t_injection = self.injection.t
+        if t_injection is not None:
+            tr = t - t_injection
+            for rt, height, width in self.peaks:
+                peaks = peaks + height*exp(-0.5*((tr - rt)/width)**2)
+        y = baseline + self._gain*peaks
+        return y + self._rng.normal(0, self.noise, y.shape)
+
+    def read_analog(self, n_samples):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        now = time.monotonic()
+        return self.signal(now - arange(n_samples)[::-1]/self.native_rate)
+
+    def start_buffered(self, rate, block_size, callback):
+        self.stop_buffered()
+        rate = min(rate, self.max_rate)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._stream,
+                                        args=(rate, block_size, callback),
+                                        daemon=True)
+        self._thread.start()
+        return rate
+
+    def stop_buffered(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _stream(self, rate, block_size, callback):
+        """Deliver blocks on a simulated sample clock"""
+        t_start = time.monotonic()
+        n = 0
+        while True:
+            # Block is complete once its last sample has been clocked in
+            deadline = t_start + (n + block_size)/rate
+            if self._stop.wait(max(0, deadline - time.monotonic())):
+                break
+            callback(self.signal(t_start + (n + arange(block_size))/rate))
+            n += block_size
+
+    def read_port(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self._port
+
+    def write_port(self, value):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self._set_port(value)
+
+    def run_digital_waveform(self, samples, rate, cancel=None):
+        if self.buffered_digital == False:
+            return super().run_digital_waveform(samples, rate, cancel)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if cancel is None:
+            cancel = threading.Event()
+        # The port changes exactly on the simulated sample clock
+        samples = asarray(samples)
+        changes = flatnonzero(samples[1:] != samples[:-1]) + 1
+        t_start = time.monotonic()
+        self._set_port(int(samples[0]))
+        for i in changes:
+            if cancel.wait(max(0, t_start + i/rate - time.monotonic())):
+                return False
+            self._set_port(int(samples[i]))
+        return not cancel.wait(max(0, t_start + len(samples)/rate - time.monotonic()))
+
+    def _set_port(self, value):
+        injected = (value & self.injection_mask) == self.injection_mask
+        if injected and (self._port & self.injection_mask) != self.injection_mask:
+            self.injection.t = time.monotonic()
+        self._port = value & 0xff
+
+    def close(self):
+        self.stop_buffered()
+
+
+BACKENDS = {
+    NidaqmxBackend.name   : NidaqmxBackend,
+    SimulatedBackend.name : SimulatedBackend,
+}
+BACKEND_DEFAULT = NidaqmxBackend.name
+
+
+def open_backend(name, daq_id, **kwargs):
+    """Create a backend instance by name for the device daq_id"""
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown DAQ backend: {}".format(name))
+    return backend(daq_id, **kwargs)
+
+
+def open_devices(name, channels, **kwargs):
+    """Open one backend per device for physical channels such as "Dev1/ai1"
+
+    Each backend reads all of its channels in one task, the first device
+    drives the valves. kwargs are passed to every backend, along with the
+    shared options of the backend, e.g., the injection of simulated devices.
+    """
+    if name in BACKENDS:
+        kwargs = dict(BACKENDS[name].shared_options(), **kwargs)
+    backends = []
+    try:
+        for i, (device, names) in enumerate(group_channels(channels)):
+            backends.append(open_backend(name, device, channels=names,
+                                         digital=(i == 0), **kwargs))
+    except Exception:
+        for backend in backends:
+            backend.close()
+        raise
+    return backends
@@ -0,0 +1,217 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+========
+batch.py
+========
+
+Batch reprocessing of recorded output files, run as
+
+    python chromatographer.py batch [options] files_or_directories...
+
+Every channel of every cycle of every run is optionally filtered, integrated
+for peaks and summarised. Files are processed in parallel by a pool of
+worker processes and the results are written to one summary file and one
+peak file. Files larger than SPLIT_SIZE are streamed and their cycles shared
+out among the workers, so a single large file is neither processed serially
+nor read into memory.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fnmatch
+import numpy
+import os
+import time
+
+from filters import parse_filter
+from peaks import PeakDetector
+import storage
+
+SUMMARY_COLUMNS = ("file, run, id, channel, samples, mean (V), std (V), "
+                   "min (V), max (V), peaks")
+PEAK_COLUMNS = "file, run, " + storage.PEAKS_CHANNEL_COLUMNS
+
+# Files larger than this (bytes) are split into jobs of cycles
+SPLIT_SIZE = storage.READ_BLOCK_SIZE
+# Samples in each job of cycles of a split file
+JOB_SAMPLES = 1 << 20
+
+
+def discover_files(paths, pattern="*.csv", exclude=("*_peaks.csv", "*_ensemble.csv"),
+                   skip=()):
+    """Find output files in paths, directories are searched recursively
+    skip : paths left out, e.g., the files being written
+    """
+    skip = set(os.path.abspath(path) for path in skip)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if (fnmatch.fnmatch(name, pattern)
+                            and not any(fnmatch.fnmatch(name, e) for e in exclude)):
+                        files.append(os.path.join(root, name))
+        else:
+            files.append(path)
+    return [path for path in files if os.path.abspath(path) not in skip]
+
+
+def analyse_cycle(t, y, filter_spec=None, threshold=None):
+    """Filter, summarise and integrate the peaks of one cycle
+
+    Returns (summary, peaks) where summary is (samples, mean, std, min, max).
+    """
+    if filter_spec is not None:
+        filter = parse_filter(filter_spec)
+        y = filter.process(y)
+        # Times of the filtered points interpolated from the raw samples
+        t = numpy.interp(filter.sample_index(numpy.arange(len(y))),
+                         numpy.arange(len(t)), t)
+    if len(y) == 0:
+        return (0, numpy.nan, numpy.nan, numpy.nan, numpy.nan), []
+    detector = PeakDetector() if threshold is None else PeakDetector(threshold)
+    peaks = detector.finish(t, y)
+    summary = (len(y), y.mean(), y.std(), y.min(), y.max())
+    return summary, peaks
+
+
+def analyse_cycles(cycles, filter_spec=None, threshold=None):
+    """Analyse cycles given as (run, cycle_id, t, y), run in the worker
+    processes
+
+    Returns (summary rows, peak rows).
+    """
+    summaries, peak_rows = [], []
+    for run_id, cycle_id, t, y in cycles:
+        # One column per channel
+        y = y.reshape(len(t), -1)
+        for channel in range(y.shape[1]):
+            summary, peaks = analyse_cycle(t, y[:, channel], filter_spec,
+                                           threshold)
+            summaries.append((run_id, cycle_id, channel) + summary
+                             + (len(peaks),))
+            for peak in peaks:
+                peak_rows.append((run_id, cycle_id, channel) + tuple(peak))
+    return summaries, peak_rows
+
+
+def analyse_file(path, filter_spec=None, threshold=None):
+    """Analyse all cycles of an output file, run in the worker processes
+
+    Returns (summary rows, peak rows) or raises on files that cannot be
+    parsed.
+    """
+    return analyse_cycles(((run_id, cycle_id, t, y) for run_id, metadata, cycle_id, t, y
+                           in storage.iter_cycles(path)), filter_spec, threshold)
+
+
+def split_file(path, job_samples=JOB_SAMPLES):
+    """Stream the cycles of an output file in lists of about job_samples
+    samples, for analyse_cycles
+    """
+    job, n = [], 0
+    for run_id, metadata, cycle_id, t, y in storage.iter_cycles(path):
+        job.append((run_id, cycle_id, t, y))
+        n += len(t)
+        if n >= job_samples:
+            yield job
+            job, n = [], 0
+    if len(job) > 0:
+        yield job
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="chromatographer.py batch",
+                            description="Reprocess recorded output files")
+    parser.add_argument('paths', nargs='+',
+                        help="Output files or directories to search")
+    parser.add_argument('-p', '--pattern', type=str, default="*.csv",
+                        help="File name pattern when searching directories")
+    parser.add_argument('-o', '--output', type=str, default="batch_summary.csv",
+                        help="Summary file, one line per cycle")
+    parser.add_argument('-P', '--peaks', type=str, default="batch_peaks.csv",
+                        help="Peak file, one line per peak")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument('--filter', type=str, default=None,
+                        help="Filters applied before integration, e.g., median:3")
+    parser.add_argument('--peak-threshold', type=float, default=None,
+                        help="Peak slope threshold in multiples of the noise")
+    args = parser.parse_args(argv)
+
+    # The outputs match the default pattern when written among the inputs
+    files = discover_files(args.paths, args.pattern,
+                           skip=(args.output, args.peaks))
+    if len(files) == 0:
+        print("!! WARN: No output files found")
+        return 1
+    print("Processing {n} files with {j} workers".format(n=len(files), j=args.jobs))
+
+    t_start = time.perf_counter()
+    n_bytes = n_cycles = n_peaks = 0
+    with open(args.output, 'w') as f_summary, open(args.peaks, 'w') as f_peaks, \
+            ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        f_summary.write("# " + SUMMARY_COLUMNS + "\n")
+        f_peaks.write("# " + PEAK_COLUMNS + "\n")
+        # (path, job) in submission order, written in that order
+        jobs = deque()
+
+        def write_results(limit):
+            nonlocal n_cycles, n_peaks
+            while len(jobs) > limit:
+                path, job = jobs.popleft()
+                try:
+                    summaries, peak_rows = job.result()
+                except Exception as err:
+                    print("!! WARN: Skipping {path}: {err}".format(path=path, err=err))
+                    continue
+                for row in summaries:
+                    f_summary.write("{},{},{},{},{},{:.6g},{:.6g},{:.6g},{:.6g},{}\n".format(
+                        path, *row))
+                for row in peak_rows:
+                    f_peaks.write("{},{},{},{},{:.4f},{:.4f},{:.4f},{:.6g},{:.6g},{:.4f}\n".format(
+                        path, *row))
+                n_cycles += len(summaries)
+                n_peaks += len(peak_rows)
+
+        for path in files:
+            size = os.path.getsize(path)
+            if size <= SPLIT_SIZE:
+                jobs.append((path, pool.submit(analyse_file, path, args.filter,
+                                               args.peak_threshold)))
+            else:
+                try:
+                    for cycles in split_file(path):
+                        jobs.append((path, pool.submit(analyse_cycles, cycles,
+                                                       args.filter, args.peak_threshold)))
+                        # Bound the cycles held in memory
+                        write_results(2*args.jobs)
+                except Exception as err:
+                    print("!! WARN: Skipping the rest of {path}: {err}".format(
+                        path=path, err=err))
+            n_bytes += size
+        write_results(0)
+
+    dt = time.perf_counter() - t_start
+    print("Processed {c} cycle channels ({p} peaks) from {mb:.1f} MB in {dt:.2f} s".format(
+        c=n_cycles, p=n_peaks, mb=n_bytes/1e6, dt=dt))
+    print("Throughput: {cps:.1f} cycles/s, {mbps:.1f} MB/s".format(
+        cps=n_cycles/dt, mbps=n_bytes/1e6/dt))
+    return 0
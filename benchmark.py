@@ -0,0 +1,395 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+============
+benchmark.py
+============
+
+Headless benchmarks of the acquisition, plotting and storage paths, run
+against the simulated DAQ backend and an offscreen Qt platform:
+
+    python benchmark.py -o results.json
+    python benchmark.py -o new.json --compare results.json
+
+* acquisition : jitter of software timed points from collect_data and the
+                highest point rate sustained with software and hardware
+                timing
+* plot        : points per second through the ChromatographerQtWorker
+                signals into ChromatographerQt.update_plot and the plot
+* storage     : write throughput of the output file and the archive, and
+                read throughput of the output file
+
+Results are saved as JSON with the commit they were measured on, so runs can
+be compared across commits with --compare.
+"""
+
+from contextlib import redirect_stdout
+import datetime
+import io
+import json
+import numpy
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Qt must run without a display, set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from backends import SimulatedBackend
+import chromatographer as cg
+import storage
+from valves import ValveProgram
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Valve program short enough not to dominate the benchmark cycles
+BENCH_PROGRAM = ValveProgram([(cg.VALVE_3|cg.VALVE_5, 0.01)], name="bench")
+
+SUITES = ('acquisition', 'plot', 'storage')
+
+
+def git_commit():
+    """Commit of the working tree, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def interval_stats(times, expected):
+    """Statistics (ms) of the intervals between times against expected"""
+    intervals = numpy.diff(times)
+    if len(intervals) == 0:
+        return {}
+    error = intervals - expected
+    return {'intervals'    : len(intervals),
+            'mean_ms'      : 1e3*intervals.mean(),
+            'jitter_ms'    : 1e3*intervals.std(),
+            'p99_error_ms' : 1e3*numpy.percentile(numpy.abs(error), 99),
+            'max_error_ms' : 1e3*numpy.abs(error).max()}
+
+
+class BenchChromatographer(cg.Chromatographer):
+    """BenchChromatographer
+    Runs a single cycle, recording when each batch of points is sent.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BenchChromatographer, self).__init__(*args, **kwargs)
+        self.sent = []
+        self.n_points = 0
+
+    def send_data_ready(self, x, y):
+        self.sent.append(time.monotonic())
+        self.n_points += len(x)
+
+    def send_peaks(self, peaks):
+        pass
+
+    def send_finished(self):
+        self.stop()
+
+
+def run_cycle(sample_window, sample_delta, hardware_timed=False, latency=0.0,
+              **kwargs):
+    """Run one cycle of collect_data on a simulated device"""
+    backend = SimulatedBackend(latency=latency, seed=0)
+    worker = BenchChromatographer(backend.daq_id, 0.05, sample_window,
+                                  sample_delta, backend=backend,
+                                  hardware_timed=hardware_timed,
+                                  valve_program=BENCH_PROGRAM, **kwargs)
+    t_start = time.perf_counter()
+    # The cycle is shorter than cycle_time, silence the overrun warnings
+    with redirect_stdout(io.StringIO()):
+        worker.collect_data()
+    elapsed = time.perf_counter() - t_start
+    worker.close_tasks()
+    return worker, elapsed
+
+
+def failure(rate, err):
+    """Description of a rate at which a run raised err"""
+    return "{rate:g} Hz: {name}: {err}".format(rate=rate,
+                                               name=type(err).__name__, err=err)
+
+
+def bench_acquisition(quick=False, latency=0.0):
+    results = {}
+    window = 2.0 if quick else 5.0
+
+    # Jitter of software timed points at a typical rate
+    dt = 0.01
+    worker, elapsed = run_cycle(window, dt, latency=latency)
+    results['polled_jitter'] = dict(sample_delta_ms=1e3*dt,
+                                    **interval_stats(worker.sent, dt))
+
+    # Highest software timed rate keeping the mean interval within 5%. A rate
+    # failing outright is recorded as the limit rather than ending the suite
+    sustained = None
+    for dt in (0.01, 0.005, 0.002, 0.001, 0.0005, 0.0002):
+        try:
+            worker, elapsed = run_cycle(window/2, dt, latency=latency)
+        except Exception as err:
+            results['polled_failure'] = failure(1/dt, err)
+            break
+        stats = interval_stats(worker.sent, dt)
+        if not stats or abs(stats['mean_ms'] - 1e3*dt) > 0.05e3*dt:
+            break
+        sustained = 1/dt
+    results['polled_max_rate_hz'] = sustained
+
+    # Highest hardware timed point rate without dropped or late points
+    sustained = None
+    for rate in (1e2, 1e3, 1e4, 2e4, 5e4, 1e5):
+        dt = 1/rate
+        try:
+            worker, elapsed = run_cycle(window/2, dt, hardware_timed=True,
+                                        latency=latency)
+        except Exception as err:
+            results['buffered_failure'] = failure(rate, err)
+            break
+        expected = int(numpy.ceil(window/2/dt))
+        overruns = sum(ring.overruns for ring in worker.rings)
+        if overruns > 0 or worker.n_points < expected - 1:
+            break
+        sustained = rate
+    results['buffered_max_rate_hz'] = sustained
+    return results
+
+
+def bench_plot(quick=False, latency=0.0):
+    """Points per second through the Qt worker signals into the plot"""
+    import importlib.util
+    from matplotlib.backends.qt_compat import QtCore, QtWidgets
+
+    spec = importlib.util.spec_from_file_location(
+            "chromatographer_qt", os.path.join(ROOT_DIR, "chromatographer-qt.py"))
+    cgqt = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cgqt)
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    window = cgqt.ChromatographerQt(backend=SimulatedBackend.name)
+    # Let init_daq create the window's own worker first
+    app.processEvents()
+    results = {}
+
+    # A hardware timed cycle at a high point rate, as in normal operation
+    window_t = 2.0 if quick else 5.0
+    dt = 1e-4
+    backend = SimulatedBackend(latency=latency, seed=0)
+    worker = cgqt.ChromatographerQtWorker(backend.daq_id, 0.05, window_t, dt,
+                                          backend=backend, hardware_timed=True,
+                                          valve_program=BENCH_PROGRAM,
+                                          telemetry=window.telemetry)
+    window.cycle = cgqt.CycleBuffer(int(window_t/dt) + 1)
+    window.plot.reset(window_t)
+    worker.data_ready.connect(window.update_plot)
+    worker.finished.connect(worker.stop)
+    thread = QtCore.QThread()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.collect_data)
+    worker.finished.connect(thread.quit)
+    t_start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        thread.start()
+        while thread.isRunning():
+            app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+        # Deliver the signals still queued for the window
+        app.processEvents()
+    elapsed = time.perf_counter() - t_start
+    worker.close_tasks()
+    latency_hist = window.telemetry.histogram("plot_latency_seconds")
+    draw_hist = window.telemetry.histogram("plot_draw_seconds")
+    results['cycle'] = {
+        'point_rate_hz'   : 1/dt,
+        'points_plotted'  : len(window.cycle),
+        'points_per_s'    : len(window.cycle)/elapsed,
+        'frames'          : draw_hist.count,
+        'draw_mean_ms'    : 1e3*draw_hist.mean,
+        'draw_max_ms'     : 1e3*draw_hist.max,
+        'latency_mean_ms' : 1e3*latency_hist.mean,
+        'latency_max_ms'  : 1e3*latency_hist.max,
+    }
+
+    # Capacity of the path from the worker to the window, points sent one at
+    # a time from another thread as fast as possible
+    n_points = 20000 if quick else 100000
+    window.cycle = cgqt.CycleBuffer(n_points)
+    worker = cgqt.ChromatographerQtWorker(backend.daq_id, 0.05, 1.0, 0.1,
+                                          backend=SimulatedBackend(),
+                                          valve_program=BENCH_PROGRAM)
+    worker.data_ready.connect(window.update_plot)
+    x, y = numpy.zeros(1), numpy.zeros(1)
+
+    def emit_all():
+        for i in range(n_points):
+            worker.send_data_ready(x, y)
+        worker.flush_data()
+
+    sender = threading.Thread(target=emit_all)
+    t_start = time.perf_counter()
+    sender.start()
+    while sender.is_alive() or len(window.cycle) < n_points:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+    elapsed = time.perf_counter() - t_start
+    sender.join()
+    worker.close_tasks()
+    results['delivery'] = {
+        'points'       : n_points,
+        'points_per_s' : n_points/elapsed,
+        'blocks'       : worker.telemetry.counter("data_blocks_total").value,
+    }
+    window.plot.timer.stop()
+    window.close()
+    return results
+
+
+def bench_storage(quick=False, **kwargs):
+    """Write and read throughput of the output file and the archive"""
+    n_cycles = 20 if quick else 100
+    n_points = 10000
+    rng = numpy.random.default_rng(0)
+    t = numpy.arange(n_points)*1e-3
+    y = rng.normal(0, 1e-3, n_points)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "bench.csv")
+        t_start = time.perf_counter()
+        with open(csv_path, 'a') as f:
+            f.write(storage.format_header(sample_window=10, sample_delta=1e-3,
+                                          cycle_time=60))
+            for cycle_id in range(n_cycles):
+                storage.write_rows(f, cycle_id, t, y)
+        elapsed = time.perf_counter() - t_start
+        size = os.path.getsize(csv_path)
+        results['csv_write'] = {'points_per_s' : n_cycles*n_points/elapsed,
+                                'mb_per_s'     : size/1e6/elapsed,
+                                'cycles_per_s' : n_cycles/elapsed}
+
+        t_start = time.perf_counter()
+        runs = storage.read_output_file(csv_path)
+        elapsed = time.perf_counter() - t_start
+        results['csv_read'] = {'points_per_s' : sum(len(d) for m, d in runs)/elapsed,
+                               'mb_per_s'     : size/1e6/elapsed}
+
+        archive_path = os.path.join(tmp, "bench" + storage.ARCHIVE_EXT)
+        t_start = time.perf_counter()
+        writer = storage.ArchiveWriter(archive_path)
+        writer.begin_run(sample_window=10, sample_delta=1e-3, cycle_time=60)
+        for cycle_id in range(n_cycles):
+            writer.write_cycle(cycle_id, t, y)
+        writer.close()
+        elapsed = time.perf_counter() - t_start
+        results['archive_write'] = {
+                'points_per_s' : n_cycles*n_points/elapsed,
+                'mb_per_s'     : os.path.getsize(archive_path)/1e6/elapsed,
+                'cycles_per_s' : n_cycles/elapsed}
+    return results
+
+
+BENCHMARKS = {
+    'acquisition' : bench_acquisition,
+    'plot'        : bench_plot,
+    'storage'     : bench_storage,
+}
+
+
+def flatten(results, prefix=""):
+    """Flatten nested results into {"suite.case.metric" : value}"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(new, old):
+    """Print the metrics of two result files side by side"""
+    new_flat = flatten(new['results'])
+    old_flat = flatten(old['results'])
+    print("# Compared to {commit} ({date})".format(commit=old.get('commit'),
+                                                  date=old.get('date')))
+    for key in sorted(new_flat):
+        a, b = new_flat[key], old_flat.get(key)
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and b != 0:
+            print("{key:<48} {a:12.4g} {b:12.4g} {r:8.2f}x".format(
+                key=key, a=a, b=b, r=a/b))
+        elif isinstance(a, (int, float)):
+            print("{key:<48} {a:12.4g} {b!s:>12}".format(key=key, a=a, b=b))
+        else:
+            print("{key:<48} {a!s:>12} {b!s:>12}".format(key=key, a=a, b=b))
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark the acquisition, plotting "
+                                        "and storage paths")
+    parser.add_argument('-o', '--output', type=str, default="benchmark.json",
+                        help="JSON file for the results")
+    parser.add_argument('--only', type=str, default=",".join(SUITES),
+                        help="Comma separated suites to run ({})".format(
+                            ", ".join(SUITES)))
+    parser.add_argument('--quick', action="store_true",
+                        help="Shorter runs, less accurate")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Latency added to each simulated DAQ access (s)")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="Results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for suite in args.only.split(','):
+        if suite not in BENCHMARKS:
+            print("!! WARN: Unknown suite {}".format(suite))
+            return 1
+        print("Running {} benchmarks".format(suite))
+        t_start = time.perf_counter()
+        results[suite] = BENCHMARKS[suite](quick=args.quick, latency=args.latency)
+        print("  done in {:.1f} s".format(time.perf_counter() - t_start))
+
+    report = {
+        'commit'   : git_commit(),
+        'date'     : datetime.datetime.now().isoformat(timespec='seconds'),
+        'python'   : platform.python_version(),
+        'numpy'    : numpy.__version__,
+        'platform' : platform.platform(),
+        'cpus'     : os.cpu_count(),
+        'quick'    : args.quick,
+        'latency'  : args.latency,
+        'results'  : results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for key, value in flatten(results).items():
+        print("{key:<48} {value}".format(key=key, value=value))
+    print("Results saved to", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
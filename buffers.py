@@ -0,0 +1,387 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+==========
+buffers.py
+==========
+
+Sample buffers shared between the DAQ callbacks, the acquisition loop and the
+user interfaces.
+
+The buffers are preallocated NumPy arrays so that no memory is allocated per
+sample while data is being collected. Buffers of more than one channel hold
+one row of channel values per sample time.
+
+SharedRingBuffer is a ring in shared memory handing samples from an
+acquisition process to a supervising process (see supervisor.py).
+"""
+
+from multiprocessing import shared_memory
+import threading
+from numpy import concatenate, empty, float64, ndarray, uint64
+
+# Bytes reserved for each counter of a SharedRingBuffer, a cache line each so
+# the producer and consumer do not write to the same line
+SHARED_COUNTER_SIZE = 64
+
+
+def _shape(n, channels):
+    """Array shape of n samples, values of one channel are kept 1D"""
+    return (n,) if channels == 1 else (n, channels)
+
+
+class RingBuffer:
+    """RingBuffer
+    Fixed size (time, value) buffer filled by a producer (e.g., a DAQ callback
+    thread) and drained by a consumer (e.g., collect_data).
+
+    When the consumer falls behind the oldest unread samples are overwritten
+    and counted in `overruns`.
+    """
+    def __init__(self, capacity, channels=1):
+        if capacity < 1:
+            raise ValueError("capacity MUST be at least 1")
+        self.capacity = int(capacity)
+        self.channels = int(channels)
+        self._t = empty(self.capacity)
+        self._y = empty(_shape(self.capacity, self.channels))
+        # Total samples written and read, positions are taken modulo capacity
+        self._head = 0
+        self._tail = 0
+        self.overruns = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return self._head - self._tail
+
+    def clear(self):
+        """Discard any unread samples and reset the counters"""
+        with self._cond:
+            self._head = 0
+            self._tail = 0
+            self.overruns = 0
+
+    def write(self, t, y):
+        """Write arrays of timestamps and values into the buffer
+        t : sample times (seconds)
+        y : sample values, (n, channels) for more than one channel
+        """
+        n = len(t)
+        if n == 0:
+            return
+        with self._cond:
+            if n > self.capacity:
+                # Only the newest samples fit, the rest are lost immediately
+                t, y = t[-self.capacity:], y[-self.capacity:]
+                self.overruns += n - self.capacity
+                n = self.capacity
+            start = self._head % self.capacity
+            first = min(n, self.capacity - start)
+            self._t[start:start + first] = t[:first]
+            self._y[start:start + first] = y[:first]
+            self._t[:n - first] = t[first:]
+            self._y[:n - first] = y[first:]
+            self._head += n
+            unread = self._head - self._tail
+            if unread > self.capacity:
+                self.overruns += unread - self.capacity
+                self._tail = self._head - self.capacity
+            self._cond.notify_all()
+
+    def wake(self):
+        """Wake a reader waiting for data, e.g., to stop"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def read(self, timeout=None):
+        """Read all unread samples as (t, y) array copies
+        timeout : seconds to wait for data when empty, None waits forever
+
+        Empty arrays are returned if no data arrived before the timeout.
+        """
+        with self._cond:
+            if self._head == self._tail:
+                self._cond.wait(timeout)
+            n = self._head - self._tail
+            start = self._tail % self.capacity
+            first = min(n, self.capacity - start)
+            t = concatenate((self._t[start:start + first], self._t[:n - first]))
+            y = concatenate((self._y[start:start + first], self._y[:n - first]))
+            self._tail = self._head
+        return t, y
+
+
+class SharedRingBuffer:
+    """SharedRingBuffer
+    Fixed size (time, value) buffer in shared memory, written by a single
+    producer process (e.g., an acquisition worker) and read by a single
+    consumer process (e.g., the supervisor).
+
+    Neither side locks or waits on the other: the producer reserves the
+    slots it is about to write, copies the samples in and then advances the
+    head, the consumer copies them out and then advances the tail. The
+    consumer creates the buffer (name None) and the producer attaches to it
+    by `name`. When the consumer falls behind, the oldest unread samples are
+    overwritten, and are counted in the consumer's `overruns`. Samples
+    whose slots were reserved by the time the consumer finished copying
+    them, written or still being written, are dropped and counted as well.
+    """
+    def __init__(self, capacity, channels=1, name=None):
+        if capacity < 1:
+            raise ValueError("capacity MUST be at least 1")
+        self.capacity = int(capacity)
+        self.channels = int(channels)
+        offset = 3*SHARED_COUNTER_SIZE
+        size = offset + 8*self.capacity*(1 + self.channels)
+        self.owner = name is None
+        if self.owner == True:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # Processes started by the owner with multiprocessing share its
+            # resource tracker, which frees the memory should the owner die
+            self.shm = shared_memory.SharedMemory(name=name)
+        buf = self.shm.buf
+        self._head = ndarray(1, uint64, buf, 0)
+        self._tail = ndarray(1, uint64, buf, SHARED_COUNTER_SIZE)
+        # End of the slots being written, ahead of the head during a write
+        self._reserved = ndarray(1, uint64, buf, 2*SHARED_COUNTER_SIZE)
+        self._t = ndarray(self.capacity, float64, buf, offset)
+        self._y = ndarray(_shape(self.capacity, self.channels), float64, buf,
+                          offset + 8*self.capacity)
+        if self.owner == True:
+            self._head[0] = 0
+            self._tail[0] = 0
+            self._reserved[0] = 0
+        self.overruns = 0
+
+    @property
+    def name(self):
+        """Name to attach to the buffer from another process"""
+        return self.shm.name
+
+    def __len__(self):
+        return min(int(self._head[0]) - int(self._tail[0]), self.capacity)
+
+    def write(self, t, y):
+        """Write arrays of timestamps and values into the buffer, from the
+        producer process only
+        """
+        n = len(t)
+        if n == 0:
+            return
+        head = int(self._head[0])
+        if n > self.capacity:
+            # Only the newest samples fit, the head still moves past the rest
+            # so that the consumer counts them in its overruns
+            t, y = t[-self.capacity:], y[-self.capacity:]
+            head += n - self.capacity
+            n = self.capacity
+        # Announced before any slot is overwritten
+        self._reserved[0] = head + n
+        start = head % self.capacity
+        first = min(n, self.capacity - start)
+        self._t[start:start + first] = t[:first]
+        self._y[start:start + first] = y[:first]
+        self._t[:n - first] = t[first:]
+        self._y[:n - first] = y[first:]
+        # Published only once the samples are in place
+        self._head[0] = head + n
+
+    def read(self):
+        """Read all unread samples as (t, y) array copies, from the consumer
+        process only
+        """
+        head = int(self._head[0])
+        tail = int(self._tail[0])
+        if head - tail > self.capacity:
+            self.overruns += head - tail - self.capacity
+            tail = head - self.capacity
+        n = head - tail
+        start = tail % self.capacity
+        first = min(n, self.capacity - start)
+        t = concatenate((self._t[start:start + first], self._t[:n - first]))
+        y = concatenate((self._y[start:start + first], self._y[:n - first]))
+        # Samples in slots the producer reserved by now may have been
+        # overwritten while they were copied, they are dropped
+        lost = min(int(self._reserved[0]) - self.capacity - tail, n)
+        if lost > 0:
+            self.overruns += lost
+            t, y = t[lost:], y[lost:]
+        self._tail[0] = head
+        return t, y
+
+    def close(self):
+        """Detach from the shared memory, which the owner also frees"""
+        # The memory cannot be unmapped while arrays still refer to it
+        del self._head, self._tail, self._reserved, self._t, self._y
+        self.shm.close()
+        if self.owner == True:
+            self.shm.unlink()
+
+
+class CycleBuffer:
+    """CycleBuffer
+    Storage for the (time, value) samples of one cycle.
+
+    The arrays are preallocated for the expected number of samples, e.g.,
+    sample_window/sample_delta, and doubled in size if more samples arrive.
+    `t` and `y` are views of the filled part of the arrays so the plot, the
+    output file and any analysis share the data without copying. Views taken
+    before the buffer grows or is reset keep their old contents.
+
+    With more than one channel `y` has one column per channel.
+    """
+    def __init__(self, capacity, channels=1):
+        self.channels = int(channels)
+        self._t = empty(max(1, int(capacity)))
+        self._y = empty(_shape(len(self._t), self.channels))
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def capacity(self):
+        return len(self._t)
+
+    @property
+    def t(self):
+        """Sample times of the cycle"""
+        return self._t[:self.n]
+
+    @property
+    def y(self):
+        """Sample values of the cycle"""
+        return self._y[:self.n]
+
+    def channel(self, i):
+        """Sample values of channel i of the cycle"""
+        return self.y if self.channels == 1 else self._y[:self.n, i]
+
+    def reset(self):
+        """Empty the buffer for the next cycle, keeping the allocation"""
+        self.n = 0
+
+    def append(self, t, y):
+        """Append a single sample"""
+        if self.n == self.capacity:
+            self._grow(self.n + 1)
+        self._t[self.n] = t
+        self._y[self.n] = y
+        self.n += 1
+
+    def extend(self, t, y):
+        """Append arrays of samples"""
+        n = self.n + len(t)
+        if n > self.capacity:
+            self._grow(n)
+        self._t[self.n:n] = t
+        self._y[self.n:n] = y
+        self.n = n
+
+    def _grow(self, size):
+        """Reallocate the arrays to hold at least size samples"""
+        capacity = max(size, 2*self.capacity)
+        t, y = empty(capacity), empty(_shape(capacity, self.channels))
+        t[:self.n] = self.t
+        y[:self.n] = self.y
+        self._t, self._y = t, y
+
+
+class BlockQueue:
+    """BlockQueue
+    Blocks of (time, value) samples handed from a producer thread (e.g., the
+    acquisition worker) to a consumer (e.g., the GUI thread), which takes all
+    pending blocks at once as a single block.
+
+    Blocks are never dropped, however far the consumer falls behind. To keep
+    the notifications bounded, `notify` returns True only when no notification
+    is outstanding, i.e., when the consumer has taken everything since the
+    last one, so at most one notification is ever queued to the consumer.
+
+    The producer marks the end of each cycle with `end_cycle`. `take` never
+    takes samples past the next end, which the consumer passes with
+    `next_cycle`, so the samples of a cycle are not mixed with those of the
+    next one when the consumer falls behind by more than a cycle.
+    """
+    def __init__(self, channels=1):
+        self.channels = int(channels)
+        self._blocks = []
+        self._n = 0
+        # perf_counter time of the oldest pending block
+        self._t_first = None
+        self._notified = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Number of pending samples"""
+        return self._n
+
+    def put(self, t, y, t_put):
+        """Append a block of samples put at perf_counter time t_put"""
+        if len(t) == 0:
+            return
+        with self._lock:
+            self._blocks.append((t, y, t_put))
+            self._n += len(t)
+            if self._t_first is None:
+                self._t_first = t_put
+
+    def end_cycle(self):
+        """Mark the end of a cycle after the samples put so far"""
+        with self._lock:
+            self._blocks.append(None)
+
+    def next_cycle(self):
+        """Pass the end of the cycle taken, see take
+
+        Returns True if samples of the following cycles are pending. They
+        were put before the end was passed, so no notification is coming for
+        them and the consumer takes them at once.
+        """
+        with self._lock:
+            if None in self._blocks:
+                self._blocks.remove(None)
+            return self._n > 0
+
+    def notify(self):
+        """True if the consumer needs to be notified of pending samples"""
+        with self._lock:
+            if self._notified == True or self._n == 0:
+                return False
+            self._notified = True
+            return True
+
+    def take(self):
+        """Take all pending samples up to the end of the cycle as
+        (t, y, t_first)
+        t_first : perf_counter time the oldest sample was put, None if empty
+        """
+        with self._lock:
+            end = self._blocks.index(None) if None in self._blocks else len(self._blocks)
+            blocks, self._blocks = self._blocks[:end], self._blocks[end:]
+            self._n -= sum(len(block[0]) for block in blocks)
+            self._t_first = next((block[2] for block in self._blocks
+                                  if block is not None), None)
+            self._notified = False
+        if len(blocks) == 0:
+            return (empty(0), empty(_shape(0, self.channels)), None)
+        if len(blocks) == 1:
+            t, y, t_first = blocks[0]
+            return t, y, t_first
+        return (concatenate([block[0] for block in blocks]),
+                concatenate([block[1] for block in blocks]), blocks[0][2])
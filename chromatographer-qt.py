@@ -29,45 +29,423 @@ License restrictions outlined in the included COPYING file. That includes this
 file.
 """
 
+import time
+# Reference point for --startup-profile, set before any other import
+STARTUP_T0 = time.perf_counter()
+
+from adaptive import add_adaptive_arguments, create_gate, reconstruct
+from buffers import BlockQueue, CycleBuffer
 import chromatographer as cg
+from collections import deque
 import datetime
+from filters import parse_filter
 from functools import partial
-import nidaqmx
-import matplotlib.animation as animation
-from matplotlib.backends.qt_compat import QtCore, QtGui, QtWidgets, is_pyqt5
-if is_pyqt5():
-    from matplotlib.backends.backend_qt5agg import (
+from matplotlib.backends.qt_compat import QtCore, QtGui, QtWidgets
+try:
+    # matplotlib >= 3.5 has a single backend for all Qt bindings
+    from matplotlib.backends.backend_qtagg import (
         FigureCanvas, NavigationToolbar2QT as NavigationToolbar)
-else:
-    from matplotlib.backends.backend_qt4agg import (
+except ImportError:
+    from matplotlib.backends.backend_qt5agg import (
         FigureCanvas, NavigationToolbar2QT as NavigationToolbar)
 from matplotlib.figure import Figure
-from PyQt5 import uic
+import importlib.util
+from lod import MinMaxPyramid
+import numpy
 import os.path
-import time
+import storage
+from telemetry import METRICS_INTERVAL_DEFAULT, MetricsExporter, Telemetry
+import threading
 import sys
 
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+UI_FILE = os.path.join(ROOT_DIR, "chromatographer.ui")
+# Compiled form of UI_FILE, regenerated whenever the .ui file changes
+UI_CACHE = os.path.join(ROOT_DIR, "__pycache__", "chromatographer_ui.py")
 
 # Conversions
 MIN_TO_SEC=60
 
+# Upper limit for plot redraws per second, independent of the sample rate
+PLOT_FPS_DEFAULT = 30
+# Upper limit for blocks of points sent from the worker to the GUI per second
+DATA_RATE_DEFAULT = 50
+# Past cycles overlaid on the plot of the current cycle
+OVERLAY_CYCLES_DEFAULT = 5
+OVERLAY_ALPHA = 0.3
+# Opacity of the confidence band of the ensemble average
+ENSEMBLE_ALPHA = 0.2
+# Refresh interval of the statistics window (milliseconds)
+STATS_REFRESH_MS = 1000
+
+
+def load_ui_class():
+    """Load the Ui class compiled from UI_FILE
+
+    Parsing the .ui XML with uic on every launch is slow, so it is compiled to
+    python once and the cached module is imported on subsequent launches.
+    """
+    if (not os.path.exists(UI_CACHE)
+            or os.path.getmtime(UI_CACHE) < os.path.getmtime(UI_FILE)):
+        from PyQt5 import uic
+        os.makedirs(os.path.dirname(UI_CACHE), exist_ok=True)
+        with open(UI_FILE) as f_ui, open(UI_CACHE, 'w') as f_py:
+            uic.compileUi(f_ui, f_py)
+    spec = importlib.util.spec_from_file_location("chromatographer_ui", UI_CACHE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Ui_Chromatographer
+
+
+class LivePlot:
+    """LivePlot
+    Live plot of the current cycle drawn with blitting.
+
+    The axes, labels and grid are rendered once into a background image which
+    is restored before drawing the persistent data line on every frame. New
+    samples only mark the plot as stale, a timer redraws stale plots at most
+    max_fps times per second so the cost of plotting does not depend on the
+    sample rate. A full redraw only happens when the data leaves the y-limits.
+
+    Traces with more points than pixels are drawn as their min/max envelope
+    from a MinMaxPyramid (see lod.py), requeried whenever the x-limits change,
+    e.g., when zooming or panning with the toolbar, so the cost of a frame
+    depends on the plot width rather than the number of points.
+
+    One line is drawn per channel in labels, y has one column per channel
+    when there is more than one. The last `overlays` cycles are kept as faded
+    lines, part of the background, behind the current cycle, as is the
+    average of the cycles of the run with its confidence band (see
+    ensemble.py).
+
+    With a telemetry registry the frame draw time and the latency from the
+    worker sending data to it being drawn are recorded.
+    """
+    def __init__(self, ax, max_fps=PLOT_FPS_DEFAULT, labels=None,
+                 telemetry=None, overlays=OVERLAY_CYCLES_DEFAULT):
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+        if labels is None:
+            labels = [None]
+        self.lines = [ax.plot([], [], 'o--', animated=True, label=label)[0]
+                      for label in labels]
+        if len(self.lines) > 1:
+            ax.legend(loc='upper right')
+        self.background = None
+        self.stale = False
+        self.trace = MinMaxPyramid()
+        # (trace, lines) of past cycles, oldest first
+        self.overlays = deque(maxlen=overlays)
+        # Lines and bands of the ensemble average
+        self.ensemble_artists = []
+        # Draw time of recent frames (seconds)
+        self.frame_times = deque(maxlen=1000)
+        if telemetry is None:
+            telemetry = Telemetry()
+        self._m_draw = telemetry.histogram("plot_draw_seconds",
+                                           "Duration of plot frames")
+        self._m_latency = telemetry.histogram("plot_latency_seconds",
+                                              "Delay from sending data to drawing it")
+        # perf_counter time the oldest data not yet drawn was sent
+        self.t_sent = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(int(1000/max_fps))
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+
+    def _on_draw(self, event):
+        """Capture the static background after a full redraw"""
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_lines()
+
+    def _on_xlim_changed(self, ax):
+        """Requery the envelopes for the new x-limits before the redraw"""
+        for trace, lines in self.overlays:
+            self.set_lines(lines, trace)
+        self.set_lines(self.lines, self.trace)
+
+    def set_lines(self, lines, trace):
+        """Set the lines, one per channel, to trace at the current x-limits"""
+        xmin, xmax = self.ax.get_xlim()
+        t, y, level = trace.envelope(xmin, xmax, self.ax.bbox.width)
+        for i, line in enumerate(lines):
+            line.set_data(t, y if y.ndim == 1 else y[:, i])
+            # Mark the samples only when they are drawn individually
+            line.set_marker('o' if level == 0 else 'None')
+            line.set_linestyle('--' if level == 0 else '-')
+
+    def draw_lines(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    def set_data(self, x, y, t_sent=None):
+        """Set the data to plot on the next frame
+        x, y : the whole cycle so far, extending the data previously set
+        t_sent : perf_counter time the worker sent the new data
+        """
+        self.trace.update(x, y)
+        self.stale = True
+        if self.t_sent is None:
+            self.t_sent = t_sent
+
+    def reset(self, xmax, keep=True):
+        """Clear the data and set the time axis from zero to xmax
+        keep : overlay the cleared cycle, otherwise clear the overlays
+        """
+        if keep == False:
+            self.clear_overlays()
+            self.clear_ensemble()
+        elif len(self.trace) > 0 and self.overlays.maxlen > 0:
+            self.add_overlay(self.trace)
+        self.trace = MinMaxPyramid()
+        self.stale = False
+        self.t_sent = None
+        for line in self.lines:
+            line.set_data([], [])
+        self.ax.set_xlim(0, xmax)
+        self.frame_times.clear()
+        self.canvas.draw_idle()
+
+    def add_overlay(self, trace):
+        """Keep the trace of a finished cycle as faded lines"""
+        # The cycle buffer is reused by the next cycle
+        trace.detach()
+        if len(self.overlays) == self.overlays.maxlen:
+            for line in self.overlays[0][1]:
+                line.remove()
+        lines = [self.ax.plot([], [], '-', color=line.get_color(),
+                              alpha=OVERLAY_ALPHA, label='_nolegend_',
+                              scalex=False, scaley=False)[0]
+                 for line in self.lines]
+        self.overlays.append((trace, lines))
+        self.set_lines(lines, trace)
+
+    def clear_overlays(self):
+        for trace, lines in self.overlays:
+            for line in lines:
+                line.remove()
+        self.overlays.clear()
+
+    def set_ensemble(self, ensemble):
+        """Show the mean and confidence band of the cycles averaged so far,
+        drawn at the next full redraw, e.g., reset
+        """
+        self.clear_ensemble()
+        if ensemble.cycles < 2:
+            return
+        t, mean = ensemble.t, ensemble.mean
+        lower, upper = ensemble.band()
+        # Down to the band extremes over about two points per pixel
+        step = int(len(t)//(2*self.ax.bbox.width))
+        if step > 1:
+            starts = numpy.arange(0, len(t), step)
+            lower = numpy.fmin.reduceat(lower, starts, axis=0)
+            upper = numpy.fmax.reduceat(upper, starts, axis=0)
+            t, mean = t[starts], mean[starts]
+        for i, line in enumerate(self.lines):
+            column = (lambda a: a) if mean.ndim == 1 else (lambda a: a[:, i])
+            self.ensemble_artists.append(
+                self.ax.fill_between(t, column(lower), column(upper),
+                                     color=line.get_color(), alpha=ENSEMBLE_ALPHA,
+                                     linewidth=0, label='_nolegend_'))
+            self.ensemble_artists += self.ax.plot(t, column(mean), '-',
+                                                  color=line.get_color(),
+                                                  linewidth=2, label='_nolegend_',
+                                                  scalex=False, scaley=False)
+
+    def clear_ensemble(self):
+        for artist in self.ensemble_artists:
+            artist.remove()
+        self.ensemble_artists = []
+
+    def refresh(self):
+        """Redraw the data line if new data has been set"""
+        if self.stale == False:
+            return
+        self.stale = False
+        t_start = time.perf_counter()
+        self.set_lines(self.lines, self.trace)
+        if self.rescale() == True or self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.ax.bbox)
+        t_end = time.perf_counter()
+        self.frame_times.append(t_end - t_start)
+        self._m_draw.observe(t_end - t_start)
+        if self.t_sent is not None:
+            self._m_latency.observe(t_end - self.t_sent)
+            self.t_sent = None
+
+    def rescale(self):
+        """Expand the y-limits to fit the data, returns True if changed"""
+        limits = self.trace.limits()
+        if limits is None:
+            return False
+        ymin, ymax = limits
+        lower, upper = self.ax.get_ylim()
+        if ymin >= lower and ymax <= upper:
+            return False
+        margin = 0.1*max(ymax - ymin, 1e-3)
+        self.ax.set_ylim(min(lower, ymin - margin), max(upper, ymax + margin))
+        return True
+
+    def report(self):
+        """Print the draw time statistics of the recent frames"""
+        if len(self.frame_times) == 0:
+            return
+        times = sorted(self.frame_times)
+        print("Plot: {n} frames, draw time mean {mean:.2f} ms, "
+              "95% {p95:.2f} ms, max {max:.2f} ms".format(
+                  n=len(times),
+                  mean=1e3*sum(times)/len(times),
+                  p95=1e3*times[int(0.95*(len(times) - 1))],
+                  max=1e3*times[-1]))
+
+
+class StatsWindow(QtWidgets.QPlainTextEdit):
+    """StatsWindow
+    Live view of the acquisition statistics, refreshed while shown.
+    """
+    def __init__(self, telemetry, parent=None):
+        super(StatsWindow, self).__init__(parent)
+        self.telemetry = telemetry
+        self.setWindowTitle("Chromatographer statistics")
+        self.setReadOnly(True)
+        self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.resize(800, 400)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(STATS_REFRESH_MS)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super(StatsWindow, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super(StatsWindow, self).hideEvent(event)
+
+    def refresh(self):
+        self.setPlainText(self.telemetry.summary().replace("#   ", "")
+                          .replace("# ", ""))
+
+
+class SimilarWindow(QtWidgets.QPlainTextEdit):
+    """SimilarWindow
+    Recorded cycles most like the last cycle, see similarity.py.
+    """
+    def __init__(self, parent=None):
+        super(SimilarWindow, self).__init__(parent)
+        self.setWindowTitle("Similar cycles")
+        self.setReadOnly(True)
+        self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
+        self.resize(800, 400)
+
+    def show_matches(self, lines):
+        self.setPlainText("\n".join(lines))
+        self.show()
+        self.raise_()
+
+
 class ChromatographerQt(QtWidgets.QMainWindow):
     """ChromatographerQt
     This acts as a user interface for controlling the ChromatographerQt.
     """
     valve1_open = False
     valve7_open = False
-    def __init__(self):
+    # Emitted from a writer's thread once it has closed its files
+    writer_closed = QtCore.Signal(object)
+
+    def __init__(self, backend=cg.BACKEND_DEFAULT, profile=None,
+                 plot_fps=PLOT_FPS_DEFAULT, channels=None, telemetry=None,
+                 data_rate=DATA_RATE_DEFAULT, overlays=OVERLAY_CYCLES_DEFAULT,
+                 attach=None, replay=None,
+                 sync_interval=storage.SYNC_INTERVAL_DEFAULT, rotate_bytes=None,
+                 rotate_daily=False, ensemble_alpha=None,
+                 show_ensemble=True, adaptive=None, index=None, stats=False,
+                 hardware_timed=False, oversample=cg.OVERSAMPLE_DEFAULT,
+                 filter=None):
         super(ChromatographerQt, self).__init__()
+        self.backend = backend
+        # Sample timing and filter of the workers, see cg.Chromatographer.
+        # The filter is kept as a spec, each worker starts from a fresh state
+        self.hardware_timed = hardware_timed
+        self.oversample = oversample
+        self.filter = filter
+        # Output of the current recording, see storage.OutputWriter, and of
+        # the recordings still being written out
+        self.writer = None
+        self.closing_writers = []
+        self.writer_closed.connect(self.report_writer)
+        self.sync_interval = sync_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        # Average of the cycles of the current recording
+        self.ensemble = None
+        # None for ensemble.EWMA_ALPHA_DEFAULT
+        self.ensemble_alpha = ensemble_alpha
+        self.show_ensemble = show_ensemble
+        # AdaptiveGate of the workers, see adaptive.py
+        self.adaptive = adaptive
+        # Fingerprints of recorded cycles searched by "Find similar"
+        self.similarity = None
+        if index is not None:
+            from similarity import SimilarityIndex
+            self.similarity = SimilarityIndex(index)
+        # (t, y) of the last cycle to end
+        self.last_cycle = None
+        # Metrics of the window and of every worker it creates
+        if telemetry is None:
+            telemetry = Telemetry()
+        self.telemetry = telemetry
+        self._m_save = telemetry.histogram("save_seconds",
+                                           "Duration of queueing a cycle end for saving")
+        # Analog channels across devices, None for ai1 of the selected device
+        self.channels = channels
+        self.profile = profile
+        self.plot_fps = plot_fps
+        self.data_rate = data_rate
+        self.overlays = overlays
+        # Print the valve report after every cycle and valve toggle
+        self.print_stats = stats
+        self.worker = None
+        # Cycles are saved between START and STOP
+        self.recording = False
+
+        # Cycle time, sample window and delta set by the daemon or the
+        # replayed file rather than the settings controls
+        self.fixed_settings = None
+        # Address of a daemon (see daemon.py) acquiring for the window
+        self.attach = attach
+        if attach is not None:
+            self.worker = RemoteWorker(attach, data_rate=data_rate,
+                                       telemetry=telemetry)
+            self.channels = self.worker.channels
+            self.fixed_settings = self.worker.status
+        # Recorded output file played instead of acquiring (see replay.py)
+        self.replay = replay
+        if replay is not None:
+            self.channels = replay.channels
+            self.fixed_settings = replay.metadata
 
         self.init_ui()
+        self.mark_startup("user interface")
         self.init_plot()
-        self.init_worker()
+        self.mark_startup("plot")
 
-        # Show the GUI
+        # Show the GUI, the DAQ is initialized once the event loop is running
         self.show()
+        self.mark_startup("show window")
+        QtCore.QTimer.singleShot(0, self.init_daq)
         return None
 
     def __str__(self):
@@ -76,22 +454,17 @@ class ChromatographerQt(QtWidgets.QMainWindow):
     def init_ui(self):
         """Set up user interface for.workerects outside of Qt Creator"""
         # Interface.workerect definitions are within the chromatographer.ui file
-        uic.loadUi('chromatographer.ui', self)
+        ui = load_ui_class()()
+        ui.setupUi(self)
+        # Expose the named widgets as attributes, as uic.loadUi does
+        self.__dict__.update(vars(ui))
         self.setWindowTitle("Chromatographer")
 
         self.errorMessage = QtWidgets.QErrorMessage()
 
-        # Populate available DAQ Devices for selection
-        try:
-            self.comboDAQDev.addItems(cg.system.devices.device_names)
-        except nidaqmx.DaqError as err_msg:
-            print(err_msg)
-            print("Exiting.")
-            sys.exit(1)
-        except Exception as err_msg:
-            print(err_msg)
-            print("Exiting.")
-            sys.exit(1)
+        # Controls requiring the DAQ are enabled by init_daq
+        self.grpManual.setEnabled(False)
+        self.btnStartStop.setEnabled(False)
 
         plotlayout = QtWidgets.QVBoxLayout()
         self.figure = Figure(tight_layout=True)
@@ -104,6 +477,11 @@ class ChromatographerQt(QtWidgets.QMainWindow):
 
         self.toolbar = NavigationToolbar(self.canvas, self)
         plotlayout.addWidget(self.toolbar)
+        self.statsWindow = StatsWindow(self.telemetry)
+        self.toolbar.addSeparator()
+        self.toolbar.addAction("Stats", self.statsWindow.show)
+        self.similarWindow = SimilarWindow()
+        self.toolbar.addAction("Find similar", self.find_similar)
         self.graph.setLayout(plotlayout)
 
         # Connect Slots to Signals for events
@@ -113,6 +491,8 @@ class ChromatographerQt(QtWidgets.QMainWindow):
         self.btnV7.clicked.connect(partial(self.toggle_valve, 7))
         self.btnOutputFile.clicked.connect(self.set_output_file)
 
+        self.comboValveProgram.addItems(cg.list_programs())
+
         # Group valve buttons, labels and state for ease of programming
         self.valve = {
                 1 : {'btn'     : self.btnV1,
@@ -125,12 +505,79 @@ class ChromatographerQt(QtWidgets.QMainWindow):
 
     def init_plot(self):
         """Initialize plot area with one plot"""
-        self.xdata, self.ydata = [0], [0]
+        self.cycle = CycleBuffer(self.get_cycle_points(),
+                                 channels=self.get_channel_count())
         self.ax = self.canvas.figure.subplots()
         self.ax.set_xlabel('Time (s)')
         self.ax.set_ylabel('Signal (V)')
+        self.ax.set_xlim(0, self.get_sample_window())
+        self.ax.grid()
+        self.plot = LivePlot(self.ax, max_fps=self.plot_fps,
+                             labels=self.channels, telemetry=self.telemetry,
+                             overlays=self.overlays)
         self.ax.figure.canvas.draw()
 
+    def init_daq(self):
+        """Populate the DAQ devices and create the worker
+
+        Deferred until after the window is shown, as loading the DAQ driver
+        and opening tasks dominates the startup time.
+        """
+        if self.attach is not None:
+            self.init_remote()
+            return
+
+        if self.replay is not None:
+            # The DAQ driver is not needed to replay a file
+            self.comboDAQDev.addItem("Replay")
+            self.show_fixed_settings()
+            self.setWindowTitle("Chromatographer (replay of {})".format(
+                os.path.basename(self.replay.path)))
+        else:
+            # Populate available DAQ Devices for selection
+            try:
+                self.comboDAQDev.addItems(cg.BACKENDS[self.backend].list_devices())
+            except Exception as err_msg:
+                print(err_msg)
+                print("Exiting.")
+                sys.exit(1)
+        self.mark_startup("DAQ devices")
+
+        self.init_worker()
+        self.mark_startup("worker")
+        self.grpManual.setEnabled(True)
+        self.btnStartStop.setEnabled(True)
+        if self.profile is not None:
+            self.profile.report()
+
+    def init_remote(self):
+        """Show the settings of the daemon and listen to its worker"""
+        status = self.worker.status
+        self.comboDAQDev.addItem(status['daq_id'])
+        self.comboValveProgram.clear()
+        self.comboValveProgram.addItem(str(status['valve_program']))
+        self.show_fixed_settings()
+        self.setWindowTitle("Chromatographer ({})".format(self.attach))
+        self.connect_worker()
+        self.worker.status_changed.connect(self.toggle_controls)
+        self.worker.listen()
+        self.btnStartStop.setEnabled(True)
+        self.toggle_controls()
+
+    def show_fixed_settings(self):
+        """Show the settings of the daemon or replayed file in the controls"""
+        self.spinCycleTime.setValue(round(self.get_cycle_time()/MIN_TO_SEC))
+        self.spinSampleWindow.setValue(round(self.get_sample_window()))
+        self.spinSampleDelta.setValue(self.get_sample_delta())
+        self.plot.reset(self.get_sample_window(), keep=False)
+        self.cycle = CycleBuffer(self.get_cycle_points(),
+                                 channels=self.get_channel_count())
+
+    def mark_startup(self, phase):
+        """Mark the end of a startup phase when profiling"""
+        if self.profile is not None:
+            self.profile.mark(phase)
+
     def init_worker(self):
         """Define worker class and move to thread to interface with GUI"""
         print("Configuring worker for data collection")
@@ -144,51 +591,168 @@ class ChromatographerQt(QtWidgets.QMainWindow):
         if worker_instance is not None:
             self.worker.close_tasks()
 
-        self.worker = ChromatographerQtWorker(daq_dev,
-                                              cycle_t, sample_t,
-                                              sample_dt)
-        self.worker.data_ready.connect(self.update_plot)
-
-        self.worker.time_remaining.connect(self.update_cycle_time)
-        self.worker.finished.connect(self.toggle_controls)
-        self.worker.finished.connect(self.save_data)
+        if self.replay is not None:
+            self.worker = self.replay.create_worker(ReplayQtWorker,
+                                                    replay=self.replay,
+                                                    telemetry=self.telemetry,
+                                                    data_rate=self.data_rate,
+                                                    adaptive=self.adaptive)
+        else:
+            self.worker = ChromatographerQtWorker(daq_dev,
+                                                  cycle_t, sample_t,
+                                                  sample_dt,
+                                                  backend=self.backend,
+                                                  channels=self.get_channels(),
+                                                  valve_program=self.get_valve_program(),
+                                                  hardware_timed=self.hardware_timed,
+                                                  oversample=self.oversample,
+                                                  filter=self.filter,
+                                                  telemetry=self.telemetry,
+                                                  data_rate=self.data_rate,
+                                                  adaptive=self.adaptive)
+        self.connect_worker()
 
         self.thread = QtCore.QThread()
         self.worker.moveToThread(self.thread)
         self.worker.finished.connect(self.thread.quit)
         self.thread.started.connect(self.worker.collect_data)
+        self.thread.finished.connect(self.collection_ended)
 
-    def update_plot(self, x, y):
-        """Update plot area with new values
-        x : sample time (seconds)
-        y : signal (voltage)
+    def connect_worker(self):
+        """Connect the signals of the worker to the window"""
+        self.worker.data_ready.connect(self.update_plot)
+        self.worker.time_remaining.connect(self.update_cycle_time)
+        self.worker.peaks_ready.connect(self.save_peaks)
+        self.worker.finished.connect(self.toggle_controls)
+        self.worker.finished.connect(self.save_data)
+        self.worker.finished.connect(self.show_valve_latency)
+
+    def collection_ended(self):
+        """Stop recording when the worker ends by itself, e.g., at the end
+        of a replay
         """
-        self.xdata.append(x)
-        self.ydata.append(y)
+        if self.recording == True:
+            self.start_stop()
 
-        self.ax.cla()
-        self.ax.autoscale(False, axis='x')
-        self.ax.autoscale(True, axis='y')
+    def is_running(self):
+        """True while data is collected, by the window's worker or the daemon"""
+        if self.attach is not None:
+            return self.worker.running
+        return self.thread.isRunning()
 
-        self.ax.set_xlabel('Time (s)')
-        self.ax.set_ylabel('Signal (V)')
-        self.ax.set_xlim(0, self.spinSampleWindow.value())
+    def update_plot(self, blocks):
+        """Update plot area with the points pending in blocks
+        blocks : BlockQueue of sample times (seconds) and signals (voltage),
+                 one column per channel with several channels
 
-        self.ax.plot(self.xdata, self.ydata, 'o--')
-        self.ax.grid()
-        self.ax.figure.canvas.draw()
+        All pending points are taken at once, so when the GUI falls behind
+        the points still all reach the cycle (and the output file) in one
+        block, while the plot only draws the latest state.
+        """
+        x, y, t_sent = blocks.take()
+        if len(x) == 0:
+            return None
+        self.cycle.extend(x, y)
+        if self.recording == True:
+            # Streamed to the output file as the points arrive
+            self.writer.write_samples(self.data_id, x, y)
+        # Drawing is left to the plot timer, capped at plot_fps
+        self.plot.set_data(self.cycle.t, self.cycle.y, t_sent)
         return None
 
     def save_data(self):
         """Save the current sample dataset and clear values"""
-        print("Saving dataset to", self.get_output_file())
-        with open(self.get_output_file(), 'a') as f:
-            for x, y in zip(self.xdata, self.ydata):
-                f.write("{index},{x},{y}\n".format(index=self.data_id,
-                                                   x=x, y=y))
+        # Points of the cycle not yet taken, e.g., when several cycles
+        # finished before the GUI caught up
+        self.update_plot(self.worker.blocks)
+        if len(self.cycle) > 0:
+            self.last_cycle = (self.cycle.t.copy(), self.cycle.y.copy())
+        if self.recording == False:
+            # Attached to a daemon acquiring before START
+            self.next_cycle()
+            return
+        print("Saving dataset to", self.writer.current_path)
+        with self._m_save.time():
+            # The samples are already queued, the writer thread completes
+            # the cycle in the archive
+            self.writer.end_cycle(self.data_id)
+        self.ensemble.update(*self.dense_cycle())
+        if self.show_ensemble == True:
+            self.plot.set_ensemble(self.ensemble)
+        if self.writer.error is not None:
+            self.errorMessage.showMessage("Saving the output failed: {}".format(
+                self.writer.error))
         self.data_id += 1
-        self.xdata = []
-        self.ydata = []
+        self.plot.report()
+        self.next_cycle()
+
+    def next_cycle(self):
+        """Clear the cycle and take the points of the next one, which may
+        already be pending when the GUI fell behind
+        """
+        self.cycle.reset()
+        self.plot.reset(self.get_sample_window())
+        if self.worker.blocks.next_cycle() == True:
+            self.update_plot(self.worker.blocks)
+
+    def dense_cycle(self):
+        """Points of the cycle on the sample grid, interpolated from the
+        points kept by adaptive sampling if the worker thins them
+        """
+        if self.attach is not None:
+            adaptive = self.worker.status.get('adaptive', False)
+        else:
+            adaptive = self.adaptive is not None
+        if adaptive == False or len(self.cycle) == 0:
+            return self.cycle.t, self.cycle.y
+        # The first and last points of a cycle are always kept
+        t = self.cycle.t
+        n = int(round((t[-1] - t[0])/self.get_sample_delta())) + 1
+        grid = numpy.linspace(t[0], t[-1], min(n, self.ensemble.points))
+        return grid, reconstruct(self.cycle.t, self.cycle.y, grid)
+
+    def find_similar(self):
+        """Show the recorded cycles most like the last cycle, or the current
+        one before any cycle ended
+        """
+        if self.similarity is None:
+            self.errorMessage.showMessage(
+                "Start with --index to search an index of recorded cycles")
+            return
+        if self.last_cycle is not None:
+            t, y = self.last_cycle
+        else:
+            t, y = self.cycle.t, self.cycle.y
+        if len(t) < 2:
+            self.errorMessage.showMessage("No cycle to compare yet")
+            return
+        if len(self.similarity) == 0:
+            self.errorMessage.showMessage("The index is empty")
+            return
+        y = y.reshape(len(t), -1)
+        fingerprints = [self.similarity.fingerprint(t, y[:, i], self.get_sample_delta())
+                        for i in range(y.shape[1])]
+        t_start = time.perf_counter()
+        results = self.similarity.search([v for v, p in fingerprints],
+                                         [p for v, p in fingerprints])
+        dt = time.perf_counter() - t_start
+        from similarity import MATCH_COLUMNS
+        lines = []
+        for channel, matches in zip(self.get_channels(), results):
+            lines.append("# Channel {}: {}".format(channel, MATCH_COLUMNS))
+            lines.extend(self.similarity.format_matches(matches))
+        lines.append("# Searched {n} cycle channels in {ms:.1f} ms".format(
+            n=len(self.similarity), ms=1e3*dt))
+        self.similarWindow.show_matches(lines)
+
+    def save_peaks(self, peaks):
+        """Save the peak tables of the current dataset, one per channel"""
+        if self.recording == False:
+            return
+        print("Found {n} peaks, saving to {path}".format(
+            n=sum(len(table) for table in peaks),
+            path=storage.peaks_path(self.writer.current_path)))
+        self.writer.write_peaks(self.data_id, peaks)
 
     def update_cycle_time(self, t):
         """Cycle time progress updater
@@ -207,41 +771,97 @@ class ChromatographerQt(QtWidgets.QMainWindow):
         self.lineOutputFile.setText(filename[0])
 
     def start_stop(self):
-        """Start or stop the data collection using a threaded worker"""
-        if self.thread.isRunning() == True:
+        """Start or stop the data collection using a threaded worker
+
+        When attached to a daemon, the daemon's acquisition is started or
+        stopped instead and the window records the cycles it sends.
+        """
+        if self.recording == True:
+            # The worker wakes from any wait, returns the valves to the cycle
+            # state and leaves collect_data within milliseconds
             self.worker.stop()
             print("Stopping data collection")
-            self.thread.terminate()
-            self.thread.wait()
+            if self.attach is None:
+                self.thread.quit()
+                self.thread.wait()
+            self.recording = False
+            # Statistics of the run's cycles, saved once per run
+            self.writer.write_ensemble(self.ensemble.columns(self.get_channels()),
+                                       self.ensemble.table())
+            self.close_writer()
             self.btnStartStop.setText("START")
         else:
-            header  = "# Date : {date}\n"
-            header += "# Sample window (t) : {t} sec\n"
-            header += "# Sample interval (dt) : {dt} sec\n"
-            header += "# Cycle Time : {ct} min\n"
-            header += "#\n"
-            header += "# id, time (s), signal (V)\n"
+            metadata = dict(date=datetime.date.today().ctime(),
+                            sample_window=self.get_sample_window(),
+                            sample_delta=self.get_sample_delta(),
+                            cycle_time=self.get_cycle_time(),
+                            channels=self.get_channels())
+            # The output file, peak table and binary archive (for fast
+            # access to single cycles) are written from the writer's thread
             try:
-                with open(self.get_output_file(), 'a') as f:
-                    f.write(header.format(date=datetime.date.today().ctime(),
-                                          t=self.get_sample_window(),
-                                          dt=self.get_sample_delta(),
-                                          ct=self.get_cycle_time()))
+                self.writer = storage.OutputWriter(self.get_output_file(),
+                                                   sync_interval=self.sync_interval,
+                                                   max_bytes=self.rotate_bytes,
+                                                   daily=self.rotate_daily,
+                                                   telemetry=self.telemetry)
             except FileNotFoundError:
                 self.errorMessage.showMessage("Please select an output file!")
                 return
+            self.writer.begin_run(**metadata)
             self.btnStartStop.setText("STOP")
             # Initial dataset id set to zero for output file
             self.data_id = 0
-            self.init_worker()
-            self.thread.start()
+            self.cycle = CycleBuffer(self.get_cycle_points(),
+                                     channels=self.get_channel_count())
+            from ensemble import EWMA_ALPHA_DEFAULT, Ensemble
+            alpha = self.ensemble_alpha
+            if alpha is None:
+                alpha = EWMA_ALPHA_DEFAULT
+            self.ensemble = Ensemble(self.get_cycle_points(),
+                                     channels=self.get_channel_count(),
+                                     alpha=alpha)
+            self.plot.reset(self.get_sample_window(), keep=False)
+            self.recording = True
+            if self.attach is None:
+                self.init_worker()
+                self.thread.start()
+            else:
+                self.worker.start()
             print("Starting data collection")
         self.toggle_controls()
         return
 
+    def close_writer(self):
+        """Write the rest of the recording and close its files from the
+        writer's thread, reported by writer_closed
+        """
+        if self.writer is None:
+            return
+        self.closing_writers.append(self.writer)
+        self.writer.close(wait=False, callback=self.writer_closed.emit)
+        self.writer = None
+
+    def report_writer(self, writer):
+        """Report the outcome of a recording once its files are closed"""
+        if writer in self.closing_writers:
+            self.closing_writers.remove(writer)
+        if writer.dropped > 0:
+            print("!! WARN: {n} blocks of output were dropped".format(
+                n=writer.dropped))
+        if writer.error is not None:
+            self.errorMessage.showMessage("Saving the output failed: {}".format(
+                writer.error))
+
+    def closeEvent(self, event):
+        self.close_writer()
+        # The files are only complete once every writer has closed them
+        for writer in list(self.closing_writers):
+            writer.close()
+        super(ChromatographerQt, self).closeEvent(event)
+
     def toggle_valve(self, valve_id):
         """Toggle the state of valve X"""
-        if self.thread.isRunning() == True:
+        if self.is_running() == True:
             print("WARN: Feature disabled during experiment")
             return
 
@@ -262,29 +882,48 @@ class ChromatographerQt(QtWidgets.QMainWindow):
             self.worker.close_valve(valve_io)
             self.valve[valve_id]['lbl'].setText("V{}: Closed".format(valve_id))
             self.valve[valve_id]['btn'].setText("OPEN")
+        self.show_valve_latency()
         return
 
+    def show_valve_latency(self):
+        """Show the valve operation latencies as the manual control tooltip"""
+        report = self.worker.valve_report()
+        self.grpManual.setToolTip(report.replace("# ", ""))
+        if self.print_stats == True:
+            print(report)
+
     def toggle_controls(self):
         """Toggles the UI controls depending on data collection"""
         # Small delay to ensure thread cleans up properly
         time.sleep(0.1)
-        state = False if self.thread.isRunning() == True else True
+        state = False if self.is_running() == True else True
         self.grpManual.setEnabled(state)
-        self.grpSettings.setEnabled(state)
+        # The settings of a daemon or replay are not changed from here
+        self.grpSettings.setEnabled(state and self.fixed_settings is None)
         self.grpCycleRemain.setEnabled(not state)
 
     def get_cycle_time(self):
         """Get the cycle time convert to seconds"""
+        if self.fixed_settings is not None:
+            return self.fixed_settings['cycle_time']
         return self.spinCycleTime.value()*MIN_TO_SEC
 
     def get_sample_window(self):
         """Get the sample window time in seconds"""
+        if self.fixed_settings is not None:
+            return self.fixed_settings['sample_window']
         return self.spinSampleWindow.value()
 
     def get_sample_delta(self):
         """Get the sample interval in seconds"""
+        if self.fixed_settings is not None:
+            return self.fixed_settings['sample_delta']
         return self.spinSampleDelta.value()
 
+    def get_cycle_points(self):
+        """Get the expected number of samples per cycle"""
+        return int(numpy.ceil(self.get_sample_window()/self.get_sample_delta())) + 1
+
     def get_output_file(self):
         """Get the output file"""
         return self.lineOutputFile.text()
@@ -292,22 +931,78 @@ class ChromatographerQt(QtWidgets.QMainWindow):
     def get_selected_daq_device(self):
         return self.comboDAQDev.currentText()
 
+    def get_valve_program(self):
+        """Get the name of the valve program run before each sample window"""
+        return self.comboValveProgram.currentText()
+
+    def get_channels(self):
+        """Get the analog channels recorded"""
+        if self.channels is not None:
+            return self.channels
+        return ["{dev}/ai1".format(dev=self.get_selected_daq_device())]
+
+    def get_channel_count(self):
+        return 1 if self.channels is None else len(self.channels)
+
+
+class _BlockSender:
+    """Sends points to the GUI queued in `blocks` rather than one signal
+    each: data_ready is emitted with the queue at most data_rate times per
+    second and only once the GUI has taken the points of the previous signal.
+    """
+    def init_blocks(self, channels, data_rate, telemetry):
+        self.blocks = BlockQueue(channels=channels)
+        self.data_interval = 1/data_rate
+        self._t_notified = float('-inf')
+        self._m_blocks = telemetry.counter("data_blocks_total",
+                                           "Blocks of points sent to the GUI")
+
+    def send_data_ready(self, x, y):
+        t = time.perf_counter()
+        self.blocks.put(x, y, t)
+        if t - self._t_notified >= self.data_interval:
+            self.flush_data()
+
+    def flush_data(self):
+        """Signal the GUI of pending points, unless it has yet to take the
+        points of the last signal, which it then takes along with these
+        """
+        if self.blocks.notify() == True:
+            self._t_notified = time.perf_counter()
+            self._m_blocks.inc()
+            self.data_ready.emit(self.blocks)
+
+    def send_peaks(self, peaks):
+        # The window is complete, points held back by data_rate go first
+        self.flush_data()
+        self.peaks_ready.emit(peaks)
+
+    def send_finished(self):
+        # The GUI takes the points up to here for this cycle on finished
+        self.blocks.end_cycle()
+        self.flush_data()
+        self.finished.emit()
+
 
-class ChromatographerQtWorker(cg.Chromatographer, QtCore.QObject):
+class ChromatographerQtWorker(_BlockSender, cg.Chromatographer, QtCore.QObject):
     """ChromatographerQtWorker
     This subclass of chromatographer.Chromatographer class adds the necessary
     Qt signals and slots for interfacing with the UI.
     """
     # NOTE the Worker sends data through the signal's emit function
     time_remaining = QtCore.Signal(float)
-    data_ready     = QtCore.Signal(float, float)
+    data_ready     = QtCore.Signal(object)
+    peaks_ready    = QtCore.Signal(object)
     finished       = QtCore.Signal()
     stop_requested = False
-    def __init__(self, daq_id, cycle_time, sample_window, sample_delta):
+    def __init__(self, daq_id, cycle_time, sample_window, sample_delta,
+                 data_rate=DATA_RATE_DEFAULT, **kwargs):
         super(QtCore.QObject, self).__init__()
         super(ChromatographerQtWorker, self).__init__(daq_id, cycle_time,
                                                       sample_window,
-                                                      sample_delta)
+                                                      sample_delta,
+                                                      **kwargs)
+        self.init_blocks(len(self.channels), data_rate, self.telemetry)
 
     @QtCore.pyqtSlot()
     def collect_data(self):
@@ -316,18 +1011,216 @@ class ChromatographerQtWorker(cg.Chromatographer, QtCore.QObject):
     def send_time_remaining(self, t):
         self.time_remaining.emit(t)
 
-    def send_data_ready(self, x, y):
-        self.data_ready.emit(x, y)
+    def valve_report(self):
+        return self.valves.report()
 
-    def send_finished(self):
-        self.finished.emit()
+
+class ReplayQtWorker(ChromatographerQtWorker):
+    """ReplayQtWorker
+    Plays a recorded output file (see replay.py) instead of acquiring.
+    """
+    def __init__(self, *args, replay=None, **kwargs):
+        super(ReplayQtWorker, self).__init__(*args, **kwargs)
+        self.replay = replay
+
+    @QtCore.pyqtSlot()
+    def collect_data(self):
+        self.replay.run(self)
+
+
+class RemoteWorker(_BlockSender, QtCore.QObject):
+    """RemoteWorker
+    Stands in for ChromatographerQtWorker when attached to a daemon (see
+    daemon.py), emitting the messages of the daemon as the same signals from
+    a thread reading the connection.
+    """
+    time_remaining = QtCore.Signal(float)
+    data_ready     = QtCore.Signal(object)
+    peaks_ready    = QtCore.Signal(object)
+    finished       = QtCore.Signal()
+    status_changed = QtCore.Signal(object)
+    def __init__(self, address, data_rate=DATA_RATE_DEFAULT, telemetry=None):
+        super(RemoteWorker, self).__init__()
+        if telemetry is None:
+            telemetry = Telemetry()
+        import daemon
+        self.client = daemon.DaemonClient(*daemon.parse_address(address))
+        # The daemon sends its status first
+        message = self.client.read()
+        if message is None:
+            self.client.close()
+            raise ConnectionError(
+                "Daemon at {} closed the connection before sending its "
+                "status".format(address))
+        kind, self.status = message
+        self.channels = self.status['channels']
+        self.init_blocks(len(self.channels), data_rate, telemetry)
+        self._reader = threading.Thread(target=self._read_messages, daemon=True)
+
+    @property
+    def running(self):
+        return self.status['running']
+
+    def listen(self):
+        """Start emitting the messages, once the signals are connected"""
+        self._reader.start()
+
+    def _read_messages(self):
+        import daemon
+        while True:
+            message = self.client.read()
+            if message is None:
+                break
+            kind, value = message
+            if kind == daemon.MSG_DATA:
+                self.send_data_ready(*value)
+            elif kind == daemon.MSG_TIME:
+                self.time_remaining.emit(value)
+            elif kind == daemon.MSG_PEAKS:
+                self.send_peaks(value)
+            elif kind == daemon.MSG_FINISHED:
+                self.send_finished()
+            elif kind == daemon.MSG_STATUS:
+                self.status = value
+                self.status_changed.emit(value)
+            elif kind == daemon.MSG_REPLY and value['ok'] == False:
+                print("!! WARN: Daemon: {}".format(value['error']))
+        print("!! WARN: Disconnected from the daemon")
+        self.status = dict(self.status, running=False)
+        self.status_changed.emit(self.status)
+
+    def start(self):
+        self.client.command('start')
+
+    def stop(self):
+        self.client.command('stop')
+
+    def open_valve(self, valves):
+        self.client.command('open_valve', valves=valves)
+
+    def close_valve(self, valves):
+        self.client.command('close_valve', valves=valves)
+
+    def valve_report(self):
+        return self.status['valve_report']
+
+    def close_tasks(self):
+        self.client.close()
 
 
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-b', '--backend', choices=sorted(cg.BACKENDS),
+                        default=cg.BACKEND_DEFAULT,
+                        help="DAQ backend")
+    parser.add_argument('--startup-profile', action="store_true",
+                        help="Report the time spent in each startup phase")
+    parser.add_argument('--stats', action="store_true",
+                        help="Print the valve latencies after every cycle")
+    parser.add_argument('--plot-fps', type=float, default=PLOT_FPS_DEFAULT,
+                        help="Maximum plot redraws per second")
+    parser.add_argument('--attach', type=str, default=None,
+                        help="Attach to a daemon at [host:]port instead of "
+                             "opening the DAQ (see chromatographer.py daemon)")
+    parser.add_argument('--replay', type=str, default=None,
+                        help="Replay a recorded output file instead of acquiring")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="Replay speed relative to the recording, "
+                             "0 for as fast as possible")
+    parser.add_argument('--overlay-cycles', type=int,
+                        default=OVERLAY_CYCLES_DEFAULT,
+                        help="Past cycles overlaid on the plot")
+    parser.add_argument('--no-ensemble', action="store_true",
+                        help="Do not plot the average of the cycles of the run")
+    parser.add_argument('--ensemble-alpha', type=float, default=None,
+                        help="Weight of the latest cycle in the moving "
+                             "average baseline (default: 0.1)")
+    add_adaptive_arguments(parser)
+    parser.add_argument('--index', type=str, default=None,
+                        help="Index of recorded cycles searched by Find similar "
+                             "(see chromatographer.py similar)")
+    parser.add_argument('--data-rate', type=float, default=DATA_RATE_DEFAULT,
+                        help="Maximum blocks of points sent to the plot per second")
+    parser.add_argument('--channels', type=str, default=None,
+                        help="Analog channels to record, e.g., Dev1/ai1,Dev2/ai1 "
+                             "(default: ai1 of the selected device)")
+    parser.add_argument('--hardware-timed', action="store_true",
+                        help="Use the DAQ sample clock instead of sleeping")
+    parser.add_argument('--oversample', type=int,
+                        default=cg.OVERSAMPLE_DEFAULT,
+                        help="Raw samples averaged per measurement")
+    parser.add_argument('--filter', type=str, default=None,
+                        help="Decimating filters reducing raw samples, "
+                             "e.g., boxcar:10, median:5,boxcar:20 or "
+                             "cic:16:3,fir:4 (overrides --oversample)")
+    parser.add_argument('--sync-interval', type=float,
+                        default=storage.SYNC_INTERVAL_DEFAULT,
+                        help="Seconds between syncs of the output to disk, "
+                             "0 to sync every write")
+    parser.add_argument('--rotate-size', type=float, default=None,
+                        help="Continue in a new output file once it reaches "
+                             "this size (MB)")
+    parser.add_argument('--rotate-daily', action="store_true",
+                        help="Continue in a new output file every day")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Write metrics in the Prometheus text format to this file")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=METRICS_INTERVAL_DEFAULT,
+                        help="Seconds between writes of the metrics file")
+    # Remaining arguments are left for Qt
+    args, qt_args = parser.parse_known_args()
+    if args.filter is not None:
+        try:
+            parse_filter(args.filter)
+        except (TypeError, ValueError) as err:
+            parser.error(str(err))
+
+    profile = None
+    if args.startup_profile == True:
+        profile = cg.StartupProfile(STARTUP_T0)
+        profile.mark("imports")
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    if profile is not None:
+        profile.mark("application")
 
     icon_path = os.path.join(ROOT_DIR, "icon.svg")
     app.setWindowIcon(QtGui.QIcon(icon_path))
 
-    window = ChromatographerQt()
+    channels = None
+    if args.channels is not None:
+        channels = args.channels.split(',')
+    telemetry = Telemetry()
+    exporter = None
+    if args.metrics_file is not None:
+        exporter = MetricsExporter(telemetry, args.metrics_file,
+                                   args.metrics_interval)
+    rotate_bytes = None
+    if args.rotate_size is not None:
+        rotate_bytes = int(args.rotate_size*1e6)
+    replay = None
+    if args.replay is not None:
+        from replay import Replay
+        try:
+            replay = Replay(args.replay, speed=args.replay_speed or None)
+        except ValueError as err:
+            parser.error(str(err))
+    window = ChromatographerQt(backend=args.backend, profile=profile,
+                               plot_fps=args.plot_fps, channels=channels,
+                               telemetry=telemetry, data_rate=args.data_rate,
+                               overlays=args.overlay_cycles, attach=args.attach,
+                               replay=replay, sync_interval=args.sync_interval,
+                               rotate_bytes=rotate_bytes,
+                               rotate_daily=args.rotate_daily,
+                               ensemble_alpha=args.ensemble_alpha,
+                               show_ensemble=not args.no_ensemble,
+                               adaptive=create_gate(args), index=args.index,
+                               stats=args.stats,
+                               hardware_timed=args.hardware_timed,
+                               oversample=args.oversample,
+                               filter=args.filter)
     app.exec_()
+    if exporter is not None:
+        exporter.stop()
@@ -27,25 +27,64 @@ example for lab technologists and students for writing software to record data
 using python and the nidaqmx interface.
 """
 
-import nidaqmx
-from nidaqmx.constants import TerminalConfiguration as termcfg
-from numpy import arange, mean
 import time
-
-# Valve ID constants for bitwise write operations
-VALVE_ALL_OFF = 0x00
-VALVE_1       = 0x02
-VALVE_2       = 0x04
-VALVE_3       = 0x08
-VALVE_4       = 0x10
-VALVE_5       = 0x20
-VALVE_6       = 0x40
-VALVE_7       = 0x80
-VALVE_ALL_ON = VALVE_1|VALVE_2|VALVE_3|VALVE_4|VALVE_5|VALVE_6|VALVE_7
+# Reference point for --startup-profile, set before the heavier imports
+STARTUP_T0 = time.perf_counter()
+
+from adaptive import add_adaptive_arguments, create_gate
+from backends import BACKENDS, BACKEND_DEFAULT, DAQBackend, open_devices
+from buffers import CycleBuffer, RingBuffer
+import copy
+from filters import Boxcar, Filter, parse_filter
+from functools import partial
+from numpy import arange, ceil, concatenate, empty
+from peaks import PeakDetector, format_peaks
+from scheduler import Cancelled, Scheduler
+from telemetry import METRICS_INTERVAL_DEFAULT, MetricsExporter, Telemetry
+from valves import (VALVE_ALL_OFF, VALVE_1, VALVE_2, VALVE_3, VALVE_4, VALVE_5,
+                    VALVE_6, VALVE_7, VALVE_ALL_ON, PRIME_PROGRAM,
+                    ValveProgram, ValveState, list_programs, load_program)
 
 DAQ_DEFAULT = "Dev1"
 
-system = nidaqmx.system.System()
+# Number of raw samples averaged into one measurement point
+OVERSAMPLE_DEFAULT = 10
+# Target interval (seconds) between DAQ buffer callbacks when hardware timed
+CALLBACK_INTERVAL = 0.05
+
+# Commandline subcommands and the modules implementing them with main(argv)
+SUBCOMMANDS = {
+    'batch'      : 'batch',
+    'daemon'     : 'daemon',
+    'replay'     : 'replay',
+    'similar'    : 'similarity',
+    'supervisor' : 'supervisor',
+}
+
+
+class StartupProfile:
+    """StartupProfile
+    Records the time spent in each phase of the application startup, as
+    reported by the --startup-profile option.
+    """
+    def __init__(self, t0=STARTUP_T0):
+        self.t0 = t0
+        self.t_last = t0
+        self.phases = []
+
+    def mark(self, phase):
+        """Mark the end of phase, timed from the previous mark"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.t_last))
+        self.t_last = now
+
+    def report(self):
+        """Print the time spent per phase"""
+        print("# Startup profile")
+        for phase, dt in self.phases:
+            print("#   {phase:<24} {ms:8.1f} ms".format(phase=phase, ms=dt*1e3))
+        print("#   {phase:<24} {ms:8.1f} ms".format(phase="total",
+                                                   ms=(self.t_last - self.t0)*1e3))
 
 
 class Chromatographer:
@@ -58,95 +97,365 @@ class Chromatographer:
     """
     # NOTE the Worker sends data through the signal's emit function
     stop_requested = False
-    def __init__(self, daq_id, cycle_time, sample_window, sample_delta):
-        # System Configuration for NI DAQs
-        self.system = nidaqmx.system.System()
-
-        # Configure DAQ to use analog input 1 and 9 for differential output as
-        # per the user manual for the DAQ 6014: ai{i, i+8} for differential
-        self.task_analog = nidaqmx.Task()
-        self.task_analog.ai_channels.add_ai_voltage_chan("{dev}/ai1".format(dev=daq_id),
-                                                         terminal_config=termcfg.DIFFERENTIAL)
-        self.task_analog.start()
-
-        # Use digital IO lined 0->7
-        self.task_digital = nidaqmx.Task()
-        self.task_digital.do_channels.add_do_chan('{dev}/port0/line0:7'.format(dev=daq_id))
-        self.task_digital.start()
-
+    def __init__(self, daq_id, cycle_time, sample_window, sample_delta,
+                 hardware_timed=False, oversample=OVERSAMPLE_DEFAULT,
+                 backend=BACKEND_DEFAULT, filter=None, peak_detector=None,
+                 channels=None, valve_program=None, telemetry=None,
+                 adaptive=None):
         self.cycle_time = cycle_time
         self.cycle_time_remaining = cycle_time
 
+        # Timing metrics of the acquisition, see telemetry.py
+        if telemetry is None:
+            telemetry = Telemetry()
+        self.telemetry = telemetry
+        # Print the metrics at the end of every cycle
+        self.print_stats = False
+
         self.sample_t = sample_window
         self.sample_dt = sample_delta
 
         if self.sample_dt >= self.sample_t:
             raise ValueError("sample_delta MUST be lower than sample_window")
 
+        # Analog channels such as "Dev1/ai1", by default the differential
+        # detector channel of daq_id
+        if channels is None:
+            channels = ["{dev}/ai1".format(dev=daq_id)]
+        # backend is either the name of a backend, opened with one backend per
+        # device of the channels, a DAQBackend instance or a list of them
+        if isinstance(backend, DAQBackend):
+            self.daqs = [backend]
+        elif isinstance(backend, str):
+            self.daqs = open_devices(backend, channels)
+        else:
+            self.daqs = list(backend)
+        # The first device drives the valves
+        self.daq = self.daqs[0]
+        self.channels = [ch for daq in self.daqs for ch in daq.channels]
+
+        # Raw samples are reduced to one point per sample_delta by the filter,
+        # either a Filter or a spec for filters.parse_filter. By default the
+        # mean of oversample samples is taken.
+        if filter is None:
+            filter = Boxcar(oversample)
+        elif not isinstance(filter, Filter):
+            filter = parse_filter(filter)
+        self.filter = filter
+        self.oversample = self.filter.decimation
+        # Each device has its own filter state, filtering all of its channels
+        self.filters = [self.filter] + [copy.deepcopy(self.filter)
+                                        for daq in self.daqs[1:]]
+        # Polled reads are not contiguous, so each one covers the support of
+        # the filter for its last output to be free of the start up state
+        self.polled_samples = (-(-self.filter.support//self.oversample)
+                               *self.oversample)
+
+        # Hardware timed acquisition uses the DAQ sample clock at
+        # oversample/sample_delta and streams blocks into a ring buffer
+        self.hardware_timed = hardware_timed
+        self.sample_rate = self.oversample/self.sample_dt
+        points_per_block = max(1, int(round(CALLBACK_INTERVAL/self.sample_dt)))
+        self.block_size = points_per_block*self.oversample
+        self._points_acquired = [0]*len(self.daqs)
+        n_points = int(ceil(self.sample_t/self.sample_dt))
+        if self.hardware_timed == True:
+            self.rings = [RingBuffer(n_points + points_per_block,
+                                     channels=len(daq.channels))
+                          for daq in self.daqs]
+            # Points read from some devices but not yet from all of them
+            self._pending = None
+
+        # Samples of the current cycle, analysed for peaks as they arrive
+        self.cycle = CycleBuffer(n_points + 1, channels=len(self.channels))
+        if peak_detector is None:
+            peak_detector = PeakDetector(sample_delta=self.sample_dt)
+        self.peak_detector = peak_detector
+        self.peak_detectors = [peak_detector] + [copy.deepcopy(peak_detector)
+                                                 for ch in self.channels[1:]]
+        # AdaptiveGate thinning the points sent on the baseline, None to send
+        # every point (see adaptive.py)
+        self.adaptive = adaptive
+
+        # Valve program run before each sample window, a ValveProgram or the
+        # name of a built-in program or program file
+        if valve_program is None:
+            valve_program = PRIME_PROGRAM
+        elif not isinstance(valve_program, ValveProgram):
+            valve_program = load_program(valve_program)
+        self.valve_program = valve_program
+        # Shadow of the valve port, read from the device once here
+        self.valves = ValveState(self.daq, telemetry=self.telemetry)
+        self.valves.resync()
+
+        # Cycles start cycle_time apart, the scheduler's waits are woken by stop
+        self.scheduler = Scheduler(self.cycle_time)
+        self.init_metrics()
+
+    def init_metrics(self):
+        """Look up the metrics updated on the hot paths once"""
+        m = self.telemetry
+        m.gauge("sample_delta_requested_seconds",
+                "Requested interval between points").set(self.sample_dt)
+        m.gauge("cycle_time_seconds", "Interval between cycle starts").set(self.cycle_time)
+        self._m_read = m.histogram("daq_read_seconds",
+                                   "Duration of software timed analog reads")
+        self._m_interval = m.histogram("sample_interval_seconds",
+                                       "Achieved interval between software timed points")
+        self._m_lateness = m.histogram("sample_lateness_seconds",
+                                       "Delay of software timed reads after their deadline")
+        self._m_callback = m.histogram("daq_callback_seconds",
+                                       "Duration of the DAQ buffer callback")
+        self._m_callback_interval = m.histogram("daq_callback_interval_seconds",
+                                                "Interval between DAQ buffer callbacks")
+        self._m_cycle = m.histogram("cycle_seconds", "Duration of a cycle")
+        self._m_cycle_lateness = m.histogram("cycle_start_lateness_seconds",
+                                             "Delay of cycle starts after their deadline")
+        self._m_cycles = m.counter("cycles_total", "Cycles completed")
+        self._m_points = m.counter("points_total", "Points recorded")
+        self._m_sent = m.counter("points_sent_total",
+                                 "Points sent to the interface or clients")
+        self._m_overruns = m.counter("ring_overruns_total",
+                                     "Points dropped by the ring buffers")
+        self._t_last_callback = [None]*len(self.daqs)
+
     def __str__(self):
         return "Chromatographer Class"
 
     def close_tasks(self):
         """Stops and closes any defined analog and digital tasks"""
-        print('Cleaning up DAQ tasks')
-        self.task_digital.stop()
-        self.task_digital.close()
-
-        self.task_analog.stop()
-        self.task_analog.close()
+        for daq in self.daqs:
+            daq.close()
 
     def collect_data(self):
         """Collects data based on the operation schematic.
-        (1) Wait cycle time duration (updates progress bar and timer)
+        (1) Wait until the cycle start (updates progress bar and timer)
         (2) Prime valves before mesaurements
         (3) Allow gas to flow in and record measurements accordingly
         (4) Reset valves to cycle state
         (5) Go to (1)
+
+        Cycles start cycle_time apart. A stop ends the collection at any
+        step, dropping the unfinished cycle, and leaves the valves in the
+        cycle state.
         """
+        try:
+            self.reset_to_cycle_state()
+            self.scheduler.start()
+            while self.scheduler.wait_for_cycle(self.update_time_remaining):
+                t_deadline = self.scheduler.next_start - self.scheduler.period
+                self._m_cycle_lateness.observe(time.monotonic() - t_deadline)
+                t_start = time.perf_counter()
+                self.run_cycle()
+                self._m_cycle.observe(time.perf_counter() - t_start)
+        except Cancelled:
+            pass
+        finally:
+            self.reset_to_cycle_state()
+            # Reinitialize the state if user restarts this function
+            self.stop_requested = False
+            self.scheduler.reset()
+
+    def update_time_remaining(self, t):
+        self.cycle_time_remaining = t
+        self.send_time_remaining(t)
+
+    def run_cycle(self):
+        """Prime the valves, sample and send the cycle"""
+        self.prime_valves()
+        self.scheduler.check()
+        self.reset_cycle()
+        if self.hardware_timed == True:
+            self.sample_buffered()
+        else:
+            self.sample_polled()
+        self.scheduler.check()
         self.reset_to_cycle_state()
-        while True:
-            if self.stop_requested == True:
+        self._m_cycles.inc()
+        self._m_points.inc(len(self.cycle))
+        self.finish_points()
+        self.send_peaks([detector.finish(self.cycle.t, self.cycle.channel(i))
+                         for i, detector in enumerate(self.peak_detectors)])
+        self.send_finished()
+
+    def reset_cycle(self):
+        """Clear the cycle and the detectors for the next cycle"""
+        self.cycle.reset()
+        for detector in self.peak_detectors:
+            detector.reset()
+        if self.adaptive is not None:
+            self.adaptive.reset()
+
+    def send_points(self, x, y):
+        """Send the points just added to the cycle, only those kept by the
+        adaptive gate if any
+        """
+        if self.adaptive is not None:
+            keep = self.adaptive.update(self.cycle.t, self.cycle.y)
+            if len(keep) == 0:
+                return
+            x, y = self.cycle.t[keep], self.cycle.y[keep]
+        self._m_sent.inc(len(x))
+        self.send_data_ready(x, y)
+
+    def finish_points(self):
+        """Send the points of the cycle held back by the adaptive gate"""
+        if self.adaptive is None:
+            return
+        keep = self.adaptive.finish(self.cycle.t, self.cycle.y)
+        if len(keep) > 0:
+            self._m_sent.inc(len(keep))
+            self.send_data_ready(self.cycle.t[keep], self.cycle.y[keep])
+
+    def update_peaks(self):
+        """Run the peak detectors over the samples added to the cycle"""
+        for i, detector in enumerate(self.peak_detectors):
+            detector.update(self.cycle.t, self.cycle.channel(i))
+
+    def sample_polled(self):
+        """Sample the signal over the sample window using software timing
+
+        Readings are started on a grid of sample_delta from the start of the
+        window rather than sleeping sample_delta after each reading.
+        """
+        t_start = time.monotonic()
+        t_last = None
+        for t in arange(0, self.sample_t, self.sample_dt):
+            if self.scheduler.wait_until(t_start + t) == False:
                 break
-
-            time.sleep(1)
-            self.cycle_time_remaining -= 1 # 1 second
-            self.send_time_remaining(self.cycle_time_remaining)
-            if self.cycle_time_remaining > 0:
-                continue
-
-            self.prime_valves()
-            for t in arange(0, self.sample_t, self.sample_dt):
-                if self.stop_requested == True:
-                    break
-                # Average N samples per measurement
-                signals = self.task_analog.read(number_of_samples_per_channel=10)
-                self.send_data_ready(t, mean(signals))
-                time.sleep(self.sample_dt)
-            self.reset_to_cycle_state()
-            self.send_finished()
-            self.cycle_time_remaining = self.cycle_time
-            self.send_time_remaining(self.cycle_time_remaining)
-        # Reinitialize the state if user restarts this function
-        self.stop_requested = False
+            now = time.monotonic()
+            self._m_lateness.observe(now - (t_start + t))
+            if t_last is not None:
+                self._m_interval.observe(now - t_last)
+            t_last = now
+            # Reduce the samples of every channel to one measurement, the
+            # last output of the filter
+            signals = []
+            for daq, filter in zip(self.daqs, self.filters):
+                filter.reset()
+                with self._m_read.time():
+                    samples = daq.read_analog(self.polled_samples)
+                signals.append(filter.process(samples)[:, -1])
+            signals = concatenate(signals)
+            self.cycle.append(t, signals[0] if len(signals) == 1 else signals)
+            self.update_peaks()
+            self.send_points(self.cycle.t[-1:].copy(), self.cycle.y[-1:].copy())
+
+    def sample_buffered(self):
+        """Sample the signal over the sample window using the DAQ sample clock
+
+        Times sent are the acquisition times of the averaged samples relative
+        to the start of the window, derived from the (coerced) sample clock
+        rate rather than the nominal sample_delta grid. Each batch of points
+        read from the ring buffers is sent at once.
+        """
+        self.start_buffered_acquisition()
+        try:
+            done = False
+            while done == False and self.stop_requested == False:
+                times, signals = self.read_rings(timeout=0.5)
+                done = len(times) > 0 and times[-1] >= self.sample_t
+                # Drop the filter start up, before the window opened
+                in_window = (times >= 0) & (times < self.sample_t)
+                times, signals = times[in_window], signals[in_window]
+                if len(times) == 0:
+                    continue
+                self.cycle.extend(times, signals)
+                self.update_peaks()
+                self.send_points(times, signals)
+        finally:
+            self.stop_buffered_acquisition()
+        overruns = sum(ring.overruns for ring in self.rings)
+        self._m_overruns.inc(overruns)
+        if overruns > 0:
+            print("!! WARN: {n} samples dropped".format(n=overruns))
+
+    def read_rings(self, timeout=None):
+        """Read the points acquired from every device as (t, y)
+
+        The devices run on their own sample clocks at the same rate, so points
+        are matched by their index and timed by the first device. Points are
+        only returned once every device has acquired them.
+        """
+        for i, ring in enumerate(self.rings):
+            # Only wait for the first device, the others are at the same rate
+            times, signals = ring.read(timeout=timeout if i == 0 else 0)
+            t_pending, y_pending = self._pending[i]
+            self._pending[i] = (concatenate((t_pending, times)),
+                                concatenate((y_pending,
+                                             signals.reshape(len(times), ring.channels))))
+        n = min(len(t) for t, y in self._pending)
+        times = self._pending[0][0][:n]
+        signals = concatenate([y[:n] for t, y in self._pending], axis=1)
+        self._pending = [(t[n:], y[n:]) for t, y in self._pending]
+        if len(self.channels) == 1:
+            signals = signals[:, 0]
+        return times, signals
+
+    def start_buffered_acquisition(self):
+        """Configure the analog sample clocks and start streaming to the rings"""
+        self._points_acquired = [0]*len(self.daqs)
+        self._pending = [(empty(0), empty((0, len(daq.channels))))
+                         for daq in self.daqs]
+        for filter, ring in zip(self.filters, self.rings):
+            filter.reset()
+            ring.clear()
+        rates = []
+        for i, daq in enumerate(self.daqs):
+            # The device may coerce the requested rate
+            rates.append(daq.start_buffered(self.oversample/self.sample_dt,
+                                            self.block_size,
+                                            partial(self._on_samples_acquired, i)))
+        self.sample_rate = rates[0]
+        self._t_last_callback = [None]*len(self.daqs)
+        self.telemetry.gauge("sample_rate_hz", "DAQ sample clock rate").set(self.sample_rate)
+        self.telemetry.gauge("daq_callback_interval_expected_seconds",
+                             "Nominal interval between DAQ buffer callbacks").set(
+                                     self.block_size/self.sample_rate)
+        if max(rates) != min(rates):
+            print("!! WARN: Devices sample at different rates: {}".format(rates))
+
+    def stop_buffered_acquisition(self):
+        """Stop streaming samples from the DAQ"""
+        for daq in self.daqs:
+            daq.stop_buffered()
+
+    def _on_samples_acquired(self, device, samples):
+        """DAQ callback, filters a block of samples into the ring buffer
+        device  : index of the device in self.daqs
+        samples : (channels, n) raw samples
+        """
+        t_start = time.perf_counter()
+        if self._t_last_callback[device] is not None:
+            self._m_callback_interval.observe(t_start - self._t_last_callback[device])
+        self._t_last_callback[device] = t_start
+        filter = self.filters[device]
+        signals = filter.process(samples)
+        n_points = signals.shape[-1]
+        points = self._points_acquired[device] + arange(n_points)
+        # Time on the sample clock of the raw samples each point represents
+        times = filter.sample_index(points)/self.sample_rate
+        self._points_acquired[device] += n_points
+        # One row per point, a single channel is kept 1D
+        signals = signals[0] if len(signals) == 1 else signals.T
+        self.rings[device].write(times, signals)
+        self._m_callback.observe(time.perf_counter() - t_start)
+        return 0
 
     def prime_valves(self):
         """Prime the valves before taking readings
-        As outlined in the operation schematic.
+        Runs the valve program, by default as outlined in the operation
+        schematic.
         """
-        self.set_valve(VALVE_ALL_OFF)
-        time.sleep(5)
-        self.set_valve(VALVE_4)
-        time.sleep(2)
-        self.set_valve(VALVE_4|VALVE_6)
-        time.sleep(5)
-        self.set_valve(VALVE_4)
-        time.sleep(2)
-        self.set_valve(VALVE_2|VALVE_4)
-        time.sleep(5)
-        self.set_valve(VALVE_4)
-        time.sleep(2)
-        self.set_valve(VALVE_3|VALVE_5)
-        time.sleep(5)
+        self.run_valve_program(self.valve_program)
+
+    def run_valve_program(self, program):
+        """Run a valve program on the DAQ sample clock if possible
+
+        Falls back to timing the steps in software on devices without
+        buffered digital output.
+        """
+        return self.valves.run_program(program, cancel=self.scheduler.cancel)
 
     def reset_to_cycle_state(self):
         """Reset all valves to off, except valve 4 to allow Ar to flow"""
@@ -164,9 +473,7 @@ class Chromatographer:
 
         Where VALVE_1 = 0x01 and VALVE_2 = 0x02.
         """
-        valves_state = self.task_digital.read()
-        new_valves_state = valves_state | valves
-        self.task_digital.write([new_valves_state])
+        self.valves.open(valves)
 
     def close_valve(self, valves):
         """Close only the requested valves
@@ -180,9 +487,7 @@ class Chromatographer:
 
         Where VALVE_1 = 0x01 and VALVE_2 = 0x02.
         """
-        valves_state = self.task_digital.read()
-        new_valves_state = valves_state & (~valves & 0xff)
-        self.task_digital.write(new_valves_state)
+        self.valves.close(valves)
 
     def set_valve(self, valves):
         """Set valves to be turned on.
@@ -191,33 +496,77 @@ class Chromatographer:
         Unlike open_valve and close_valve, set_valve opens the valves of
         interest, while closing the rest.
         """
-        self.task_digital.write([valves])
+        self.valves.set(valves)
+
+    def valve_transaction(self):
+        """Context manager grouping valve changes into one port write, e.g.,
+
+        with worker.valve_transaction():
+            worker.close_valve(VALVE_1)
+            worker.open_valve(VALVE_7)
+        """
+        return self.valves.transaction()
+
+    def resync_valves(self):
+        """Re-read the valve state from the device, e.g., after it was
+        changed outside of this program
+        """
+        return self.valves.resync()
 
     def stop(self):
-        """Safely request stop for worker"""
+        """Safely request stop for worker, from any thread
+
+        Wakes the worker from any wait, including valve programs and reads of
+        the ring buffers, so the stop takes effect immediately.
+        """
         self.stop_requested = True
+        self.scheduler.stop()
+        for ring in getattr(self, 'rings', []):
+            ring.wake()
 
     def send_time_remaining(self, t):
         pass
 
     def send_data_ready(self, x, y):
-        print(x, y)
+        """Points acquired since the last call
+        x : sample times (seconds)
+        y : signals (voltage), one column per channel with several channels
+        """
+        for t, signal in zip(x, y):
+            if len(self.channels) == 1:
+                print(t, signal)
+            else:
+                print(t, *signal)
+
+    def send_peaks(self, peaks):
+        """Peak tables of the finished cycle, one per channel, see
+        peaks.PEAK_DTYPE
+        """
+        for channel, table in zip(self.channels, peaks):
+            if len(self.channels) > 1:
+                print("# Peaks of", channel)
+            for line in format_peaks(table).splitlines():
+                print("# " + line.lstrip("# "))
 
     def send_finished(self):
         print("# Dataset finished")
+        if self.print_stats == True:
+            print(self.telemetry.summary())
 
 
-if __name__ == '__main__':
-    from argparse import ArgumentParser
-    import datetime
-    from sys import exit
-
-    parser = ArgumentParser()
+def add_acquisition_arguments(parser):
+    """Add the options selecting the DAQ devices and configuring the cycle,
+    shared by the commandline and the daemon subcommand
+    """
     parser.add_argument('-d', '--daq-device', type=str, default=DAQ_DEFAULT,
                         help="DAQ device")
-    parser.add_argument('-l', '--list-devices', action="store_true",
-                        help="Display available DAQ devices")
-
+    parser.add_argument('--channels', type=str, default=None,
+                        help="Analog channels to record, e.g., "
+                             "Dev1/ai1,Dev1/ai2,Dev2/ai1 (default: <DAQ device>/ai1), "
+                             "the first device drives the valves")
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS),
+                        default=BACKEND_DEFAULT,
+                        help="DAQ backend")
     group_cfg = parser.add_argument_group("Chromatographer configuration")
     group_cfg.add_argument('-c', '--cycle-time', type=int, default=300,
                            help="Cycle time in seconds")
@@ -225,6 +574,97 @@ if __name__ == '__main__':
                            help="Sample window (t) in seconds")
     group_cfg.add_argument('-t', '--sample-delta', type=float,  default=0.5,
                            help="Sample interval (dt) in seconds")
+    group_cfg.add_argument('--hardware-timed', action="store_true",
+                           help="Use the DAQ sample clock instead of sleeping")
+    group_cfg.add_argument('--oversample', type=int,
+                           default=OVERSAMPLE_DEFAULT,
+                           help="Raw samples averaged per measurement")
+    group_cfg.add_argument('--valve-program', type=str, default=None,
+                           help="Valve program run before each sample window, "
+                                "the name of a program ({}) or a program "
+                                "file".format(", ".join(list_programs())))
+    group_cfg.add_argument('--filter', type=str, default=None,
+                           help="Decimating filters reducing raw samples, "
+                                "e.g., boxcar:10, median:5,boxcar:20 or "
+                                "cic:16:3,fir:4 (overrides --oversample)")
+
+    group_sim = parser.add_argument_group("Simulated device (--backend simulated)")
+    group_sim.add_argument('--sim-peaks', type=str, default=None,
+                           help="Peaks as rt:height:width[,rt:height:width...]")
+    group_sim.add_argument('--sim-noise', type=float, default=0.002,
+                           help="Noise standard deviation (V)")
+    group_sim.add_argument('--sim-drift', type=float, default=1e-5,
+                           help="Baseline drift (V/s)")
+    group_sim.add_argument('--sim-latency', type=float, default=0.0,
+                           help="Latency added to each DAQ access (s)")
+    group_sim.add_argument('--sim-max-rate', type=float, default=1e6,
+                           help="Highest sample rate of the device (Hz)")
+    group_sim.add_argument('--sim-software-valves', action="store_true",
+                           help="Device without buffered digital output")
+    add_adaptive_arguments(parser)
+
+
+def create_worker(args, worker_class=None):
+    """Open the DAQ devices and create the worker configured by the options
+    of add_acquisition_arguments
+    """
+    if worker_class is None:
+        worker_class = Chromatographer
+    if args.channels is not None:
+        channels = args.channels.split(',')
+    else:
+        channels = ["{dev}/ai1".format(dev=args.daq_device)]
+
+    if args.backend == 'simulated':
+        sim_options = dict(noise=args.sim_noise, drift=args.sim_drift,
+                           latency=args.sim_latency,
+                           max_rate=args.sim_max_rate,
+                           buffered_digital=not args.sim_software_valves)
+        if args.sim_peaks is not None:
+            sim_options['peaks'] = [[float(v) for v in peak.split(':')]
+                                    for peak in args.sim_peaks.split(',')]
+        backend = open_devices(args.backend, channels, **sim_options)
+    else:
+        backend = args.backend
+
+    return worker_class(args.daq_device, args.cycle_time, args.sample_window,
+                        args.sample_delta,
+                        hardware_timed=args.hardware_timed,
+                        oversample=args.oversample,
+                        filter=args.filter,
+                        backend=backend,
+                        channels=channels,
+                        valve_program=args.valve_program,
+                        adaptive=create_gate(args))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import datetime
+    import importlib
+    from sys import argv, exit
+
+    profile = StartupProfile()
+    profile.mark("imports")
+
+    # Subcommands are only imported when used
+    if len(argv) > 1 and argv[1] in SUBCOMMANDS:
+        exit(importlib.import_module(SUBCOMMANDS[argv[1]]).main(argv[2:]))
+
+    parser = ArgumentParser(epilog="Subcommands: {}, see <subcommand> --help".format(
+        ", ".join(sorted(SUBCOMMANDS))))
+    add_acquisition_arguments(parser)
+    parser.add_argument('-l', '--list-devices', action="store_true",
+                        help="Display available DAQ devices")
+    parser.add_argument('--startup-profile', action="store_true",
+                        help="Report the time spent in each startup phase")
+    parser.add_argument('--stats', action="store_true",
+                        help="Print timing statistics after every cycle and at exit")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Write metrics in the Prometheus text format to this file")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=METRICS_INTERVAL_DEFAULT,
+                        help="Seconds between writes of the metrics file")
 
     group_man = parser.add_argument_group("Manual valve control")
     group_man.add_argument('-o', '--open', action="store_true",
@@ -235,18 +675,18 @@ if __name__ == '__main__':
                            help="shut specified valve (-v or --valve).")
 
     args = parser.parse_args()
+    profile.mark("arguments")
 
     if args.list_devices == True:
-        for dev in system.devices.device_names:
+        for dev in BACKENDS[args.backend].list_devices():
             print(dev)
         exit()
 
+    worker = create_worker(args)
     cycle_time = args.cycle_time
     sample_t = args.sample_window
     sample_dt = args.sample_delta
-    daq_device = args.daq_device
-
-    worker = Chromatographer(daq_device, cycle_time, sample_t, sample_dt)
+    profile.mark("DAQ initialization")
 
     if (args.open == True) and (args.shut == True):
         print("!! CONFLICT: Only pass one valve control option at a time")
@@ -269,8 +709,24 @@ if __name__ == '__main__':
     print("# Sample window (t) :", sample_t)
     print("# Sample interval (dt) :", sample_dt)
     print("# Cycle time :", cycle_time)
+    print("# Channels :", ", ".join(worker.channels))
+    print("# Valve program :", worker.valve_program)
+    if args.startup_profile == True:
+        profile.report()
+    worker.print_stats = args.stats
+    exporter = None
+    if args.metrics_file is not None:
+        exporter = MetricsExporter(worker.telemetry, args.metrics_file,
+                                   args.metrics_interval)
     try:
           worker.collect_data()
+    except KeyboardInterrupt:
+        print("# Stopped")
     except Exception as err:
         print(err)
+    if exporter is not None:
+        exporter.stop()
+    if args.stats == True:
+        print(worker.telemetry.summary())
+        print(worker.valves.report())
     worker.close_tasks()
@@ -0,0 +1,542 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+=========
+daemon.py
+=========
+
+Headless acquisition daemon, run as
+
+    python chromatographer.py daemon [options]
+
+The daemon owns the DAQ devices and runs collect_data in a thread, publishing
+the points, peak tables, cycle ends and time remaining to any number of
+clients connected to a local TCP socket, e.g., chromatographer-qt.py
+--attach. Clients send commands on the same connection to start and stop the
+acquisition and to open and close valves while it is stopped.
+
+Every message is a frame of a header, holding the message kind and the
+payload length, followed by the payload. Points and peak tables are sent as
+raw little endian arrays, the status, commands and replies as JSON.
+
+Publishing a message only queues it for a fan-out thread, which encodes it
+once and queues the frame to the sender thread of each client, so slow
+clients never hold up the acquisition. A client falling CLIENT_QUEUE_FRAMES
+frames behind is disconnected.
+
+Clients are not authenticated, anyone who can connect controls the valves,
+so the daemon only listens on a loopback address unless --allow-remote is
+given.
+"""
+
+import ipaddress
+import json
+import numpy
+import queue
+import socket
+import struct
+import threading
+
+import chromatographer as cg
+from peaks import PEAK_DTYPE
+from telemetry import METRICS_INTERVAL_DEFAULT, MetricsExporter
+from valves import parse_valves
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT_DEFAULT = 5470
+PROTOCOL_VERSION = 1
+
+# Frames queued per client before it is disconnected for falling behind
+CLIENT_QUEUE_FRAMES = 10000
+# Seconds between checks for a stop while waiting for connections
+ACCEPT_TIMEOUT = 1.0
+
+# Message kinds
+MSG_STATUS   = 1    # JSON, sent on connecting and whenever the status changes
+MSG_DATA     = 2    # uint32 n, uint32 channels, n times, n*channels values
+MSG_TIME     = 3    # float64 seconds remaining to the next cycle
+MSG_PEAKS    = 4    # uint32 tables, then uint32 n and n peaks per table
+MSG_FINISHED = 5    # no payload, the cycle has finished
+MSG_COMMAND  = 6    # JSON {"command" : ..., ...}, from a client
+MSG_REPLY    = 7    # JSON {"command" : ..., "ok" : ..., "error" : ...}
+
+HEADER = struct.Struct("<BI")
+_COUNT = struct.Struct("<I")
+_DATA = struct.Struct("<II")
+_TIME = struct.Struct("<d")
+_PEAK_WIRE_DTYPE = PEAK_DTYPE.newbyteorder('<')
+
+
+def encode(kind, value=None):
+    """Frame of a message"""
+    if kind == MSG_DATA:
+        t, y = value
+        t = numpy.ascontiguousarray(t, dtype='<f8')
+        y = numpy.ascontiguousarray(y, dtype='<f8')
+        channels = 1 if y.ndim == 1 else y.shape[1]
+        payload = _DATA.pack(len(t), channels) + t.tobytes() + y.tobytes()
+    elif kind == MSG_TIME:
+        payload = _TIME.pack(value)
+    elif kind == MSG_PEAKS:
+        parts = [_COUNT.pack(len(value))]
+        for table in value:
+            parts.append(_COUNT.pack(len(table)))
+            parts.append(numpy.asarray(table).astype(_PEAK_WIRE_DTYPE).tobytes())
+        payload = b"".join(parts)
+    elif kind == MSG_FINISHED:
+        payload = b""
+    else:
+        payload = json.dumps(value).encode()
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def decode(kind, payload):
+    """Value of a message from its payload"""
+    if kind == MSG_DATA:
+        n, channels = _DATA.unpack_from(payload)
+        t = numpy.frombuffer(payload, '<f8', n, _DATA.size)
+        y = numpy.frombuffer(payload, '<f8', n*channels, _DATA.size + 8*n)
+        return t, (y if channels == 1 else y.reshape(n, channels))
+    elif kind == MSG_TIME:
+        return _TIME.unpack(payload)[0]
+    elif kind == MSG_PEAKS:
+        (n_tables,), offset = _COUNT.unpack_from(payload), _COUNT.size
+        tables = []
+        for i in range(n_tables):
+            (n,) = _COUNT.unpack_from(payload, offset)
+            offset += _COUNT.size
+            table = numpy.frombuffer(payload, _PEAK_WIRE_DTYPE, n, offset)
+            tables.append(table.astype(PEAK_DTYPE))
+            offset += n*_PEAK_WIRE_DTYPE.itemsize
+        return tables
+    elif kind == MSG_FINISHED:
+        return None
+    return json.loads(payload.decode())
+
+
+def read_frame(f):
+    """Read a frame from a binary file, returns (kind, payload) or None at
+    the end of the stream
+    """
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, size = HEADER.unpack(header)
+    payload = f.read(size)
+    if len(payload) < size:
+        return None
+    return kind, payload
+
+
+def parse_address(address):
+    """(host, port) from "host:port" or "port" """
+    host, sep, port = str(address).rpartition(':')
+    return (host or DAEMON_HOST), int(port)
+
+
+def is_loopback(host):
+    """True if every address host resolves to is a loopback address"""
+    try:
+        addresses = socket.getaddrinfo(host or None, None)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address[4][0].split('%')[0]).is_loopback
+               for address in addresses)
+
+
+class _Client:
+    """Connection to a client, frames are sent from its own thread"""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = "{}:{}".format(*address[:2])
+        self.queue = queue.Queue(CLIENT_QUEUE_FRAMES)
+        self.closed = False
+        self._sender = threading.Thread(target=self._send_frames, daemon=True)
+        self._sender.start()
+
+    def send(self, frame):
+        """Queue a frame, False if the client has fallen too far behind"""
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            return False
+        return True
+
+    def _send_frames(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                break
+        self.close()
+
+    def close(self):
+        if self.closed == True:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        # Wake the sender, which otherwise fails on the closed socket
+        self.send(None)
+
+
+# Publisher queue item adding a client
+_ADD = object()
+
+
+class Publisher:
+    """Publisher
+    Fans messages out to the connected clients from its own thread.
+    """
+    def __init__(self):
+        self.clients = []
+        # Clients disconnected for falling behind
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, client, first=None):
+        """Add a client from the publisher thread, in order with the
+        messages published so far
+        first : callable returning the (kind, value) message sent to the
+                client before any other, e.g., the current status
+        """
+        self._queue.put((_ADD, (client, first)))
+
+    def remove(self, client):
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def publish(self, kind, value=None):
+        """Queue a message for every client, never blocks"""
+        self._queue.put((kind, value))
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            if message[0] is _ADD:
+                client, first = message[1]
+                if client.closed == True:
+                    continue
+                if first is not None:
+                    client.send(encode(*first()))
+                with self._lock:
+                    self.clients.append(client)
+                continue
+            frame = encode(*message)
+            with self._lock:
+                clients = list(self.clients)
+            for client in clients:
+                if client.send(frame) == False:
+                    print("!! WARN: Client {} fell behind, disconnecting".format(
+                        client.address))
+                    self.dropped += 1
+                    self.remove(client)
+                    client.close()
+
+    def close(self):
+        """Send the queued messages and disconnect the clients"""
+        self._queue.put(None)
+        self._thread.join()
+        with self._lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.send(None)
+
+
+class DaemonChromatographer(cg.Chromatographer):
+    """DaemonChromatographer
+    Publishes what the commandline version prints.
+    """
+    publisher = None
+
+    def send_time_remaining(self, t):
+        self.publisher.publish(MSG_TIME, t)
+
+    def send_data_ready(self, x, y):
+        self.publisher.publish(MSG_DATA, (x, y))
+
+    def send_peaks(self, peaks):
+        self.publisher.publish(MSG_PEAKS, peaks)
+
+    def send_finished(self):
+        self.publisher.publish(MSG_FINISHED)
+        if self.print_stats == True:
+            print(self.telemetry.summary())
+
+
+class Daemon:
+    """Daemon
+    Serves the acquisition of a DaemonChromatographer to clients on a
+    socket and runs the commands they send.
+    """
+    def __init__(self, worker, host=DAEMON_HOST, port=DAEMON_PORT_DEFAULT):
+        self.worker = worker
+        self.publisher = Publisher()
+        worker.publisher = self.publisher
+        self.server = socket.create_server((host, port))
+        self.server.settimeout(ACCEPT_TIMEOUT)
+        self.address = self.server.getsockname()[:2]
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # Running as published, changed before the status is published
+        self._acquiring = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self):
+        """Status sent to the clients"""
+        worker = self.worker
+        return {'protocol'       : PROTOCOL_VERSION,
+                'running'        : self._acquiring,
+                'daq_id'         : worker.channels[0].split('/')[0],
+                'channels'       : list(worker.channels),
+                'cycle_time'     : worker.cycle_time,
+                'sample_window'  : worker.sample_t,
+                'sample_delta'   : worker.sample_dt,
+                'hardware_timed' : worker.hardware_timed,
+                'adaptive'       : worker.adaptive is not None,
+                'valve_program'  : worker.valve_program.name,
+                'valves'         : worker.valves.state,
+                'valve_report'   : worker.valves.report(),
+                'clients'        : len(self.publisher.clients)}
+
+    def start(self):
+        """Start the acquisition, unless it is running"""
+        with self._lock:
+            if self.running == True:
+                return
+            self._thread = threading.Thread(target=self._collect, daemon=True)
+            self._acquiring = True
+            self._thread.start()
+        self.publisher.publish(MSG_STATUS, self.status())
+
+    def _collect(self):
+        print("# Acquisition started")
+        try:
+            self.worker.collect_data()
+        except Exception as err:
+            print("!! WARN: Acquisition failed: {}".format(err))
+        finally:
+            print("# Acquisition stopped")
+            self._acquiring = False
+            self.publisher.publish(MSG_STATUS, self.status())
+
+    def stop(self):
+        """Stop the acquisition and wait for it to end"""
+        with self._lock:
+            if self.running == False:
+                return
+            self.worker.stop()
+            self._thread.join()
+
+    def change_valves(self, command, valves):
+        """Open or close valves, only while the acquisition is stopped"""
+        if self.running == True:
+            raise ValueError("Valves are run by the valve program during acquisition")
+        valves = parse_valves(valves)
+        if command == 'open_valve':
+            self.worker.open_valve(valves)
+        else:
+            self.worker.close_valve(valves)
+        self.publisher.publish(MSG_STATUS, self.status())
+
+    def handle(self, request):
+        """Run a command from a client, returns the reply"""
+        if not isinstance(request, dict):
+            return {'command' : None, 'ok' : False,
+                    'error' : "Command is not a JSON object"}
+        command = request.get('command')
+        reply = {'command' : command, 'ok' : True}
+        try:
+            if command == 'start':
+                self.start()
+            elif command == 'stop':
+                self.stop()
+            elif command in ('open_valve', 'close_valve'):
+                self.change_valves(command, request.get('valves'))
+            elif command == 'status':
+                reply['status'] = self.status()
+            else:
+                raise ValueError("Unknown command: {}".format(command))
+        except (ValueError, TypeError) as err:
+            reply.update(ok=False, error=str(err))
+        except Exception as err:
+            # e.g., a DAQ error, the client gets the error like any other
+            print("!! WARN: Command {} failed: {}".format(command, err))
+            reply.update(ok=False, error="{}: {}".format(type(err).__name__, err))
+        return reply
+
+    def _serve_client(self, client):
+        """Read and run the commands of a client until it disconnects"""
+        f = client.sock.makefile('rb')
+        try:
+            while True:
+                frame = read_frame(f)
+                if frame is None:
+                    break
+                kind, payload = frame
+                if kind != MSG_COMMAND:
+                    continue
+                try:
+                    reply = self.handle(decode(kind, payload))
+                except Exception as err:
+                    # A bad request is answered, the connection stays open
+                    reply = {'command' : None, 'ok' : False,
+                             'error' : "{}: {}".format(type(err).__name__, err)}
+                client.send(encode(MSG_REPLY, reply))
+        except (OSError, ValueError) as err:
+            print("!! WARN: Client {}: {}".format(client.address, err))
+        finally:
+            self.publisher.remove(client)
+            client.close()
+            print("# Client {} disconnected".format(client.address))
+
+    def serve_forever(self):
+        """Accept clients until closed"""
+        while self._closed.is_set() == False:
+            try:
+                sock, address = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock, address)
+            print("# Client {} connected".format(client.address))
+            # The status goes first, taken by the publisher so that no status
+            # change falls between it and the published messages
+            self.publisher.add(client,
+                               first=lambda: (MSG_STATUS, self.status()))
+            threading.Thread(target=self._serve_client, args=(client,),
+                             daemon=True).start()
+
+    def close(self):
+        """Stop the acquisition and disconnect the clients"""
+        self._closed.set()
+        self.stop()
+        self.server.close()
+        self.publisher.close()
+
+
+class DaemonClient:
+    """DaemonClient
+    Connection to a daemon. Messages are read with `read`, the first being
+    the status, and commands sent with `command`, their replies arriving as
+    MSG_REPLY messages.
+    """
+    def __init__(self, host=DAEMON_HOST, port=DAEMON_PORT_DEFAULT, timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._f = self.sock.makefile('rb')
+        self._lock = threading.Lock()
+
+    def read(self):
+        """Next message as (kind, value), None once disconnected"""
+        try:
+            frame = read_frame(self._f)
+        except (OSError, ValueError):
+            return None
+        if frame is None:
+            return None
+        return frame[0], decode(*frame)
+
+    def command(self, command, **kwargs):
+        """Send a command, e.g., command('open_valve', valves=VALVE_1)"""
+        with self._lock:
+            self.sock.sendall(encode(MSG_COMMAND, dict(command=command, **kwargs)))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="chromatographer.py daemon",
+                            description="Acquire without a user interface, "
+                                        "serving the data to clients")
+    cg.add_acquisition_arguments(parser)
+    parser.add_argument('--host', type=str, default=DAEMON_HOST,
+                        help="Address to listen on (default: local connections only)")
+    parser.add_argument('--allow-remote', action="store_true",
+                        help="Allow a --host other than a loopback address, "
+                             "clients are NOT authenticated")
+    parser.add_argument('--port', type=int, default=DAEMON_PORT_DEFAULT,
+                        help="Port to listen on")
+    parser.add_argument('--idle', action="store_true",
+                        help="Wait for a client to start the acquisition")
+    parser.add_argument('--stats', action="store_true",
+                        help="Print timing statistics after every cycle and at exit")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Write metrics in the Prometheus text format to this file")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=METRICS_INTERVAL_DEFAULT,
+                        help="Seconds between writes of the metrics file")
+    args = parser.parse_args(argv)
+    if is_loopback(args.host) == False:
+        if args.allow_remote == False:
+            parser.error("--host {} is not a loopback address, clients are not "
+                         "authenticated, add --allow-remote to listen on it "
+                         "anyway".format(args.host))
+        print("!! WARN: Listening on {}, anyone who can connect controls "
+              "the instrument".format(args.host))
+
+    worker = cg.create_worker(args, DaemonChromatographer)
+    worker.print_stats = args.stats
+    daemon = Daemon(worker, args.host, args.port)
+    print("# Serving on {}:{}".format(*daemon.address))
+    print("# Channels :", ", ".join(worker.channels))
+    print("# Valve program :", worker.valve_program)
+    exporter = None
+    if args.metrics_file is not None:
+        exporter = MetricsExporter(worker.telemetry, args.metrics_file,
+                                   args.metrics_interval)
+    if args.idle == False:
+        daemon.start()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        print("# Stopped")
+    finally:
+        daemon.close()
+        if exporter is not None:
+            exporter.stop()
+        if args.stats == True:
+            print(worker.telemetry.summary())
+            print(worker.valves.report())
+        worker.close_tasks()
+    return 0
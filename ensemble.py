@@ -0,0 +1,143 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+===========
+ensemble.py
+===========
+
+Ensemble averaging of the cycles of a run.
+
+Every cycle of a run samples the same grid of times, so sample i of each
+cycle measures the same point of the chromatogram. Averaging the cycles
+point by point improves the signal to noise ratio by the square root of the
+number of cycles. The running mean and variance at each point are updated
+with Welford's algorithm as each cycle ends, alongside an exponentially
+weighted moving average (EWMA) following slow drifts of the baseline, so the
+statistics of any number of cycles are kept in memory for a single cycle.
+"""
+
+import numpy
+
+# Weight of the latest cycle in the EWMA baseline
+EWMA_ALPHA_DEFAULT = 0.1
+# Half width of the confidence band of the mean in standard errors (95%)
+BAND_Z_DEFAULT = 1.96
+
+
+class Ensemble:
+    """Ensemble
+    Running mean, variance and EWMA baseline across cycles at each point of
+    a grid of up to `points` samples, values may have one column per channel.
+
+    Cycles are aligned by sample index. Samples beyond `points` are ignored
+    and points not reached by a short (e.g., stopped) cycle keep the
+    statistics of the cycles that did reach them.
+    """
+    def __init__(self, points, channels=1, alpha=EWMA_ALPHA_DEFAULT):
+        self.points = int(points)
+        self.channels = int(channels)
+        self.alpha = alpha
+        shape = (self.points,) if self.channels == 1 else (self.points, self.channels)
+        self._t = numpy.zeros(self.points)
+        self._count = numpy.zeros(self.points)
+        self._mean = numpy.zeros(shape)
+        self._m2 = numpy.zeros(shape)
+        self._baseline = numpy.zeros(shape)
+        # Number of cycles added
+        self.cycles = 0
+        # Points reached by any cycle
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reset(self):
+        for array in (self._count, self._mean, self._m2, self._baseline):
+            array[:] = 0
+        self.cycles = 0
+        self.size = 0
+
+    def update(self, t, y):
+        """Add a cycle of sample times t and values y"""
+        n = min(len(t), self.points)
+        if n == 0:
+            return
+        y = numpy.asarray(y)[:n]
+        count = self._count[:n]
+        count += 1
+        if self.channels > 1:
+            count = count[:, None]
+        mean = self._mean[:n]
+        # Welford: the deviation from the old and the new mean
+        delta = y - mean
+        mean += delta/count
+        self._m2[:n] += delta*(y - mean)
+        # Points reached for the first time start the baseline at the sample
+        baseline = self._baseline[:n]
+        baseline += numpy.where(count == 1, y - baseline, self.alpha*(y - baseline))
+        if n > self.size:
+            self._t[self.size:n] = t[self.size:n]
+            self.size = n
+        self.cycles += 1
+
+    @property
+    def t(self):
+        return self._t[:self.size]
+
+    @property
+    def count(self):
+        """Cycles averaged at each point"""
+        return self._count[:self.size]
+
+    @property
+    def mean(self):
+        return self._mean[:self.size]
+
+    @property
+    def baseline(self):
+        return self._baseline[:self.size]
+
+    @property
+    def variance(self):
+        """Sample variance at each point, NaN before two cycles"""
+        count = self.count if self.channels == 1 else self.count[:, None]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(count > 1, self._m2[:self.size]/(count - 1), numpy.nan)
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.variance)
+
+    def band(self, z=BAND_Z_DEFAULT):
+        """Confidence band (lower, upper) of the mean, z standard errors wide"""
+        count = self.count if self.channels == 1 else self.count[:, None]
+        half = z*self.std/numpy.sqrt(numpy.maximum(count, 1))
+        return self.mean - half, self.mean + half
+
+    def columns(self, labels=None):
+        """Column header of table for the named channels"""
+        if labels is None or len(labels) == 1:
+            return "time (s), n, mean (V), std (V), baseline (V)"
+        names = ["{} {} (V)".format(stat, label)
+                 for stat in ("mean", "std", "baseline") for label in labels]
+        return "time (s), n, " + ", ".join(names)
+
+    def table(self):
+        """Statistics as one row per point: time, n, mean, std and baseline
+        with one column per channel each
+        """
+        return numpy.column_stack((self.t, self.count, self.mean, self.std,
+                                   self.baseline))
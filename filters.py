@@ -0,0 +1,257 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+==========
+filters.py
+==========
+
+Decimating filters reducing raw DAQ samples to measurement points.
+
+Every filter processes blocks of samples as they arrive from the DAQ and
+keeps its state between blocks, so the output is the same no matter how the
+samples are split into blocks. Filters are chained to decimate in stages and
+are described on the commandline as a comma separated list, e.g.,
+
+    boxcar:10          mean of every 10 samples (the original behaviour)
+    median:5,boxcar:20 reject spikes, then average
+    cic:16:3,fir:4     3rd order CIC by 16, then a 4x decimating FIR
+
+Samples are filtered along the last axis, so a (channels, n) block of a
+multi-channel read is filtered for all channels at once.
+"""
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class Filter:
+    """Filter
+    A decimating filter, `process` returns one output per `decimation`
+    input samples.
+
+    `delay` is the delay in input samples of an output relative to the last
+    input sample of its group, used to timestamp the output.
+
+    `support` is the number of input samples an output depends on, so an
+    output is free of the start up state once that many samples were seen.
+    """
+    decimation = 1
+    delay = 0.0
+
+    @property
+    def support(self):
+        return self.decimation
+
+    def reset(self):
+        """Forget the filter state, e.g., between sample windows"""
+        pass
+
+    def process(self, x):
+        """Filter and decimate a block of samples"""
+        raise NotImplementedError
+
+    def sample_index(self, k):
+        """Input sample index (may be fractional) represented by output k"""
+        return k*self.decimation + (self.decimation - 1) - self.delay
+
+
+class Boxcar(Filter):
+    """Boxcar
+    Mean of each group of n samples.
+    """
+    def __init__(self, n):
+        self.decimation = int(n)
+        self.delay = (self.decimation - 1)/2
+        self.reset()
+
+    def reset(self):
+        self._rest = None
+
+    def _groups(self, x):
+        """Split the pending and new samples into full groups of n"""
+        x = numpy.asarray(x, dtype=float)
+        if self._rest is not None:
+            x = numpy.concatenate((self._rest, x), axis=-1)
+        n_groups = x.shape[-1]//self.decimation
+        self._rest = x[..., n_groups*self.decimation:]
+        x = x[..., :n_groups*self.decimation]
+        return x.reshape(x.shape[:-1] + (n_groups, self.decimation))
+
+    def process(self, x):
+        return self._groups(x).mean(axis=-1)
+
+
+class Median(Boxcar):
+    """Median
+    Median of each group of n samples, rejects spikes.
+    """
+    def process(self, x):
+        return numpy.median(self._groups(x), axis=-1)
+
+
+class _PhasedFilter(Filter):
+    """Filters computed at the input rate and decimated afterwards"""
+    def reset(self):
+        self._history = None
+        # Samples seen, modulo decimation
+        self._phase = 0
+
+    def _extend(self, x, n_history):
+        """Prepend the last n_history samples of the previous block"""
+        if self._history is None:
+            # Start as if the first sample had always been present
+            self._history = numpy.repeat(x[..., :1], n_history, axis=-1)
+        x_ext = numpy.concatenate((self._history, x), axis=-1)
+        self._history = x_ext[..., x_ext.shape[-1] - n_history:]
+        return x_ext
+
+    def _kept(self, n):
+        """Indices of the outputs kept from a block of n samples"""
+        start = (self.decimation - 1 - self._phase) % self.decimation
+        self._phase = (self._phase + n) % self.decimation
+        return numpy.arange(start, n, self.decimation)
+
+
+class CIC(_PhasedFilter):
+    """CIC
+    Cascaded integrator comb decimator of the given order. Implemented as
+    cascaded moving sums, which has the same response without the integrator
+    growing without bound over long acquisitions.
+    """
+    def __init__(self, decimation, order=3):
+        self.decimation = int(decimation)
+        self.order = int(order)
+        self.delay = self.order*(self.decimation - 1)/2
+        self.gain = float(self.decimation)**self.order
+        self.reset()
+
+    @property
+    def support(self):
+        return self.order*(self.decimation - 1) + 1
+
+    def reset(self):
+        super().reset()
+        self._stages = [None]*self.order
+
+    def process(self, x):
+        x = numpy.asarray(x, dtype=float)
+        n = x.shape[-1]
+        if n == 0:
+            return x
+        D = self.decimation
+        y = x
+        for i in range(self.order):
+            if self._stages[i] is None:
+                self._stages[i] = numpy.repeat(y[..., :1], D - 1, axis=-1)
+            y_ext = numpy.concatenate((self._stages[i], y), axis=-1)
+            self._stages[i] = y_ext[..., y_ext.shape[-1] - (D - 1):]
+            c = numpy.cumsum(y_ext, axis=-1)
+            c = numpy.concatenate((numpy.zeros_like(c[..., :1]), c), axis=-1)
+            y = c[..., D:] - c[..., :-D]
+        return y[..., self._kept(n)]/self.gain
+
+
+def lowpass_taps(numtaps, cutoff):
+    """Windowed sinc low pass FIR taps
+    cutoff : cutoff frequency as a fraction of the sample rate (0-0.5)
+    """
+    n = numpy.arange(numtaps) - (numtaps - 1)/2
+    taps = 2*cutoff*numpy.sinc(2*cutoff*n)*numpy.hamming(numtaps)
+    return taps/taps.sum()
+
+
+class FIRDecimator(_PhasedFilter):
+    """FIRDecimator
+    Low pass FIR filter followed by decimation, only the outputs kept after
+    decimation are computed.
+    """
+    def __init__(self, decimation, taps=None, numtaps=None):
+        self.decimation = int(decimation)
+        if taps is None:
+            if numtaps is None:
+                numtaps = 8*self.decimation + 1
+            # Cut off a little below the decimated Nyquist frequency
+            taps = lowpass_taps(numtaps, 0.4/self.decimation)
+        self.taps = numpy.asarray(taps, dtype=float)
+        self.delay = (len(self.taps) - 1)/2
+        self.reset()
+
+    @property
+    def support(self):
+        return len(self.taps)
+
+    def process(self, x):
+        x = numpy.asarray(x, dtype=float)
+        if x.shape[-1] == 0:
+            return x
+        x_ext = self._extend(x, len(self.taps) - 1)
+        windows = sliding_window_view(x_ext, len(self.taps), axis=-1)
+        return windows[..., self._kept(x.shape[-1]), :] @ self.taps[::-1]
+
+
+class FilterChain(Filter):
+    """FilterChain
+    Filters applied one after the other, decimating in stages.
+    """
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.decimation = 1
+        for stage in self.stages:
+            self.decimation *= stage.decimation
+
+    @property
+    def support(self):
+        # Each output of a stage spans the decimation of the stages before
+        support, decimation = 1, 1
+        for stage in self.stages:
+            support += (stage.support - 1)*decimation
+            decimation *= stage.decimation
+        return support
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, x):
+        for stage in self.stages:
+            x = stage.process(x)
+        return x
+
+    def sample_index(self, k):
+        for stage in reversed(self.stages):
+            k = stage.sample_index(k)
+        return k
+
+
+FILTERS = {
+    'boxcar' : Boxcar,
+    'median' : Median,
+    'cic'    : CIC,
+    'fir'    : FIRDecimator,
+}
+
+
+def parse_filter(spec):
+    """Create a FilterChain from a spec such as "cic:16:3,fir:4" """
+    stages = []
+    for stage in spec.split(','):
+        name, *params = stage.strip().split(':')
+        try:
+            stage_class = FILTERS[name.lower()]
+        except KeyError:
+            raise ValueError("Unknown filter: {}".format(name))
+        stages.append(stage_class(*[int(p) for p in params]))
+    return FilterChain(stages)
@@ -0,0 +1,138 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+======
+lod.py
+======
+
+Level of detail for plotting long traces.
+
+A trace with more points than there are pixels across the plot is drawn as
+its min/max envelope: the minimum and maximum of the samples falling in each
+pixel, which looks the same as drawing every sample but costs two vertices
+per pixel. The envelopes are precomputed in a pyramid of levels, each level
+holding the minimum and maximum of `factor` entries of the level below, so
+the envelope of any time range is read from the level closest to the screen
+resolution instead of scanning the samples.
+"""
+
+from buffers import CycleBuffer
+import numpy
+
+# Entries of a level combined into one entry of the level above
+LOD_FACTOR = 4
+
+
+class MinMaxPyramid:
+    """MinMaxPyramid
+    Min/max envelopes of a growing (time, value) trace at decreasing
+    resolutions, for plotting.
+
+    The trace is not copied, `update` is given views of the whole trace so
+    far (e.g., CycleBuffer.t and .y) and only the new samples are added to
+    the levels. Values may have one column per channel.
+    """
+    def __init__(self, factor=LOD_FACTOR):
+        self.factor = int(factor)
+        self.t = numpy.empty(0)
+        self.y = numpy.empty(0)
+        # Level k + 1 as (lo, hi) CycleBuffers of the bucket minima at the
+        # bucket start times and of the maxima at the bucket end times
+        self.levels = []
+
+    def __len__(self):
+        return len(self.t)
+
+    def _arrays(self, k):
+        """(t_lo, lo, t_hi, hi) of level k, level 0 being the samples"""
+        if k == 0:
+            return self.t, self.y, self.t, self.y
+        lo, hi = self.levels[k - 1]
+        return lo.t, lo.y, hi.t, hi.y
+
+    def update(self, t, y):
+        """Set the trace to t, y, which extend the previous trace"""
+        self.t, self.y = numpy.asarray(t), numpy.asarray(y)
+        channels = 1 if self.y.ndim == 1 else self.y.shape[1]
+        f = self.factor
+        k = 0
+        while True:
+            t_lo, lo, t_hi, hi = self._arrays(k)
+            if k == len(self.levels):
+                if len(t_lo) < 2*f:
+                    break
+                self.levels.append((CycleBuffer(len(t_lo)//f, channels),
+                                    CycleBuffer(len(t_lo)//f, channels)))
+            lo_next, hi_next = self.levels[k]
+            start = len(lo_next)*f
+            end = len(t_lo)//f*f
+            if end > start:
+                shape = (-1, f) + lo.shape[1:]
+                lo_next.extend(t_lo[start:end:f],
+                               lo[start:end].reshape(shape).min(axis=1))
+                hi_next.extend(t_hi[start + f - 1:end:f],
+                               hi[start:end].reshape(shape).max(axis=1))
+            k += 1
+
+    def detach(self):
+        """Copy the samples, e.g., before the buffer they view is reused"""
+        self.t, self.y = self.t.copy(), self.y.copy()
+
+    @staticmethod
+    def _range(t, tmin, tmax):
+        """Index range of t from tmin to tmax, with one entry either side"""
+        i0 = max(int(numpy.searchsorted(t, tmin, 'right')) - 1, 0)
+        i1 = min(int(numpy.searchsorted(t, tmax, 'right')) + 1, len(t))
+        return i0, i1
+
+    def _interleave(self, k, i0, i1):
+        """Alternating minima and maxima of entries i0 to i1 of level k"""
+        t_lo, lo, t_hi, hi = self._arrays(k)
+        t = numpy.stack((t_lo[i0:i1], t_hi[i0:i1]), axis=1).reshape(-1)
+        y = numpy.stack((lo[i0:i1], hi[i0:i1]), axis=1)
+        return t, y.reshape((-1,) + lo.shape[1:])
+
+    def envelope(self, tmin, tmax, width):
+        """Points drawing the trace from tmin to tmax across width pixels
+
+        Returns (t, y, level), level 0 being the samples themselves, which
+        are returned when there are fewer than two per pixel. Otherwise the
+        envelope is taken from the finest level with at most one entry per
+        pixel, completed by the finer levels past its last full bucket.
+        """
+        width = max(1, int(width))
+        i0, i1 = self._range(self.t, tmin, tmax)
+        if i1 - i0 <= 2*width or len(self.levels) == 0:
+            return self.t[i0:i1], self.y[i0:i1], 0
+        for k in range(1, len(self.levels) + 1):
+            i0, i1 = self._range(self.levels[k - 1][0].t, tmin, tmax)
+            if i1 - i0 <= width:
+                break
+        pieces = [self._interleave(k, i0, i1)]
+        if i1 == len(self.levels[k - 1][0]):
+            # The samples after the last full bucket of level k
+            for j in range(k - 1, -1, -1):
+                start = len(self.levels[j][0])*self.factor
+                pieces.append(self._interleave(j, start, len(self._arrays(j)[0])))
+        return (numpy.concatenate([t for t, y in pieces]),
+                numpy.concatenate([y for t, y in pieces]), k)
+
+    def limits(self):
+        """Minimum and maximum value of the trace, None if empty"""
+        if len(self.t) == 0:
+            return None
+        t, y, level = self.envelope(-numpy.inf, numpy.inf, 1)
+        return numpy.min(y), numpy.max(y)
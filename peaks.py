@@ -0,0 +1,267 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+========
+peaks.py
+========
+
+Peak detection and integration of chromatograms.
+
+Peaks are found from the smoothed slope of the signal: a peak starts when the
+slope rises above the threshold, passes its apex when the slope falls below
+the negative threshold and ends once the signal flattens out again. The
+threshold is a multiple of the slope noise estimated from the start of the
+cycle. The smoothing, hold and baseline settings are in seconds and
+converted to samples from the sample interval, so the detection does not
+depend on the sample rate. Areas are integrated above a straight baseline
+drawn between the start and end of each peak, which follows slow baseline
+drift.
+
+PeakDetector.update only processes the samples added since the previous call,
+so it can be run on the cycle buffer while the cycle is being recorded.
+"""
+
+import numpy
+
+# One row per peak in the table returned by PeakDetector.finish
+PEAK_DTYPE = numpy.dtype([('retention_time', 'f8'),
+                          ('start', 'f8'),
+                          ('end', 'f8'),
+                          ('height', 'f8'),
+                          ('area', 'f8'),
+                          ('width', 'f8')])
+
+# Detector states
+BASELINE, RISING, FALLING = 0, 1, 2
+
+
+def integrate_peak(t, y, start, end):
+    """Integrate a peak between sample indices start and end (inclusive)
+
+    Returns a PEAK_DTYPE record, the baseline is the line joining the signal
+    at start and end.
+    """
+    ts, ys = t[start:end + 1], y[start:end + 1]
+    slope = (ys[-1] - ys[0])/(ts[-1] - ts[0]) if end > start else 0.0
+    above = ys - (ys[0] + slope*(ts - ts[0]))
+    apex = int(numpy.argmax(above))
+    rt = ts[apex]
+    if 0 < apex < len(ts) - 1:
+        # Parabolic interpolation of the apex between samples
+        a, b, c = above[apex - 1:apex + 2]
+        denom = a - 2*b + c
+        if denom != 0:
+            rt += 0.5*(a - c)/denom*(ts[apex + 1] - ts[apex - 1])/2
+    # Trapezoidal integration above the baseline
+    area = numpy.sum((above[1:] + above[:-1])*numpy.diff(ts))/2
+    return numpy.array((rt, ts[0], ts[-1], above[apex], area, ts[-1] - ts[0]),
+                       dtype=PEAK_DTYPE)
+
+
+# Fewest slopes the noise is estimated from, whatever the baseline time
+MIN_BASELINE_POINTS = 8
+# Slopes further than this many deviations from the median are left out of
+# the noise estimate, repeated a few times
+NOISE_CLIP = 3.0
+NOISE_ITERATIONS = 3
+
+
+def slope_noise(slopes):
+    """Robust standard deviation of the slopes at the start of a cycle, one
+    per column of a 2D array
+
+    The median absolute deviation ignores the slopes of a peak taking less
+    than half the slopes, but is still inflated by them, so it is repeated
+    without the slopes more than NOISE_CLIP deviations from the median.
+    """
+    slopes = numpy.asarray(slopes, dtype=float)
+    columns = slopes.reshape(len(slopes), -1).T
+    noise = numpy.empty(len(columns))
+    for i, column in enumerate(columns):
+        for iteration in range(NOISE_ITERATIONS):
+            deviation = numpy.abs(column - numpy.median(column))
+            noise[i] = 1.4826*numpy.median(deviation)
+            kept = column[deviation <= NOISE_CLIP*noise[i]]
+            if len(kept) == len(column) or len(kept) < MIN_BASELINE_POINTS:
+                break
+            column = kept
+    return noise if slopes.ndim > 1 else noise[0]
+
+
+class PeakDetector:
+    """PeakDetector
+    Incremental slope based peak detector.
+
+    threshold    : slope threshold as a multiple of the slope noise
+    smooth       : seconds averaged either side of a point for its slope
+    hold         : seconds a slope condition must hold to change state
+    min_width    : peaks narrower than this (s) are discarded
+    baseline     : seconds at the start of the cycle used for the noise
+    sample_delta : sample interval (s), by default the median interval of
+                   the first samples of each cycle
+
+    Each setting is at least one sample (min_width two), so at coarse sample
+    intervals the detection is only as fine as the samples allow.
+    """
+    def __init__(self, threshold=8.0, smooth=0.05, hold=0.05, min_width=0.1,
+                 baseline=2.0, sample_delta=None):
+        self.threshold = threshold
+        self.smooth = smooth
+        self.hold = hold
+        self.min_width = min_width
+        self.baseline = baseline
+        self.sample_delta = sample_delta
+        self._slope = numpy.empty(1024)
+        self._up = numpy.zeros(1024, dtype=bool)
+        self._down = numpy.zeros(1024, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        """Forget the current cycle"""
+        # Settings in samples, set from the sample interval of the cycle
+        self._h = self._hold = self._min_points = self._baseline = None
+        # Slopes are computed up to _next, compared with the threshold up to
+        # _marked and states are scanned up to _pos
+        self._next = self._marked = self._pos = 0
+        self.slope_threshold = None
+        self._state = BASELINE
+        self._start = 0
+        self.peaks = []
+
+    def _set_intervals(self, t):
+        """Convert the settings to samples"""
+        dt = self.sample_delta
+        if dt is None:
+            dt = numpy.median(numpy.diff(t[:MIN_BASELINE_POINTS + 1]))
+        self._h = max(1, int(round(self.smooth/dt)))
+        self._hold = max(1, int(round(self.hold/dt)))
+        self._min_points = max(2, int(numpy.ceil(self.min_width/dt)) + 1)
+        self._baseline = max(MIN_BASELINE_POINTS, int(round(self.baseline/dt)))
+        self._next = self._marked = self._pos = self._h
+
+    def _slope_range(self, t, y, i0, i1):
+        """Smoothed slope for the sample indices [i0, i1)"""
+        h = self._h
+        # Moving sums of h samples ending at each index from i0 - h to i1 + h
+        cy = numpy.concatenate(([0.0], numpy.cumsum(y[i0 - h:i1 + h])))
+        ct = numpy.concatenate(([0.0], numpy.cumsum(t[i0 - h:i1 + h])))
+        n = i1 - i0
+        # Mean of the h samples before and after each index
+        y_before = cy[h:h + n] - cy[:n]
+        y_after = cy[2*h + 1:2*h + 1 + n] - cy[h + 1:h + 1 + n]
+        t_before = ct[h:h + n] - ct[:n]
+        t_after = ct[2*h + 1:2*h + 1 + n] - ct[h + 1:h + 1 + n]
+        return (y_after - y_before)/(t_after - t_before)
+
+    def update(self, t, y):
+        """Process the samples added to the cycle since the last call
+        t, y : all samples of the cycle so far
+        """
+        if self._h is None:
+            if len(t) < MIN_BASELINE_POINTS + 1:
+                return
+            self._set_intervals(t)
+        i0, i1 = self._next, len(y) - self._h
+        if i1 <= i0:
+            return
+        if i1 > len(self._slope):
+            size = max(i1, 2*len(self._slope))
+            for name in ('_slope', '_up', '_down'):
+                array = getattr(self, name)
+                grown = numpy.zeros(size, dtype=array.dtype)
+                # The first slope may lie beyond the initial arrays
+                n = min(i0, len(array))
+                grown[:n] = array[:n]
+                setattr(self, name, grown)
+        self._slope[i0:i1] = self._slope_range(t, y, i0, i1)
+        self._next = i1
+
+        if self.slope_threshold is None:
+            # Estimate the slope noise from the start of the cycle
+            if i1 - self._h < self._baseline:
+                return
+            noise = slope_noise(self._slope[self._h:self._h + self._baseline])
+            self.slope_threshold = max(self.threshold*noise,
+                                       numpy.finfo(float).eps)
+        # Only the new slopes are compared with the threshold
+        m = self._marked
+        self._up[m:i1] = self._slope[m:i1] > self.slope_threshold
+        self._down[m:i1] = self._slope[m:i1] < -self.slope_threshold
+        self._marked = i1
+        self._scan(t, y, i1)
+
+    def _find_run(self, mask, i, n):
+        """Index of the first run of hold True values in mask[i:n]"""
+        window = mask[i:n].astype(int)
+        if len(window) < self._hold:
+            return None
+        counts = numpy.convolve(window, numpy.ones(self._hold, dtype=int), 'valid')
+        found = numpy.flatnonzero(counts == self._hold)
+        return i + found[0] if len(found) > 0 else None
+
+    def _scan(self, t, y, n):
+        """Run the detector states over the slopes up to index n"""
+        up, down = self._up, self._down
+        i = self._pos
+        while i < n:
+            if self._state == BASELINE:
+                found = self._find_run(up, i, n)
+                if found is None:
+                    break
+                i = found
+                self._start = i
+                self._state = RISING
+            elif self._state == RISING:
+                found = self._find_run(down, i, n)
+                if found is None:
+                    break
+                i = found
+                self._state = FALLING
+            else:
+                found = self._find_run(~down, i, n)
+                if found is None:
+                    break
+                i = found
+                self._end_peak(t, y, i)
+                if self._find_run(up, i, n) == i:
+                    # Unresolved peaks, the valley starts the next peak
+                    self._start = i
+                    self._state = RISING
+                else:
+                    self._state = BASELINE
+        # A run may still start in the last hold - 1 samples
+        self._pos = max(i, min(n, n - self._hold + 1))
+
+    def _end_peak(self, t, y, end):
+        if end - self._start + 1 >= self._min_points:
+            self.peaks.append(integrate_peak(t, y, self._start, end))
+
+    def finish(self, t, y):
+        """Process the remaining samples and return the peak table"""
+        self.update(t, y)
+        if self._state != BASELINE:
+            self._end_peak(t, y, len(y) - 1)
+        table = numpy.array(self.peaks, dtype=PEAK_DTYPE)
+        self.reset()
+        return table
+
+
+def format_peaks(peaks):
+    """Format a peak table as text lines"""
+    lines = ["# rt (s), start (s), end (s), height (V), area (V s), width (s)"]
+    for peak in peaks:
+        lines.append("{:.4f},{:.4f},{:.4f},{:.6g},{:.6g},{:.4f}".format(*peak))
+    return "\n".join(lines)
@@ -0,0 +1,233 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+=========
+replay.py
+=========
+
+Replay of recorded output files through the acquisition hooks, run as
+
+    python chromatographer.py replay [options] output.csv
+
+The cycles of the file are fed to a Chromatographer as if they were being
+acquired: the points go into its cycle and peak detectors and out through
+send_points, followed by send_peaks and send_finished, with
+send_time_remaining counting down between cycles. Playback is in real time,
+faster or slower by a speed factor, or as fast as possible. The file is
+streamed (see storage.iter_output_file), so its size is not limited by
+memory.
+"""
+
+from adaptive import add_adaptive_arguments, create_gate
+from backends import open_devices
+import chromatographer as cg
+import numpy
+from scheduler import Cancelled
+import storage
+import time
+
+# Shortest interval (s) between sends of points at a finite speed
+REPLAY_MIN_INTERVAL = 0.001
+
+
+class Replay:
+    """Replay
+    Plays a recorded output file through the hooks of a worker.
+
+    speed : playback speed relative to the recording, e.g., 100 for 100x,
+            None for as fast as possible
+    """
+    def __init__(self, path, speed=1.0, block_size=storage.READ_BLOCK_SIZE):
+        self.path = path
+        self.speed = speed
+        self.block_size = block_size
+        # Metadata of the first run, configuring the worker. Settings
+        # missing from it, e.g., in a file without a header, are inferred from
+        # the first cycle
+        self.metadata = {}
+        for run, metadata, cycle_id, t, y in storage.iter_cycles(path, block_size):
+            self.metadata = dict(metadata)
+            self._infer_settings(t)
+            break
+        else:
+            raise ValueError("No recorded points in {path}".format(path=path))
+        self._period = None
+        self._first_cycle = True
+        self._t_window = None
+        self._t_sent = None
+
+    def _infer_settings(self, t):
+        """Sample interval and window from the times t of the first cycle,
+        where the header does not give them
+        """
+        delta = self.metadata.get('sample_delta') or 0
+        if delta <= 0 and len(t) > 1:
+            delta = float(numpy.median(numpy.diff(t)))
+        if delta <= 0:
+            raise ValueError("No sample interval in {path} and too few "
+                             "points to infer it".format(path=self.path))
+        self.metadata['sample_delta'] = delta
+        window = self.metadata.get('sample_window') or 0
+        if window <= delta:
+            self.metadata['sample_window'] = max(float(t[-1]), delta) + delta
+
+    @property
+    def channels(self):
+        """Channels of the first run, None for a single unnamed channel"""
+        return self.metadata.get('channels')
+
+    def create_worker(self, worker_class=None, **kwargs):
+        """Worker configured as the first run was recorded
+
+        The worker needs a device, a simulated one stands in for the DAQ,
+        which is never read or written while replaying.
+        """
+        if worker_class is None:
+            worker_class = cg.Chromatographer
+        channels = self.channels or ["Replay/ai1"]
+        backend = open_devices('simulated', channels)
+        return worker_class(channels[0].split('/')[0],
+                            self.metadata.get('cycle_time', 0),
+                            self.metadata.get('sample_window', 0),
+                            self.metadata.get('sample_delta', 0),
+                            backend=backend, channels=channels, **kwargs)
+
+    def run(self, worker):
+        """Play the file through worker until the end or worker.stop()"""
+        scheduler = worker.scheduler
+        cycle_id = None
+        run = None
+        try:
+            for metadata, data in storage.iter_output_file(self.path, self.block_size):
+                if metadata is not run:
+                    if cycle_id is not None:
+                        self._finish(worker)
+                        cycle_id = None
+                    run = metadata
+                    n_channels = data.shape[1] - 2
+                    if n_channels != len(worker.channels):
+                        print("!! WARN: Skipping a run of {n} channel(s)".format(n=n_channels))
+                    else:
+                        self._start_run(worker, metadata)
+                if data.shape[1] - 2 != len(worker.channels):
+                    continue
+                signals = 2 if data.shape[1] == 3 else slice(2, None)
+                bounds = numpy.flatnonzero(numpy.diff(data[:, 0])) + 1
+                for chunk in numpy.split(data, bounds):
+                    if chunk[0, 0] != cycle_id:
+                        if cycle_id is not None:
+                            self._finish(worker)
+                        cycle_id = chunk[0, 0]
+                        self._start_cycle(worker)
+                    self._play(worker, chunk[:, 1], chunk[:, signals])
+            if cycle_id is not None:
+                self._finish(worker)
+        except Cancelled:
+            pass
+        finally:
+            worker.stop_requested = False
+            scheduler.reset()
+
+    def _start_run(self, worker, metadata):
+        """Start cycles cycle_time apart, as they were recorded"""
+        cycle_time = metadata.get('cycle_time') or 0
+        self._period = None
+        self._first_cycle = True
+        if self.speed is not None and cycle_time > 0:
+            self._period = cycle_time/self.speed
+            worker.scheduler.period = self._period
+
+    def _start_cycle(self, worker):
+        if self._period is not None and self._first_cycle == True:
+            # The first cycle of a run starts at once, the next one a period later
+            worker.scheduler.start()
+        elif self._period is not None:
+            speed = self.speed
+            if worker.scheduler.wait_for_cycle(
+                    lambda t: worker.update_time_remaining(t*speed)) == False:
+                raise Cancelled()
+        worker.scheduler.check()
+        worker.reset_cycle()
+        self._first_cycle = False
+        self._t_window = time.monotonic()
+        self._t_sent = None
+
+    def _play(self, worker, t, y):
+        """Send the points when they were recorded relative to the window"""
+        if self.speed is None:
+            worker.scheduler.check()
+            self._send(worker, t, y)
+            return
+        i = 0
+        while i < len(t):
+            deadline = self._t_window + t[i]/self.speed
+            if self._t_sent is not None:
+                deadline = max(deadline, self._t_sent + REPLAY_MIN_INTERVAL)
+            if worker.scheduler.wait_until(deadline) == False:
+                raise Cancelled()
+            self._t_sent = time.monotonic()
+            # Every point due by now
+            j = max(i + 1, int(numpy.searchsorted(
+                t, (self._t_sent - self._t_window)*self.speed, 'right')))
+            self._send(worker, t[i:j], y[i:j])
+            i = j
+
+    def _send(self, worker, t, y):
+        worker.cycle.extend(t, y)
+        worker.update_peaks()
+        worker.send_points(t, y)
+
+    def _finish(self, worker):
+        worker.finish_points()
+        worker.send_peaks([detector.finish(worker.cycle.t, worker.cycle.channel(i))
+                           for i, detector in enumerate(worker.peak_detectors)])
+        worker.send_finished()
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="chromatographer.py replay",
+                            description="Replay a recorded output file")
+    parser.add_argument('path', help="Output file to replay")
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help="Playback speed relative to the recording, "
+                             "0 for as fast as possible")
+    parser.add_argument('--stats', action="store_true",
+                        help="Print timing statistics after every cycle and at exit")
+    add_adaptive_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        replay = Replay(args.path, speed=args.speed or None)
+    except ValueError as err:
+        print("!! WARN: {err}".format(err=err))
+        return 1
+    worker = replay.create_worker(adaptive=create_gate(args))
+    worker.print_stats = args.stats
+    print("# Replaying :", args.path)
+    print("# Speed :", "maximum" if replay.speed is None else replay.speed)
+    print("# Channels :", ", ".join(worker.channels))
+    t_start = time.perf_counter()
+    try:
+        replay.run(worker)
+    except KeyboardInterrupt:
+        print("# Stopped")
+    print("# Replayed in {:.3f} s".format(time.perf_counter() - t_start))
+    if args.stats == True:
+        print(worker.telemetry.summary())
+    worker.close_tasks()
+    return 0
@@ -0,0 +1,116 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+============
+scheduler.py
+============
+
+Cycle scheduling for the Chromatographer.
+
+All waits are on deadlines of the monotonic clock, so time spent working
+between waits does not add up to drift, and are interruptible: a stop wakes
+every wait immediately. Cycles start on a fixed grid of cycle_time from the
+first start, when a cycle overruns the grid the missed starts are skipped.
+"""
+
+from math import ceil
+import threading
+import time
+
+
+class Cancelled(Exception):
+    """Raised to abandon a cycle once a stop has been requested"""
+    pass
+
+
+class Scheduler:
+    """Scheduler
+    Monotonic deadlines and interruptible waits for a periodic cycle.
+
+    period : seconds between cycle starts
+    """
+    def __init__(self, period):
+        self.period = period
+        self.next_start = None
+        # Cycle starts skipped because the previous cycle overran
+        self.missed = 0
+        self._stop = threading.Event()
+
+    @property
+    def cancel(self):
+        """Event set on stop, for blocking calls that accept one"""
+        return self._stop
+
+    @property
+    def stop_requested(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        """Request a stop, waking any wait"""
+        self._stop.set()
+
+    def reset(self):
+        """Clear a stop request"""
+        self._stop.clear()
+
+    def check(self):
+        """Raise Cancelled if a stop has been requested"""
+        if self._stop.is_set():
+            raise Cancelled()
+
+    def wait_until(self, deadline):
+        """Wait until the monotonic deadline, False if stopped first"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return not self._stop.is_set()
+            if self._stop.wait(remaining):
+                return False
+
+    def wait(self, seconds):
+        """Wait for seconds, False if stopped first"""
+        return self.wait_until(time.monotonic() + seconds)
+
+    def start(self, delay=None):
+        """Set the first cycle start, one period from now by default"""
+        self.missed = 0
+        if delay is None:
+            delay = self.period
+        self.next_start = time.monotonic() + delay
+
+    def wait_for_cycle(self, callback=None, tick=1.0):
+        """Wait for the next cycle start, False if stopped first
+        callback : called with the seconds remaining every tick seconds
+        """
+        now = time.monotonic()
+        if self.next_start < now:
+            # The previous cycle overran, keep to the grid of cycle starts
+            missed = int((now - self.next_start)//self.period) + 1
+            self.next_start += missed*self.period
+            self.missed += missed
+            print("!! WARN: Cycle overran, skipped {n} cycle start(s)".format(n=missed))
+        deadline = self.next_start
+        while True:
+            remaining = deadline - time.monotonic()
+            if callback is not None:
+                callback(max(0.0, remaining))
+            if remaining <= 0:
+                break
+            # Wake on whole ticks before the deadline
+            if self.wait_until(deadline - (ceil(remaining/tick) - 1)*tick) == False:
+                return False
+        self.next_start = deadline + self.period
+        return not self._stop.is_set()
@@ -0,0 +1,505 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+=============
+similarity.py
+=============
+
+Similarity search over recorded cycles, run as
+
+    python chromatographer.py similar index [options] index_dir files_or_directories...
+    python chromatographer.py similar search [options] index_dir output.csv
+
+Every channel of every cycle is reduced to a fingerprint: the signal averaged
+over a fixed number of bins of a common time span, less its median baseline
+and scaled to unit length, so the dot product of two fingerprints is the
+cosine similarity of the chromatograms whatever their size, plus the
+retention times of its largest peaks. The fingerprints are appended to raw
+float32 files of an index directory, which are searched with a single matrix
+product for the closest shapes, the best candidates then being ranked with
+the agreement of their retention times.
+"""
+
+import json
+import numpy
+import os
+import time
+
+from adaptive import reconstruct
+from peaks import PeakDetector
+import storage
+
+INDEX_VERSION = 1
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.f32"
+PEAKS_FILE = "peaks.f32"
+ENTRIES_FILE = "entries.i32"
+
+# Bins of the fingerprint and retention times of the largest peaks kept
+FINGERPRINT_POINTS = 128
+FINGERPRINT_PEAKS = 8
+# Seconds between retention times counted as the same peak
+RETENTION_TOLERANCE_DEFAULT = 1.0
+# Weight of the retention times in the score, the rest is the shape
+RETENTION_WEIGHT_DEFAULT = 0.3
+# Closest shapes ranked by the full score, per match asked for
+CANDIDATES_PER_MATCH = 8
+MIN_CANDIDATES = 64
+
+# file, run, id and channel of each entry
+ENTRY_COLUMNS = 4
+MATCH_DTYPE = numpy.dtype([('score', 'f4'),
+                           ('shape', 'f4'),
+                           ('retention', 'f4'),
+                           ('file', 'i4'),
+                           ('run', 'i4'),
+                           ('id', 'i4'),
+                           ('channel', 'i4')])
+MATCH_COLUMNS = "score, shape, retention, file, run, id, channel"
+
+
+def fingerprint(t, y, span, points=FINGERPRINT_POINTS, peaks=FINGERPRINT_PEAKS,
+                detector=None):
+    """Fingerprint of one channel of a cycle as (vector, retention times)
+
+    The signal is averaged over `points` bins of [0, span] (holding the
+    first and last values outside the cycle) rather than sampled, so noise
+    and the sample rate do not change it. The retention times of the
+    `peaks` largest peaks by area are in time order, padded with NaN.
+    """
+    t = numpy.asarray(t, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    vector = numpy.zeros(points, dtype=numpy.float32)
+    times = numpy.full(peaks, numpy.nan, dtype=numpy.float32)
+    if len(t) < 2:
+        return vector, times
+    if detector is None:
+        detector = PeakDetector()
+    table = detector.finish(t, y)
+    if len(table) > 0:
+        largest = numpy.sort(table[numpy.argsort(table['area'])[::-1][:peaks]]
+                             ['retention_time'])
+        times[:len(largest)] = largest
+    # Mean of each bin from the running integral of the signal
+    if t[0] > 0:
+        t, y = numpy.concatenate(([0.0], t)), numpy.concatenate(([y[0]], y))
+    if t[-1] < span:
+        t, y = numpy.append(t, span), numpy.append(y, y[-1])
+    integral = numpy.concatenate(([0.0], numpy.cumsum(numpy.diff(t)*(y[1:] + y[:-1])/2)))
+    edges = numpy.linspace(0, span, points + 1)
+    means = numpy.diff(numpy.interp(edges, t, integral))/numpy.diff(edges)
+    means -= numpy.median(means)
+    norm = numpy.linalg.norm(means)
+    if norm > 0:
+        vector[:] = means/norm
+    return vector, times
+
+
+def dense(t, y, sample_delta):
+    """Points of a cycle on its sample grid, interpolated if the file was
+    recorded with adaptive sampling (see adaptive.py)
+    """
+    if not sample_delta or len(t) < 2:
+        return t, y
+    n = int(round((t[-1] - t[0])/sample_delta)) + 1
+    if len(t) >= n:
+        return t, y
+    grid = numpy.linspace(t[0], t[-1], n)
+    return grid, reconstruct(t, y, grid)
+
+
+def retention_agreement(query, candidates, tolerance=RETENTION_TOLERANCE_DEFAULT):
+    """Fraction of peaks in common between the retention times of a query
+    and of each row of candidates, NaN padded, 1 when neither has peaks
+    """
+    query = query[numpy.isfinite(query)]
+    n_candidates = numpy.sum(numpy.isfinite(candidates), axis=1)
+    n = numpy.maximum(len(query), n_candidates)
+    if len(query) == 0:
+        return numpy.where(n == 0, 1.0, 0.0)
+    # Query peaks within the tolerance of any peak of the candidate
+    near = numpy.abs(candidates[:, None, :] - query[None, :, None]) <= tolerance
+    common = numpy.sum(numpy.any(near, axis=2), axis=1)
+    with numpy.errstate(invalid='ignore'):
+        return numpy.where(n == 0, 1.0, numpy.minimum(common, n_candidates)/n)
+
+
+class SimilarityIndex:
+    """SimilarityIndex
+    Fingerprints of recorded cycles in an index directory.
+
+    The vectors, retention times and (file, run, id, channel) entries are
+    raw arrays appended to their own files, and index.json records their
+    settings, the indexed files and the number of complete entries, so an
+    interrupted indexing leaves the index as it was. The arrays are read
+    into memory by `load` and searched there.
+
+    points, peaks, span : fingerprint settings of a new index, span (s)
+                          defaulting to the sample window of the first file
+    """
+    def __init__(self, path, points=FINGERPRINT_POINTS, peaks=FINGERPRINT_PEAKS,
+                 span=None):
+        self.path = path
+        self.info = {'version' : INDEX_VERSION,
+                     'points'  : points,
+                     'peaks'   : peaks,
+                     'span'    : span,
+                     'count'   : 0,
+                     'files'   : []}
+        info_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                self.info = json.load(f)
+        self._vectors = None
+        self._peaks = None
+        self._entries = None
+        self._loaded = None
+
+    def __len__(self):
+        return self.info['count']
+
+    @property
+    def points(self):
+        return self.info['points']
+
+    @property
+    def peaks(self):
+        return self.info['peaks']
+
+    @property
+    def span(self):
+        return self.info['span']
+
+    @property
+    def files(self):
+        """Indexed files as [path, size, last (run, id)] in file number order"""
+        return self.info['files']
+
+    def file_number(self, path):
+        """Number of an indexed file, None if it is not indexed"""
+        path = os.path.abspath(path)
+        for number, (indexed, size, last) in enumerate(self.files):
+            if indexed == path:
+                return number
+        return None
+
+    def append(self, path, size, entries, vectors, peaks):
+        """Append the fingerprints of a file, entries being (run, id, channel)
+
+        The last cycle indexed before from the file may have been recorded
+        only in part then, its entries replace the fingerprints it had.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        number = self.file_number(path)
+        if number is None:
+            number = len(self.files)
+            self.files.append([os.path.abspath(path), 0, None])
+        last = self.files[number][2]
+        if last is not None and len(entries) > 0:
+            again = (entries[:, 0] == last[0]) & (entries[:, 1] == last[1])
+            self._replace(number, entries[again], vectors[again], peaks[again])
+            entries, vectors, peaks = entries[~again], vectors[~again], peaks[~again]
+        if len(entries) > 0:
+            rows = numpy.empty((len(entries), ENTRY_COLUMNS), dtype=numpy.int32)
+            rows[:, 0] = number
+            rows[:, 1:] = entries
+            count = len(self)
+            for name, array, width in ((VECTORS_FILE, vectors, self.points),
+                                       (PEAKS_FILE, peaks, self.peaks),
+                                       (ENTRIES_FILE, rows, ENTRY_COLUMNS)):
+                with open(os.path.join(self.path, name), 'ab') as f:
+                    # Drop whatever an interrupted append left past count
+                    f.truncate(count*width*4)
+                    f.write(numpy.ascontiguousarray(array).tobytes())
+            self.info['count'] = count + len(entries)
+            self.files[number][2] = [int(v) for v in entries[-1][:2]]
+        self.files[number][1] = size
+        self.save()
+
+    def _replace(self, number, entries, vectors, peaks):
+        """Overwrite the fingerprints of entries of file number in place"""
+        if len(entries) == 0:
+            return
+        count = len(self)
+        rows = numpy.fromfile(os.path.join(self.path, ENTRIES_FILE), dtype=numpy.int32,
+                              count=count*ENTRY_COLUMNS).reshape(count, ENTRY_COLUMNS)
+        for entry, vector, times in zip(entries, vectors, peaks):
+            found = numpy.flatnonzero((rows[:, 0] == number) &
+                                      (rows[:, 1:] == entry).all(axis=1))
+            if len(found) == 0:
+                continue
+            for name, array, width in ((VECTORS_FILE, vector, self.points),
+                                       (PEAKS_FILE, times, self.peaks)):
+                with open(os.path.join(self.path, name), 'r+b') as f:
+                    f.seek(int(found[-1])*width*4)
+                    f.write(numpy.ascontiguousarray(array, dtype=numpy.float32).tobytes())
+
+    def save(self):
+        """Write index.json, replacing the previous one at once"""
+        info_path = os.path.join(self.path, INDEX_FILE)
+        with open(info_path + ".tmp", 'w') as f:
+            json.dump(self.info, f)
+        os.replace(info_path + ".tmp", info_path)
+
+    def load(self):
+        """Read the arrays into memory, again if the index has grown"""
+        info_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(info_path):
+            mtime = os.path.getmtime(info_path)
+            if mtime == self._loaded:
+                return
+            with open(info_path) as f:
+                self.info = json.load(f)
+            self._loaded = mtime
+        count = len(self)
+
+        def read(name, width, dtype):
+            path = os.path.join(self.path, name)
+            if count == 0:
+                return numpy.empty((0, width), dtype=dtype)
+            return numpy.fromfile(path, dtype=dtype, count=count*width).reshape(count, width)
+
+        self._vectors = read(VECTORS_FILE, self.points, numpy.float32)
+        self._peaks = read(PEAKS_FILE, self.peaks, numpy.float32)
+        self._entries = read(ENTRIES_FILE, ENTRY_COLUMNS, numpy.int32)
+
+    def fingerprint(self, t, y, sample_delta=None):
+        """Fingerprint of one channel of a cycle with the index settings"""
+        t, y = dense(t, y, sample_delta)
+        return fingerprint(t, y, self.span, self.points, self.peaks)
+
+    def search(self, vectors, peaks, k=10, tolerance=RETENTION_TOLERANCE_DEFAULT,
+               weight=RETENTION_WEIGHT_DEFAULT, exclude=None):
+        """Best k matches of each query as MATCH_DTYPE arrays, best first
+
+        vectors, peaks : fingerprints of the queries, one row each
+        exclude        : (file, run, id, channel) entries left out of the
+                         results, e.g., the query itself
+        """
+        self.load()
+        vectors = numpy.atleast_2d(numpy.asarray(vectors, dtype=numpy.float32))
+        peaks = numpy.atleast_2d(peaks)
+        # Shape similarity of every query to every entry at once
+        shapes = vectors @ self._vectors.T
+        if exclude is not None:
+            excluded = numpy.all(self._entries == numpy.asarray(exclude), axis=1)
+            shapes[:, excluded] = -numpy.inf
+        n = min(len(self), max(k*CANDIDATES_PER_MATCH, MIN_CANDIDATES))
+        results = []
+        for shape, query in zip(shapes, peaks):
+            if n < len(self):
+                candidates = numpy.argpartition(shape, len(self) - n)[len(self) - n:]
+            else:
+                candidates = numpy.arange(len(self))
+            candidates = candidates[numpy.isfinite(shape[candidates])]
+            retention = retention_agreement(query, self._peaks[candidates], tolerance)
+            score = (1 - weight)*shape[candidates] + weight*retention
+            best = numpy.argsort(score)[::-1][:k]
+            matches = numpy.empty(len(best), dtype=MATCH_DTYPE)
+            matches['score'] = score[best]
+            matches['shape'] = shape[candidates[best]]
+            matches['retention'] = retention[best]
+            for i, name in enumerate(('file', 'run', 'id', 'channel')):
+                matches[name] = self._entries[candidates[best], i]
+            results.append(matches)
+        return results
+
+    def format_matches(self, matches):
+        """Matches as lines of text, one per match"""
+        return ["{:.4f}, {:.4f}, {:.2f}, {}, {}, {}, {}".format(
+                    m['score'], m['shape'], m['retention'],
+                    self.files[m['file']][0], m['run'], m['id'], m['channel'])
+                for m in matches]
+
+
+def index_file(path, span, points, peaks, after=None):
+    """Fingerprints of the cycles of an output file, run in the worker
+    processes
+
+    Cycles before `after` (run, id) were indexed before and are skipped,
+    `after` itself is fingerprinted again as rows may have been added to it
+    since. Returns (path, size, entries, vectors, peaks).
+    """
+    size = os.path.getsize(path)
+    entries, vectors, times = [], [], []
+    # Streamed, and runs numbered as in the batch output
+    for run_id, metadata, cycle_id, t, y in storage.iter_cycles(path):
+        if after is not None and (run_id, cycle_id) < tuple(after):
+            continue
+        # One column per channel
+        y = y.reshape(len(t), -1)
+        for channel in range(y.shape[1]):
+            tc, yc = dense(t, y[:, channel], metadata.get('sample_delta'))
+            vector, retention = fingerprint(tc, yc, span, points, peaks)
+            entries.append((run_id, cycle_id, channel))
+            vectors.append(vector)
+            times.append(retention)
+    return (path, size,
+            numpy.array(entries, dtype=numpy.int32).reshape(-1, 3),
+            numpy.array(vectors, dtype=numpy.float32).reshape(-1, points),
+            numpy.array(times, dtype=numpy.float32).reshape(-1, peaks))
+
+
+def main_index(args):
+    from batch import discover_files
+    from concurrent.futures import ProcessPoolExecutor
+
+    index = SimilarityIndex(args.index, points=args.points, peaks=args.peaks,
+                            span=args.span)
+    files = discover_files(args.paths, args.pattern)
+    if len(files) == 0:
+        print("!! WARN: No output files found")
+        return 1
+    if index.span is None:
+        for metadata, data in storage.iter_output_file(files[0]):
+            index.info['span'] = metadata.get('sample_window')
+            break
+        if not index.span:
+            print("!! WARN: No sample window in {path}, give --span".format(path=files[0]))
+            return 1
+
+    # Only the cycles appended to files indexed before
+    jobs = []
+    for path in files:
+        number = index.file_number(path)
+        after = None
+        if number is not None:
+            indexed, size, after = index.files[number]
+            if os.path.getsize(path) == size:
+                continue
+            if os.path.getsize(path) < size:
+                print("!! WARN: Skipping {path}, smaller than when indexed".format(path=path))
+                continue
+        jobs.append((path, after))
+    print("Indexing {n} files with {j} workers".format(n=len(jobs), j=args.jobs))
+
+    t_start = time.perf_counter()
+    n_cycles = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(index_file, path, index.span, index.points,
+                               index.peaks, after): path for path, after in jobs}
+        for future in futures:
+            try:
+                path, size, entries, vectors, peaks = future.result()
+            except Exception as err:
+                print("!! WARN: Skipping {path}: {err}".format(path=futures[future], err=err))
+                continue
+            index.append(path, size, entries, vectors, peaks)
+            n_cycles += len(entries)
+    dt = time.perf_counter() - t_start
+    print("Indexed {c} cycle channels in {dt:.2f} s, {n} in the index".format(
+        c=n_cycles, dt=dt, n=len(index)))
+    return 0
+
+
+def main_search(args):
+    index = SimilarityIndex(args.index)
+    if len(index) == 0:
+        print("!! WARN: The index is empty")
+        return 1
+    # The last matching cycle of the run, by default the last run
+    query = None
+    n_runs = 0
+    for cycle in storage.iter_cycles(args.query):
+        n_runs = cycle[0] + 1
+        if args.run is None and query is not None and query[0] != cycle[0]:
+            query = None
+        if args.run is not None and cycle[0] != args.run:
+            if cycle[0] > args.run:
+                break
+            continue
+        if args.cycle is None or cycle[2] == args.cycle:
+            query = cycle
+    run_id = n_runs - 1 if args.run is None else args.run
+    if not 0 <= run_id < n_runs:
+        print("!! WARN: No run {run} in {path}, it has {n} runs".format(
+            run=run_id, path=args.query, n=n_runs))
+        return 1
+    if query is None:
+        print("!! WARN: No cycle{id} in run {run} of {path}".format(
+            id="" if args.cycle is None else " {}".format(args.cycle),
+            run=run_id, path=args.query))
+        return 1
+    run_id, metadata, cycle_id, t, y = query
+    y = y.reshape(len(t), -1)
+    if not 0 <= args.channel < y.shape[1]:
+        print("!! WARN: No channel {ch} in {path}, it has {n} channels".format(
+            ch=args.channel, path=args.query, n=y.shape[1]))
+        return 1
+    y = y[:, args.channel]
+    vector, peaks = index.fingerprint(t, y, metadata.get('sample_delta'))
+
+    exclude = None
+    number = index.file_number(args.query)
+    if number is not None:
+        exclude = (number, run_id, cycle_id, args.channel)
+    t_start = time.perf_counter()
+    index.load()
+    t_load = time.perf_counter()
+    matches, = index.search(vector, peaks, k=args.matches, tolerance=args.tolerance,
+                            weight=args.retention_weight, exclude=exclude)
+    t_search = time.perf_counter()
+    print("# Query : {path}, run {run}, id {id}, channel {ch}".format(
+        path=args.query, run=run_id, id=cycle_id, ch=args.channel))
+    print("# " + MATCH_COLUMNS)
+    for line in index.format_matches(matches):
+        print(line)
+    print("# Searched {n} cycle channels in {search:.1f} ms (loaded in {load:.1f} ms)".format(
+        n=len(index), search=1e3*(t_search - t_load), load=1e3*(t_load - t_start)))
+    return 0
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="chromatographer.py similar",
+                            description="Index recorded cycles and find similar ones")
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('index', help="Add output files to an index")
+    cmd.add_argument('index', help="Index directory, created if needed")
+    cmd.add_argument('paths', nargs='+',
+                     help="Output files or directories to search")
+    cmd.add_argument('-p', '--pattern', type=str, default="*.csv",
+                     help="File name pattern when searching directories")
+    cmd.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                     help="Number of worker processes")
+    cmd.add_argument('--points', type=int, default=FINGERPRINT_POINTS,
+                     help="Bins of the fingerprint of a new index")
+    cmd.add_argument('--peaks', type=int, default=FINGERPRINT_PEAKS,
+                     help="Retention times kept per cycle in a new index")
+    cmd.add_argument('--span', type=float, default=None,
+                     help="Seconds of each cycle fingerprinted in a new index "
+                          "(default: sample window of the first file)")
+    cmd = commands.add_parser('search', help="Find the cycles most like a cycle")
+    cmd.add_argument('index', help="Index directory")
+    cmd.add_argument('query', help="Output file of the cycle")
+    cmd.add_argument('--run', type=int, default=None,
+                     help="Run of the cycle in the file (default: last)")
+    cmd.add_argument('--cycle', type=int, default=None,
+                     help="Id of the cycle in the run (default: last)")
+    cmd.add_argument('--channel', type=int, default=0,
+                     help="Channel of the cycle")
+    cmd.add_argument('-k', '--matches', type=int, default=10,
+                     help="Number of matches listed")
+    cmd.add_argument('--tolerance', type=float, default=RETENTION_TOLERANCE_DEFAULT,
+                     help="Seconds between retention times of the same peak")
+    cmd.add_argument('--retention-weight', type=float, default=RETENTION_WEIGHT_DEFAULT,
+                     help="Weight of the retention times in the score")
+    args = parser.parse_args(argv)
+
+    if args.command == 'index':
+        return main_index(args)
+    return main_search(args)
@@ -0,0 +1,851 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+==========
+storage.py
+==========
+
+Reading and writing recorded chromatograms.
+
+Two formats are supported:
+
+* output file : the text file written by chromatographer-qt.py, a '#' header
+                per run followed by "id,time,signal" lines per sample.
+* archive     : an append-only binary file holding each cycle as columnar
+                float64 arrays, with a small index file mapping run and cycle
+                ids to byte offsets so single cycles can be memory-mapped.
+
+Archive layout, all values little endian:
+
+    "CGARCH01"                                  file magic
+    RUN_ run_id length <metadata json> <pad>    run record, once per run
+    CYCL run_id cycle_id channels n <t[n]> <y[channels][n]>
+
+The index (archive path + ".idx") is a flat array of INDEX_DTYPE records, one
+per run or cycle record. It can be rebuilt by scanning the archive.
+
+During acquisition all three files of a recording (output file, peak table
+and archive) are written by an OutputWriter from a thread of its own.
+
+Usage:
+
+    python storage.py import output.csv output.cga
+    python storage.py export output.cga output.csv
+    python storage.py list output.cga
+"""
+
+import datetime
+import io
+import json
+import numpy
+import os
+import os.path
+import queue
+import re
+import struct
+from telemetry import Telemetry
+import threading
+import time
+
+ARCHIVE_EXT = ".cga"
+INDEX_EXT = ".idx"
+ARCHIVE_MAGIC = b"CGARCH01"
+
+RUN_RECORD = struct.Struct("<4sII")
+CYCLE_RECORD = struct.Struct("<4sIIIQ")
+RUN_KIND = b"RUN_"
+CYCLE_KIND = b"CYCL"
+# Cycle id used in the index for run metadata records
+RUN_ENTRY = 0xffffffff
+
+INDEX_DTYPE = numpy.dtype([('run', '<u4'), ('cycle', '<u4'),
+                           ('channels', '<u4'), ('reserved', '<u4'),
+                           ('offset', '<u8'), ('n', '<u8')])
+
+# Output file header written at the start of each run
+HEADER = ("# Date : {date}\n"
+          "# Sample window (t) : {sample_window} sec\n"
+          "# Sample interval (dt) : {sample_delta} sec\n"
+          "# Cycle Time : {cycle_time} min\n"
+          "#\n"
+          "# {columns}\n")
+DATA_COLUMNS = "id, time (s), signal (V)"
+PEAKS_COLUMNS = "id, rt (s), start (s), end (s), height (V), area (V s), width (s)"
+PEAKS_CHANNEL_COLUMNS = PEAKS_COLUMNS.replace("id, ", "id, channel, ", 1)
+
+# Header keys as written by chromatographer.py and chromatographer-qt.py
+HEADER_KEYS = {
+    'date'                  : 'date',
+    'sample window (t)'     : 'sample_window',
+    'sample interval (dt)'  : 'sample_delta',
+    'cycle time'            : 'cycle_time',
+}
+HEADER_RE = re.compile(r"^#\s*([^:]+?)\s*:\s*(.*?)\s*$")
+
+# Bytes read at a time when streaming output files
+READ_BLOCK_SIZE = 1 << 24
+
+# Blocks of samples queued for an OutputWriter before further blocks are
+# dropped, run starts, peak tables and cycle ends are always queued
+WRITER_QUEUE_SIZE = 4096
+# Seconds between syncs of the written files to disk
+SYNC_INTERVAL_DEFAULT = 1.0
+
+
+def format_header(date=None, sample_window=None, sample_delta=None,
+                  cycle_time=None, columns=DATA_COLUMNS, **kwargs):
+    """Format the output file header of a run"""
+    if date is None:
+        date = datetime.date.today().ctime()
+    return HEADER.format(date=date, sample_window=sample_window,
+                         sample_delta=sample_delta, cycle_time=cycle_time,
+                         columns=columns)
+
+
+def data_columns(channels=None):
+    """Column header of the output file for the named analog channels"""
+    if channels is None or len(channels) == 1:
+        return DATA_COLUMNS
+    return "id, time (s), " + ", ".join("{} (V)".format(ch) for ch in channels)
+
+
+def peaks_columns(channels=None):
+    """Column header of the peak file, with a channel column if needed"""
+    if channels is None or len(channels) == 1:
+        return PEAKS_COLUMNS
+    return PEAKS_CHANNEL_COLUMNS
+
+
+def archive_path(path):
+    """Archive stored alongside the output file path"""
+    return os.path.splitext(path)[0] + ARCHIVE_EXT
+
+
+def peaks_path(path):
+    """Peak table file stored alongside the output file path"""
+    base, ext = os.path.splitext(path)
+    return base + "_peaks" + (ext or ".csv")
+
+
+def ensemble_path(path):
+    """Ensemble statistics file (see ensemble.py) stored alongside the output
+    file path
+    """
+    base, ext = os.path.splitext(path)
+    return base + "_ensemble" + (ext or ".csv")
+
+
+def rotated_path(path, n):
+    """Path of the n-th file the output file path is rotated to"""
+    base, ext = os.path.splitext(path)
+    return "{base}.{n}{ext}".format(base=base, n=n, ext=ext or ".csv")
+
+
+def write_rows(f, cycle_id, t, y):
+    """Write the samples of one cycle as "id,time,signal" lines
+    y : sample values, shape (n,) or (n, channels) for one column per channel
+    """
+    ids = numpy.full(len(t), cycle_id)
+    channels = 1 if numpy.ndim(y) == 1 else numpy.shape(y)[1]
+    numpy.savetxt(f, numpy.column_stack((ids, t, y)),
+                  fmt=('%d', '%.10g') + ('%.10g',)*channels, delimiter=',')
+
+
+def write_peaks(f, cycle_id, peaks, channel=None):
+    """Write the peak table of one cycle, see peaks.PEAK_DTYPE
+    channel : channel index written after the id, if not None
+    """
+    prefix = "{}".format(cycle_id)
+    if channel is not None:
+        prefix += ",{}".format(channel)
+    for peak in peaks:
+        f.write(prefix + ",{:.4f},{:.4f},{:.4f},{:.6g},{:.6g},{:.4f}\n".format(*peak))
+
+
+def parse_header(lines):
+    """Parse the metadata from the '#' header lines of a run"""
+    metadata = {}
+    for line in lines:
+        columns = [c.strip() for c in line.lstrip('# ').split(',')]
+        if columns[:2] == ["id", "time (s)"] and len(columns) > 3:
+            # Channel names of a run of several channels
+            metadata['channels'] = [c.replace(" (V)", "") for c in columns[2:]]
+            continue
+        match = HEADER_RE.match(line)
+        if match is None:
+            continue
+        key = HEADER_KEYS.get(match.group(1).lower())
+        if key is None:
+            continue
+        value = match.group(2)
+        if key != 'date':
+            # Drop units, e.g., "30 sec"
+            value = float(value.split()[0])
+        metadata[key] = value
+    return metadata
+
+
+def read_output_file(path):
+    """Read an output file as a list of runs
+
+    Each run is a tuple of (metadata, data) where data is an (n, 3) array of
+    the id, time and signal columns, with one signal column per channel for
+    runs of several channels.
+
+    The file is split into header and data blocks with array operations on
+    the raw bytes and each data block is parsed with a single loadtxt call,
+    rather than handling the file line by line.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    runs = []
+    metadata = None
+    for is_header, start, end in _line_blocks(raw):
+        if is_header == True:
+            if metadata is not None:
+                # Header without any data
+                runs.append((metadata, numpy.empty((0, 3))))
+            metadata = parse_header(raw[start:end].decode().splitlines())
+        else:
+            runs.append((metadata or {}, _parse_rows(raw[start:end])))
+            metadata = None
+    if metadata is not None:
+        runs.append((metadata, numpy.empty((0, 3))))
+    return runs
+
+
+def _line_blocks(raw):
+    """Split raw bytes into blocks of consecutive header or data lines,
+    yields (is_header, start, end) byte ranges
+    """
+    chars = numpy.frombuffer(raw, dtype=numpy.uint8)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(chars == ord('\n')) + 1))
+    starts = starts[starts < len(raw)]
+    if len(starts) == 0:
+        return
+    is_header = chars[starts] == ord('#')
+    bounds = numpy.flatnonzero(is_header[1:] != is_header[:-1]) + 1
+    block_starts = numpy.concatenate(([0], bounds))
+    block_ends = numpy.concatenate((bounds, [len(starts)]))
+    for first, last in zip(block_starts, block_ends):
+        end = starts[last] if last < len(starts) else len(raw)
+        yield bool(is_header[first]), int(starts[first]), int(end)
+
+
+def _parse_rows(raw):
+    return numpy.loadtxt(io.BytesIO(raw), delimiter=',', ndmin=2)
+
+
+def iter_output_file(path, block_size=READ_BLOCK_SIZE):
+    """Stream an output file as (metadata, data) blocks
+
+    Like read_output_file, but reading about block_size bytes at a time so
+    files larger than memory can be processed. The rows of a run may be
+    split over several blocks, which then share the same metadata dict, so
+    a new run starts whenever the metadata is a different object. Runs
+    without any rows are skipped.
+    """
+    metadata = {}
+    header = []
+    rest = b""
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            raw = rest + block
+            if len(block) > 0:
+                # Keep the partial last line for the next block
+                end = raw.rfind(b"\n") + 1
+                raw, rest = raw[:end], raw[end:]
+            for is_header, start, end in _line_blocks(raw):
+                if is_header == True:
+                    header.extend(raw[start:end].decode().splitlines())
+                    continue
+                if len(header) > 0:
+                    metadata = parse_header(header)
+                    header = []
+                yield metadata, _parse_rows(raw[start:end])
+            if len(block) == 0:
+                break
+
+
+def split_cycles(data):
+    """Split (id, time, signal) rows into a list of (cycle_id, t, y)
+
+    y is (n,) for a single signal column and (n, channels) otherwise.
+    """
+    if len(data) == 0:
+        return []
+    ids = data[:, 0]
+    bounds = numpy.flatnonzero(numpy.diff(ids)) + 1
+    signals = 2 if data.shape[1] == 3 else slice(2, None)
+    return [(int(chunk[0, 0]), chunk[:, 1], chunk[:, signals])
+            for chunk in numpy.split(data, bounds)]
+
+
+def iter_cycles(path, block_size=READ_BLOCK_SIZE):
+    """Stream the cycles of an output file as (run, metadata, cycle_id, t, y)
+
+    Built on iter_output_file, so runs without any rows are not counted, and
+    the rows of a cycle split over several blocks are joined. Memory use is
+    that of a block plus the largest cycle.
+    """
+    run_id = -1
+    metadata = None
+    pending = None
+    for block_metadata, data in iter_output_file(path, block_size):
+        if block_metadata is not metadata:
+            if pending is not None:
+                yield (run_id, metadata) + pending
+                pending = None
+            metadata = block_metadata
+            run_id += 1
+        for cycle in split_cycles(data):
+            if pending is not None and pending[0] == cycle[0]:
+                cycle = (cycle[0], numpy.concatenate((pending[1], cycle[1])),
+                         numpy.concatenate((pending[2], cycle[2])))
+            elif pending is not None:
+                yield (run_id, metadata) + pending
+            pending = cycle
+    if pending is not None:
+        yield (run_id, metadata) + pending
+
+
+def _pad(n):
+    """Padding needed to align n bytes to 8 bytes"""
+    return -n % 8
+
+
+class ArchiveWriter:
+    """ArchiveWriter
+    Appends runs and cycles to an archive and its index.
+
+    Records are written to the archive before their index entry, so after a
+    crash the index never points past the end of the archive.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_EXT
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if new == False and not os.path.exists(self.index_path):
+            rebuild_index(path)
+        self.f = open(path, 'ab')
+        self.f_index = open(self.index_path, 'ab')
+        if new == True:
+            self.f.write(ARCHIVE_MAGIC)
+            index = numpy.empty(0, dtype=INDEX_DTYPE)
+        else:
+            index = numpy.fromfile(self.index_path, dtype=INDEX_DTYPE)
+        # Id of the current run, new runs continue from the last one
+        self.run_id = int(index['run'].max()) if len(index) > 0 else -1
+
+    def _append_index(self, run_id, cycle_id, channels, offset, n):
+        entry = numpy.array([(run_id, cycle_id, channels, 0, offset, n)],
+                            dtype=INDEX_DTYPE)
+        self.f_index.write(entry.tobytes())
+        self.f_index.flush()
+
+    def begin_run(self, **metadata):
+        """Start a new run described by metadata, returns the run id"""
+        self.run_id += 1
+        payload = json.dumps(metadata).encode()
+        offset = self.f.tell() + RUN_RECORD.size
+        self.f.write(RUN_RECORD.pack(RUN_KIND, self.run_id, len(payload)))
+        self.f.write(payload + b"\0"*_pad(RUN_RECORD.size + len(payload)))
+        self.f.flush()
+        self._append_index(self.run_id, RUN_ENTRY, 0, offset, len(payload))
+        return self.run_id
+
+    def write_cycle(self, cycle_id, t, y):
+        """Append one cycle of the current run
+        t : sample times, shape (n,)
+        y : sample values, shape (n,) or (n, channels)
+        """
+        if self.run_id < 0:
+            self.begin_run()
+        t = numpy.ascontiguousarray(t, dtype='<f8')
+        y = numpy.asarray(y, dtype='<f8')
+        channels = 1 if y.ndim == 1 else y.shape[1]
+        offset = self.f.tell() + CYCLE_RECORD.size
+        self.f.write(CYCLE_RECORD.pack(CYCLE_KIND, self.run_id, cycle_id,
+                                       channels, len(t)))
+        self.f.write(t.tobytes())
+        # Channels are stored as contiguous columns
+        self.f.write(numpy.ascontiguousarray(y.T).tobytes())
+        self.f.flush()
+        self._append_index(self.run_id, cycle_id, channels, offset, len(t))
+
+    def close(self):
+        self.f.close()
+        self.f_index.close()
+
+
+def rebuild_index(path):
+    """Recreate the index of an archive by scanning its records"""
+    entries = []
+    with open(path, 'rb') as f:
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ValueError("{} is not an archive".format(path))
+        while True:
+            kind = f.read(4)
+            if len(kind) < 4:
+                break
+            f.seek(-4, io.SEEK_CUR)
+            if kind == RUN_KIND:
+                _, run_id, length = RUN_RECORD.unpack(f.read(RUN_RECORD.size))
+                entries.append((run_id, RUN_ENTRY, 0, 0, f.tell(), length))
+                f.seek(length + _pad(RUN_RECORD.size + length), io.SEEK_CUR)
+            elif kind == CYCLE_KIND:
+                header = f.read(CYCLE_RECORD.size)
+                if len(header) < CYCLE_RECORD.size:
+                    break
+                _, run_id, cycle_id, channels, n = CYCLE_RECORD.unpack(header)
+                offset = f.tell()
+                f.seek(8*n*(1 + channels), io.SEEK_CUR)
+                if offset + 8*n*(1 + channels) > os.path.getsize(path):
+                    # Truncated record at the end of the archive
+                    break
+                entries.append((run_id, cycle_id, channels, 0, offset, n))
+            else:
+                raise ValueError("Corrupt archive record at {}".format(f.tell()))
+    index = numpy.array(entries, dtype=INDEX_DTYPE)
+    index.tofile(path + INDEX_EXT)
+    return index
+
+
+class ArchiveReader:
+    """ArchiveReader
+    Random access to the runs and cycles of an archive.
+
+    Cycles are returned as read-only views of a memory map of the archive, so
+    only the pages of the requested cycles are read from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index and map the archive, e.g., after it grew"""
+        index_path = self.path + INDEX_EXT
+        if os.path.exists(index_path):
+            self.index = numpy.fromfile(index_path, dtype=INDEX_DTYPE)
+        else:
+            self.index = rebuild_index(self.path)
+        self.data = numpy.memmap(self.path, dtype=numpy.uint8, mode='r')
+        if bytes(self.data[:len(ARCHIVE_MAGIC)]) != ARCHIVE_MAGIC:
+            raise ValueError("{} is not an archive".format(self.path))
+        self._lookup = {(int(e['run']), int(e['cycle'])): i
+                        for i, e in enumerate(self.index)}
+
+    def runs(self):
+        """Ids of the runs in the archive"""
+        mask = self.index['cycle'] == RUN_ENTRY
+        return [int(run) for run in self.index['run'][mask]]
+
+    def metadata(self, run_id):
+        """Metadata stored with run_id"""
+        entry = self.index[self._lookup[(run_id, RUN_ENTRY)]]
+        start = int(entry['offset'])
+        return json.loads(bytes(self.data[start:start + int(entry['n'])]))
+
+    def cycles(self, run_id):
+        """Ids of the cycles recorded in run_id"""
+        mask = (self.index['run'] == run_id) & (self.index['cycle'] != RUN_ENTRY)
+        return [int(cycle) for cycle in self.index['cycle'][mask]]
+
+    def read_cycle(self, run_id, cycle_id):
+        """Return (t, y) of a cycle, y is (n,) or (n, channels)"""
+        entry = self.index[self._lookup[(run_id, cycle_id)]]
+        start, n = int(entry['offset']), int(entry['n'])
+        channels = int(entry['channels'])
+        values = self.data[start:start + 8*n*(1 + channels)].view('<f8')
+        t = values[:n]
+        y = values[n:].reshape(channels, n).T
+        if channels == 1:
+            y = y[:, 0]
+        return t, y
+
+    def close(self):
+        del self.data
+
+
+# Queue item ending the writer thread
+_STOP = ('stop',)
+
+
+class OutputWriter:
+    """OutputWriter
+    Writes the output file, peak table and archive of a recording from a
+    thread of its own, so the caller never waits on the disk.
+
+    Samples are queued as they arrive and everything queued while the
+    thread was busy is written as one batch: the samples of a cycle are
+    formatted in one go, each file gets a single write and is flushed.
+    Files are synced to disk at most every sync_interval seconds after a
+    write (group commit), 0 syncing every batch and None leaving it to the
+    OS, so a crash loses at most the last interval rather than the cycle.
+    The archive gets each cycle when it ends, or is stopped part way.
+
+    At the end of a cycle the files are rotated, to path.1.csv, path.2.csv,
+    etc. with their peak tables and archives, once the output file reaches
+    max_bytes or, with daily, the date has changed. The header of the run is
+    repeated at the top of each file.
+
+    Should the disk fall queue_size blocks of samples behind, further blocks
+    are dropped and counted in dropped. Run starts, peak tables and cycle
+    ends are never dropped, so the files keep their structure. Once writing
+    fails, the error is kept in error, nothing more is written and
+    everything queued afterwards is counted in dropped.
+    """
+    def __init__(self, path, sync_interval=SYNC_INTERVAL_DEFAULT,
+                 max_bytes=None, daily=False, queue_size=WRITER_QUEUE_SIZE,
+                 telemetry=None):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.daily = daily
+        # Number of items dropped with the queue full or after an error
+        self.dropped = 0
+        # First error writing the files, None if all went well
+        self.error = None
+        if telemetry is None:
+            telemetry = Telemetry()
+        self._m_write = telemetry.histogram("writer_batch_seconds",
+                                            "Duration of writing a batch of output")
+        self._m_sync = telemetry.histogram("writer_sync_seconds",
+                                           "Duration of syncing the output to disk")
+        self._m_dropped = telemetry.counter("writer_dropped_total",
+                                            "Output items dropped with the writer queue full "
+                                            "or after a write error")
+        # Unbounded, the blocks of samples in it are limited by the slots
+        self._queue = queue.Queue()
+        self._sample_slots = threading.Semaphore(queue_size)
+        # Callback of close, whether close was called and whether the thread
+        # has ended, under _lock
+        self._lock = threading.Lock()
+        self._closed = None
+        self._closing = False
+        self._done = False
+        self._metadata = None
+        # Samples of the current cycle and its id, for the archive
+        self._cycle = []
+        self._cycle_id = None
+        self._rotation = 0
+        # Rotate before the next write, not to leave an empty file at the end
+        self._rotate_due = False
+        # Opened here so a bad path is reported to the caller
+        self._open(path)
+        self._thread = threading.Thread(target=self._run, name="OutputWriter",
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        """Queue an item, never waiting for the writer thread"""
+        if self.error is None:
+            if item[0] != 'samples' or self._sample_slots.acquire(blocking=False):
+                self._queue.put(item)
+                return
+            if self.dropped == 0:
+                print("!! WARN: Output writer queue full, dropping samples")
+        self.dropped += 1
+        self._m_dropped.inc()
+
+    def begin_run(self, **metadata):
+        """Start a new run described by metadata, see format_header"""
+        self._put(('run', metadata))
+
+    def write_samples(self, cycle_id, t, y):
+        """Append samples of a cycle as they arrive, the arrays must not
+        be modified afterwards
+        t : sample times, shape (n,)
+        y : sample values, shape (n,) or (n, channels)
+        """
+        self._put(('samples', cycle_id, t, y))
+
+    def end_cycle(self, cycle_id):
+        """Mark the end of a cycle, which is then written to the archive"""
+        self._put(('cycle', cycle_id))
+
+    def write_peaks(self, cycle_id, peaks):
+        """Write the peak tables of a cycle, one per channel"""
+        self._put(('peaks', cycle_id, peaks))
+
+    def write_ensemble(self, columns, table):
+        """Append the ensemble statistics of the run (see ensemble.py) to the
+        ensemble file, columns being the header of the table's columns
+        """
+        self._put(('ensemble', columns, table))
+
+    def close(self, wait=True, callback=None):
+        """Write everything queued, sync and close the files
+
+        wait     : wait for the files to be closed, otherwise return at once
+        callback : called with the writer once the files are closed, from
+                   the writer thread unless it had already ended
+
+        Only the first call closes the writer, later ones can still wait.
+        """
+        with self._lock:
+            first = self._closing == False
+            self._closing = True
+            done = self._done
+            if first == True and done == False:
+                self._closed = callback
+        if first == True:
+            self._queue.put(_STOP)
+            if done == True and callback is not None:
+                # The thread ended on an error before the close
+                callback(self)
+        if wait == True:
+            self._thread.join()
+
+    def _open(self, path):
+        self.f = open(path, 'a')
+        self.f_peaks = open(peaks_path(path), 'a')
+        self.archive = ArchiveWriter(archive_path(path))
+        self.current_path = path
+        self._date = datetime.date.today()
+
+    def _close_files(self):
+        self.f.close()
+        self.f_peaks.close()
+        self.archive.close()
+
+    def _run(self):
+        # monotonic time of the first write since the last sync
+        t_unsynced = None
+        stop = False
+        while stop == False:
+            timeout = None
+            if t_unsynced is not None:
+                timeout = max(0, t_unsynced + self.sync_interval - time.monotonic())
+            try:
+                items = [self._queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item[0] == 'samples':
+                    self._sample_slots.release()
+            stop = any(item is _STOP for item in items)
+            try:
+                if len(items) > 0:
+                    with self._m_write.time():
+                        self._write(items)
+                    if t_unsynced is None and self.sync_interval is not None:
+                        t_unsynced = time.monotonic()
+                if t_unsynced is not None and (stop == True or
+                        time.monotonic() >= t_unsynced + self.sync_interval):
+                    self._sync()
+                    t_unsynced = None
+            except OSError as err:
+                print("!! WARN: Writing {path} failed, output stopped: {err}".format(
+                    path=self.current_path, err=err))
+                self.error = err
+                break
+        try:
+            self._close_files()
+        except OSError as err:
+            self.error = self.error or err
+        with self._lock:
+            callback, self._closed = self._closed, None
+            self._done = True
+        if callback is not None:
+            callback(self)
+
+    def _write(self, items):
+        data = io.StringIO()
+        peaks = io.StringIO()
+        samples = []
+        for item in items:
+            kind = item[0]
+            if self._rotate_due == True and kind in ('run', 'samples', 'peaks'):
+                # Nothing is buffered right after the end of a cycle. A new
+                # run writes its own header, not that of the last run
+                self._rotate(begin_run=kind != 'run')
+            if kind == 'samples':
+                if item[1] != self._cycle_id:
+                    # A cycle without an end, e.g., from a restarted source
+                    self._archive_cycle()
+                    self._cycle_id = item[1]
+                samples.append(item[1:])
+                self._cycle.append(item[2:])
+                continue
+            # Everything before the item is written first
+            self._format_samples(data, samples)
+            samples = []
+            if kind == 'run':
+                self._write_out(data, peaks)
+                # The cycle stopped part way belongs to the previous run
+                self._archive_cycle()
+                self._metadata = item[1]
+                self._begin_run()
+            elif kind == 'peaks':
+                for channel, table in enumerate(item[2]):
+                    if len(item[2]) == 1:
+                        channel = None
+                    write_peaks(peaks, item[1], table, channel=channel)
+            elif kind == 'cycle':
+                self._write_out(data, peaks)
+                self._end_cycle(item[1])
+            elif kind == 'ensemble':
+                self._write_ensemble(item[1], item[2])
+            elif kind == 'stop':
+                self._archive_cycle()
+        self._format_samples(data, samples)
+        self._write_out(data, peaks)
+
+    def _format_samples(self, f, samples):
+        """Format the samples of each cycle at once"""
+        start = 0
+        for i in range(1, len(samples) + 1):
+            if i < len(samples) and samples[i][0] == samples[start][0]:
+                continue
+            block = samples[start:i]
+            if len(block) == 1:
+                cycle_id, t, y = block[0]
+            else:
+                cycle_id = block[0][0]
+                t = numpy.concatenate([t for _, t, _ in block])
+                y = numpy.concatenate([y for _, _, y in block])
+            write_rows(f, cycle_id, t, y)
+            start = i
+
+    def _write_out(self, data, peaks):
+        for buffer, f in ((data, self.f), (peaks, self.f_peaks)):
+            if buffer.tell() > 0:
+                f.write(buffer.getvalue())
+                f.flush()
+                buffer.seek(0)
+                buffer.truncate()
+
+    def _write_ensemble(self, columns, table):
+        with open(ensemble_path(self.current_path), 'a') as f:
+            f.write(format_header(columns=columns, **(self._metadata or {})))
+            numpy.savetxt(f, table, fmt='%.10g', delimiter=',')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _begin_run(self):
+        channels = self._metadata.get('channels')
+        self.f.write(format_header(columns=data_columns(channels), **self._metadata))
+        self.f_peaks.write(format_header(columns=peaks_columns(channels),
+                                         **self._metadata))
+        self.archive.begin_run(**self._metadata)
+
+    def _archive_cycle(self):
+        """Write the samples of the current cycle to the archive"""
+        if len(self._cycle) > 0:
+            t = numpy.concatenate([t for t, y in self._cycle])
+            y = numpy.concatenate([y for t, y in self._cycle])
+            self.archive.write_cycle(self._cycle_id, t, y)
+        self._cycle = []
+        self._cycle_id = None
+
+    def _end_cycle(self, cycle_id):
+        self._cycle_id = cycle_id
+        self._archive_cycle()
+        if self.max_bytes is not None and os.fstat(self.f.fileno()).st_size >= self.max_bytes:
+            self._rotate_due = True
+        elif self.daily == True and datetime.date.today() != self._date:
+            self._rotate_due = True
+
+    def _rotate(self, begin_run=True):
+        """Continue in the next free rotated_path, repeating the header of
+        the current run unless begin_run is False
+        """
+        self._rotate_due = False
+        self._sync()
+        self._close_files()
+        path = self.path
+        while os.path.exists(path):
+            self._rotation += 1
+            path = rotated_path(self.path, self._rotation)
+        print("# Continuing output in", path)
+        self._open(path)
+        if begin_run == True and self._metadata is not None:
+            self._begin_run()
+
+    def _sync(self):
+        with self._m_sync.time():
+            for f in (self.f, self.f_peaks, self.archive.f, self.archive.f_index):
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def csv_to_archive(csv_path, archive_path):
+    """Convert an output file to an archive, returns the number of cycles"""
+    writer = ArchiveWriter(archive_path)
+    n_cycles = 0
+    try:
+        for metadata, data in read_output_file(csv_path):
+            writer.begin_run(**metadata)
+            for cycle_id, t, y in split_cycles(data):
+                writer.write_cycle(cycle_id, t, y)
+                n_cycles += 1
+    finally:
+        writer.close()
+    return n_cycles
+
+
+def archive_to_csv(archive_path, csv_path):
+    """Export an archive to an output file, returns the number of cycles"""
+    reader = ArchiveReader(archive_path)
+    n_cycles = 0
+    with open(csv_path, 'a') as f:
+        for run_id in reader.runs():
+            metadata = reader.metadata(run_id)
+            f.write(format_header(columns=data_columns(metadata.get('channels')),
+                                  **metadata))
+            for cycle_id in reader.cycles(run_id):
+                t, y = reader.read_cycle(run_id, cycle_id)
+                write_rows(f, cycle_id, t, y)
+                n_cycles += 1
+    reader.close()
+    return n_cycles
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Convert and inspect archives")
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('import', help="Convert an output file to an archive")
+    cmd.add_argument('csv')
+    cmd.add_argument('archive')
+    cmd = commands.add_parser('export', help="Convert an archive to an output file")
+    cmd.add_argument('archive')
+    cmd.add_argument('csv')
+    cmd = commands.add_parser('list', help="List the runs and cycles of an archive")
+    cmd.add_argument('archive')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        n = csv_to_archive(args.csv, args.archive)
+        print("Imported {n} cycles into {path}".format(n=n, path=args.archive))
+    elif args.command == 'export':
+        n = archive_to_csv(args.archive, args.csv)
+        print("Exported {n} cycles to {path}".format(n=n, path=args.csv))
+    elif args.command == 'list':
+        reader = ArchiveReader(args.archive)
+        for run_id in reader.runs():
+            print("# Run", run_id, reader.metadata(run_id))
+            for cycle_id in reader.cycles(run_id):
+                t, y = reader.read_cycle(run_id, cycle_id)
+                print(cycle_id, len(t))
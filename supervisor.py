@@ -0,0 +1,452 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+=============
+supervisor.py
+=============
+
+Several instruments acquired from one host, run as
+
+    python chromatographer.py supervisor [options] instruments.json
+
+Each instrument is acquired by a Chromatographer in a process of its own, so
+the instruments neither share an interpreter lock nor wait on each other or
+on the supervisor. How much this improves the timing of each instrument has
+not been measured yet; it needs a host with a core per instrument, on fewer
+cores the processes still compete for the CPU.
+
+The points of each instrument are handed to the supervisor through a
+SharedRingBuffer (see buffers.py), and the rarer events (run settings, time
+remaining, peak tables, cycle ends) through a queue. The supervisor records
+every instrument to <output>/<name>.csv with an OutputWriter (see
+storage.py) and prints a status line per instrument.
+
+The instruments file maps names to the commandline options of the
+instrument, as a string or a list:
+
+    {
+        "gc1" : "-d Dev1 -c 300 -T 30 -t 0.5",
+        "gc2" : ["-d", "Dev2", "--channels", "Dev2/ai1,Dev2/ai2"]
+    }
+"""
+
+from buffers import SharedRingBuffer
+import chromatographer as cg
+import datetime
+import json
+import multiprocessing
+import numpy
+import os
+import os.path
+import queue
+import shlex
+import signal
+import storage
+from telemetry import METRICS_INTERVAL_DEFAULT, MetricsExporter, Telemetry
+import threading
+import time
+
+# Seconds between reads of the sample rings
+POLL_INTERVAL = 0.05
+# Seconds between status lines
+STATUS_INTERVAL_DEFAULT = 5.0
+# Seconds before restarting an instrument process that exited
+RESTART_DELAY = 5.0
+# Seconds to wait for an instrument process to stop before terminating it
+STOP_TIMEOUT = 10.0
+# Seconds between checks of the stop event by an instrument process
+STOP_CHECK_INTERVAL = 0.1
+
+
+def parse_instruments(path):
+    """Instrument names and commandline options from an instruments file"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_instrument_arguments(argv):
+    """Options of an instrument, see chromatographer.add_acquisition_arguments"""
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="instrument")
+    cg.add_acquisition_arguments(parser)
+    return parser.parse_args(argv)
+
+
+class SupervisedChromatographer(cg.Chromatographer):
+    """SupervisedChromatographer
+    Hands its points to the supervisor through a shared ring and its events
+    through a queue, tagged with the instrument name.
+    """
+    name = None
+    ring = None
+    events = None
+
+    def send_time_remaining(self, t):
+        self.events.put((self.name, 'time', t))
+
+    def send_data_ready(self, x, y):
+        self.ring.write(x, y)
+
+    def send_peaks(self, peaks):
+        self.events.put((self.name, 'peaks', peaks))
+
+    def send_finished(self):
+        # Delay of the reads after their deadline, software timed only
+        lateness = self.telemetry.histogram("sample_lateness_seconds")
+        stats = {'lateness_p99' : None, 'lateness_max' : None}
+        if lateness.count > 0:
+            stats = {'lateness_p99' : lateness.quantile(0.99),
+                     'lateness_max' : lateness.max}
+        self.events.put((self.name, 'finished', stats))
+
+
+def run_instrument(name, argv, ring_name, events, stop_event, cpu=None):
+    """Acquire an instrument until stop_event is set, in its own process"""
+    # Ctrl-C reaches the whole process group, only the supervisor stops the
+    # instruments
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    args = parse_instrument_arguments(argv)
+    ring = None
+    worker = None
+    try:
+        worker = cg.create_worker(args, SupervisedChromatographer)
+        ring = SharedRingBuffer(ring_capacity(args), len(worker.channels),
+                                name=ring_name)
+        worker.name, worker.ring, worker.events = name, ring, events
+        # Woken from any wait of the worker by stop
+        threading.Thread(target=watch_stop, args=(stop_event, worker),
+                         daemon=True).start()
+        events.put((name, 'started',
+                    dict(date=datetime.date.today().ctime(),
+                         sample_window=worker.sample_t,
+                         sample_delta=worker.sample_dt,
+                         cycle_time=worker.cycle_time,
+                         channels=worker.channels)))
+        worker.collect_data()
+    except Exception as err:
+        events.put((name, 'error', "{}: {}".format(type(err).__name__, err)))
+        raise
+    finally:
+        if worker is not None:
+            worker.close_tasks()
+        if ring is not None:
+            ring.close()
+        events.put((name, 'stopped', None))
+
+
+def watch_stop(stop_event, worker):
+    """Stop the worker once stop_event is set
+
+    The event is polled rather than waited on: a process exiting while one of
+    its threads waits on a multiprocessing Event leaves the event counting a
+    sleeper, and setting it then blocks the supervisor forever.
+    """
+    while stop_event.is_set() == False:
+        time.sleep(STOP_CHECK_INTERVAL)
+    worker.stop()
+
+
+def ring_capacity(args):
+    """Points in the sample ring of an instrument, a whole sample window"""
+    return int(numpy.ceil(args.sample_window/args.sample_delta)) + 1
+
+
+class Instrument:
+    """Instrument
+    An instrument acquired in a process of its own, as seen by the
+    supervisor.
+
+    argv : commandline options of the instrument, a list or a string
+    """
+    def __init__(self, name, argv):
+        self.name = name
+        if isinstance(argv, str):
+            argv = shlex.split(argv)
+        self.argv = list(argv)
+        args = parse_instrument_arguments(argv)
+        if args.channels is not None:
+            self.channels = args.channels.split(',')
+        else:
+            self.channels = ["{dev}/ai1".format(dev=args.daq_device)]
+        self.capacity = ring_capacity(args)
+        self.process = None
+        self.ring = None
+        self.stop_event = None
+        self.writer = None
+        self.state = "stopped"
+        self.error = None
+        # Cycle being recorded and points in it, points and peaks of the last
+        # finished cycle
+        self.cycle_id = 0
+        self.points = 0
+        self.cycle_points = 0
+        self.peaks = 0
+        self.time_remaining = None
+        self.stats = {}
+        self.restarts = 0
+        self.t_exit = None
+        # Points in total and at the last status line, for the rate
+        self.points_total = 0
+        self.points_reported = 0
+
+
+class Supervisor:
+    """Supervisor
+    Runs one acquisition process per instrument and records the points they
+    hand over.
+
+    output : directory of the output files, one set per instrument
+    pin : pin instrument i to CPU i + 1 (modulo the CPUs), keeping CPU 0
+          for the supervisor
+    restart : restart instrument processes that exit, e.g., on a DAQ error
+    """
+    def __init__(self, instruments, output=".", pin=False, restart=False,
+                 sync_interval=storage.SYNC_INTERVAL_DEFAULT, telemetry=None):
+        self.instruments = [Instrument(name, argv)
+                            for name, argv in instruments.items()]
+        self.output = output
+        self.pin = pin
+        self.restart = restart
+        self.sync_interval = sync_interval
+        if telemetry is None:
+            telemetry = Telemetry()
+        self.telemetry = telemetry
+        # The workers are never forked with the supervisor's threads and
+        # devices, each starts from a fresh interpreter
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self._by_name = {inst.name: inst for inst in self.instruments}
+        self._t_status = time.monotonic()
+
+    def start(self):
+        for i, inst in enumerate(self.instruments):
+            self.launch(inst, i)
+
+    def launch(self, inst, i=None):
+        """Start the acquisition process of an instrument"""
+        if i is None:
+            i = self.instruments.index(inst)
+        cpu = None
+        if self.pin == True:
+            cpu = (i + 1) % os.cpu_count()
+        inst.ring = SharedRingBuffer(inst.capacity, len(inst.channels))
+        inst.stop_event = self.context.Event()
+        inst.process = self.context.Process(
+            target=run_instrument, name="instrument-" + inst.name,
+            args=(inst.name, inst.argv, inst.ring.name, self.events,
+                  inst.stop_event, cpu),
+            daemon=True)
+        inst.process.start()
+        inst.state = "starting"
+        inst.error = None
+
+    def poll(self, timeout=POLL_INTERVAL):
+        """Handle the events and points of every instrument, waiting up to
+        timeout for an event
+        """
+        try:
+            events = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        for name, kind, payload in events:
+            self.handle(self._by_name[name], kind, payload)
+        for inst in self.instruments:
+            self.drain(inst)
+            self.check_process(inst)
+
+    def drain(self, inst):
+        """Record the points handed over by an instrument"""
+        if inst.ring is None:
+            return
+        t, y = inst.ring.read()
+        if len(t) == 0:
+            return
+        inst.points += len(t)
+        inst.points_total += len(t)
+        self.telemetry.counter("supervisor_points_total", "Points recorded",
+                               instrument=inst.name).inc(len(t))
+        if inst.writer is not None:
+            inst.writer.write_samples(inst.cycle_id, t, y)
+
+    def handle(self, inst, kind, payload):
+        """Handle an event of an instrument"""
+        if kind == 'started':
+            inst.state = "running"
+            if inst.writer is None:
+                inst.writer = storage.OutputWriter(
+                    os.path.join(self.output, inst.name + ".csv"),
+                    sync_interval=self.sync_interval, telemetry=self.telemetry)
+            inst.writer.begin_run(**payload)
+            inst.cycle_id = 0
+            inst.points = 0
+        elif kind == 'time':
+            inst.time_remaining = payload
+        elif kind == 'peaks':
+            # The points of the cycle were written before its peaks
+            self.drain(inst)
+            inst.peaks = sum(len(table) for table in payload)
+            inst.writer.write_peaks(inst.cycle_id, payload)
+        elif kind == 'finished':
+            self.drain(inst)
+            inst.writer.end_cycle(inst.cycle_id)
+            inst.cycle_id += 1
+            inst.cycle_points = inst.points
+            inst.points = 0
+            inst.stats = payload
+            self.telemetry.counter("supervisor_cycles_total", "Cycles recorded",
+                                   instrument=inst.name).inc()
+        elif kind == 'error':
+            inst.error = payload
+            print("!! WARN: {name} failed: {err}".format(name=inst.name, err=payload))
+        elif kind == 'stopped':
+            self.drain(inst)
+            inst.state = "stopped" if inst.error is None else "failed"
+
+    def check_process(self, inst):
+        """Notice instrument processes that exited and restart them if asked"""
+        if inst.process is None or inst.process.is_alive():
+            return
+        if inst.t_exit is None:
+            inst.t_exit = time.monotonic()
+            self.drain(inst)
+            inst.ring.close()
+            inst.ring = None
+            if inst.stop_event.is_set() == False:
+                inst.state = "failed"
+                print("!! WARN: {name} exited with code {code}".format(
+                    name=inst.name, code=inst.process.exitcode))
+        if (self.restart == True and inst.stop_event.is_set() == False and
+                time.monotonic() - inst.t_exit >= RESTART_DELAY):
+            inst.restarts += 1
+            inst.t_exit = None
+            print("# Restarting", inst.name)
+            self.launch(inst)
+
+    def stop(self):
+        """Stop every instrument and close its output"""
+        for inst in self.instruments:
+            if inst.stop_event is not None:
+                inst.stop_event.set()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for inst in self.instruments:
+            if inst.process is None:
+                continue
+            inst.process.join(max(0, deadline - time.monotonic()))
+            if inst.process.is_alive():
+                print("!! WARN: Terminating", inst.name)
+                inst.process.terminate()
+                inst.process.join()
+        # Events and points sent before the processes ended
+        self.poll(timeout=0)
+        for inst in self.instruments:
+            if inst.writer is not None:
+                inst.writer.close()
+                inst.writer = None
+
+    def status(self):
+        """One line per instrument"""
+        now = time.monotonic()
+        interval = max(now - self._t_status, 1e-9)
+        self._t_status = now
+        lines = ["# {:<12} {:<9} {:>6} {:>8} {:>9} {:>9} {:>6} {:>10} {:>8}".format(
+            "instrument", "state", "cycle", "points", "points/s", "remaining",
+            "peaks", "late p99", "overruns")]
+        for inst in self.instruments:
+            rate = (inst.points_total - inst.points_reported)/interval
+            inst.points_reported = inst.points_total
+            remaining = "-"
+            if inst.time_remaining is not None:
+                remaining = "{:.0f} s".format(inst.time_remaining)
+            late = "-"
+            if inst.stats.get('lateness_p99') is not None:
+                late = "{:.2f} ms".format(inst.stats['lateness_p99']*1e3)
+            overruns = inst.ring.overruns if inst.ring is not None else 0
+            state = inst.state
+            if inst.writer is not None and inst.writer.error is not None:
+                # Still acquiring, but nothing is saved
+                state = "no output"
+            lines.append("# {:<12} {:<9} {:>6} {:>8} {:>9.1f} {:>9} {:>6} {:>10} {:>8}".format(
+                inst.name, state, inst.cycle_id, inst.cycle_points, rate,
+                remaining, inst.peaks, late, overruns))
+        return "\n".join(lines)
+
+    def run(self, status_interval=STATUS_INTERVAL_DEFAULT):
+        """Supervise until interrupted, printing the status regularly"""
+        t_status = time.monotonic()
+        while True:
+            self.poll()
+            if time.monotonic() - t_status >= status_interval:
+                t_status = time.monotonic()
+                print(self.status())
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="chromatographer.py supervisor",
+                            description="Acquire several instruments, one "
+                                        "process each, recording them all")
+    parser.add_argument('instruments',
+                        help="JSON file of instrument names and their options")
+    parser.add_argument('-o', '--output', type=str, default=".",
+                        help="Directory of the output files, <name>.csv per instrument")
+    parser.add_argument('--pin', action="store_true",
+                        help="Pin each instrument process to a CPU of its own")
+    parser.add_argument('--restart', action="store_true",
+                        help="Restart instrument processes that exit")
+    parser.add_argument('--status-interval', type=float,
+                        default=STATUS_INTERVAL_DEFAULT,
+                        help="Seconds between status lines")
+    parser.add_argument('--sync-interval', type=float,
+                        default=storage.SYNC_INTERVAL_DEFAULT,
+                        help="Seconds between syncs of the output to disk")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Write metrics in the Prometheus text format to this file")
+    parser.add_argument('--metrics-interval', type=float,
+                        default=METRICS_INTERVAL_DEFAULT,
+                        help="Seconds between writes of the metrics file")
+    args = parser.parse_args(argv)
+
+    supervisor = Supervisor(parse_instruments(args.instruments),
+                            output=args.output, pin=args.pin,
+                            restart=args.restart,
+                            sync_interval=args.sync_interval)
+    for inst in supervisor.instruments:
+        print("# {name} : {channels}".format(name=inst.name,
+                                             channels=", ".join(inst.channels)))
+    exporter = None
+    if args.metrics_file is not None:
+        exporter = MetricsExporter(supervisor.telemetry, args.metrics_file,
+                                   args.metrics_interval)
+    supervisor.start()
+    try:
+        supervisor.run(args.status_interval)
+    except KeyboardInterrupt:
+        print("# Stopping")
+    finally:
+        supervisor.stop()
+        if exporter is not None:
+            exporter.stop()
+        print(supervisor.status())
+    return 0
@@ -0,0 +1,267 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+============
+telemetry.py
+============
+
+Timing and performance metrics of the acquisition.
+
+Durations are recorded into fixed bucket histograms, which cost one bisect
+and a few additions per observation, and counts into counters. The metrics
+of a Telemetry registry are printed as a summary (--stats) or written to a
+file in the Prometheus text format (--metrics-file), e.g., for the node
+exporter's textfile collector.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+# Prefix of the exported metric names
+METRIC_PREFIX = "chromatographer_"
+
+# Histogram bucket upper bounds (seconds), 1-2.5-5 steps from 10 us to 100 s
+LATENCY_BUCKETS = [m*10.0**e for e in range(-5, 3) for m in (1, 2.5, 5)]
+
+METRICS_INTERVAL_DEFAULT = 10.0
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels) + "}"
+
+
+class Counter:
+    """Counter
+    Monotonically increasing count.
+    """
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def samples(self, name, labels):
+        return ["{name}{labels} {value}".format(name=name,
+                                                labels=_format_labels(labels),
+                                                value=self.value)]
+
+    def summary(self):
+        return "{}".format(self.value)
+
+
+class Gauge(Counter):
+    """Gauge
+    Value that is set, e.g., a configured rate.
+    """
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def summary(self):
+        return "{:.6g}".format(self.value)
+
+
+class Histogram:
+    """Histogram
+    Distribution of observed values in fixed buckets, with the exact count,
+    sum, minimum and maximum.
+    """
+    kind = "histogram"
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = list(bounds)
+        # One count per bound and one above the last bound
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the body of a with statement"""
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t_start)
+
+    @property
+    def mean(self):
+        return self.sum/self.count if self.count > 0 else float('nan')
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return float('nan')
+        rank = q*self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def samples(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            le = "+Inf" if bound == float('inf') else "{:g}".format(bound)
+            lines.append("{name}_bucket{labels} {n}".format(
+                name=name, labels=_format_labels(labels + (('le', le),)), n=total))
+        lines.append("{name}_sum{labels} {s:.9g}".format(
+            name=name, labels=_format_labels(labels), s=self.sum))
+        lines.append("{name}_count{labels} {n}".format(
+            name=name, labels=_format_labels(labels), n=self.count))
+        return lines
+
+    def summary(self):
+        if self.count == 0:
+            return "n=0"
+        return ("n={n:<7} mean {mean:9.3f} ms, p50 <{p50:9.3f} ms, "
+                "p99 <{p99:9.3f} ms, max {max:9.3f} ms".format(
+                    n=self.count, mean=self.mean*1e3,
+                    p50=self.quantile(0.5)*1e3, p99=self.quantile(0.99)*1e3,
+                    max=self.max*1e3))
+
+
+class Telemetry:
+    """Telemetry
+    Registry of named metrics, created on first use.
+
+    Metrics are identified by their name and labels, e.g.,
+    telemetry.histogram("valve_operation_seconds", operation="set").
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(key, metric_class())
+                if help is not None:
+                    self.help.setdefault(name, help)
+        return metric
+
+    def counter(self, name, help=None, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help=None, **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help=None, **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def time(self, name, help=None, **labels):
+        """Context manager observing a duration into the named histogram"""
+        return self.histogram(name, help, **labels).time()
+
+    def _snapshot(self):
+        """Sorted ((name, labels), metric) items and the help texts, copied
+        under the lock as other threads may be adding metrics
+        """
+        with self._lock:
+            items, help = list(self.metrics.items()), dict(self.help)
+        return sorted(items, key=lambda item: item[0]), help
+
+    def format_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        items, help = self._snapshot()
+        for (name, labels), metric in items:
+            full_name = METRIC_PREFIX + name
+            if name not in described:
+                described.add(name)
+                if name in help:
+                    lines.append("# HELP {} {}".format(full_name, help[name]))
+                lines.append("# TYPE {} {}".format(full_name, metric.kind))
+            lines.extend(metric.samples(full_name, labels))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """One line per metric, as printed by --stats"""
+        lines = ["# Statistics"]
+        items, help = self._snapshot()
+        for (name, labels), metric in items:
+            lines.append("#   {name:<40} {value}".format(
+                name=name + _format_labels(labels), value=metric.summary()))
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Write the metrics to path, replacing it atomically"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.format_prometheus())
+        os.replace(tmp_path, path)
+
+
+class MetricsExporter:
+    """MetricsExporter
+    Writes the metrics of a Telemetry registry to a file every interval
+    seconds from a background thread, and once more when stopped.
+    """
+    def __init__(self, telemetry, path, interval=METRICS_INTERVAL_DEFAULT):
+        self.telemetry = telemetry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while True:
+            deadline += self.interval
+            stopped = self._stop.wait(max(0.0, deadline - time.monotonic()))
+            try:
+                self.telemetry.write(self.path)
+            except Exception as err:
+                # Kept running, the next write may succeed
+                print("!! WARN: Could not write metrics: {}".format(err))
+            if stopped == True:
+                break
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,47 @@
+import numpy
+import pytest
+
+from adaptive import AdaptiveGate
+from peaks import slope_noise
+
+
+def cycle(dt, duration=120.0):
+    rng = numpy.random.default_rng(5)
+    t = numpy.arange(0, duration, dt)
+    y = rng.normal(0, 0.005, len(t))
+    y += numpy.exp(-0.5*((t - 60)/0.5)**2)
+    return t, y
+
+
+def run(gate, t, y, step):
+    keep = [gate.update(t[:i], y[:i]) for i in range(step, len(t) + 1, step)]
+    keep.append(gate.finish(t, y))
+    return numpy.concatenate(keep)
+
+
+@pytest.mark.parametrize("dt", [0.001, 0.01, 0.5])
+def test_peak_kept_at_any_rate(dt):
+    t, y = cycle(dt)
+    keep = run(AdaptiveGate(), t, y, max(1, int(0.1/dt)))
+    # Every point once, in order, ending with the last
+    assert (numpy.diff(keep) > 0).all()
+    assert keep[-1] == len(t) - 1
+    peak = numpy.flatnonzero(abs(t - 60) < 1)
+    assert numpy.isin(peak, keep).all()
+    assert len(keep) < 0.6*len(t)
+
+
+def test_points_sent_before_noise_known():
+    t, y = cycle(0.5)
+    gate = AdaptiveGate(baseline=20.0)
+    assert gate.update(t[:3], y[:3]).tolist() == [0, 1, 2]
+    assert gate.slope_threshold is None
+
+
+def test_slope_noise_ignores_peak():
+    rng = numpy.random.default_rng(6)
+    slopes = rng.normal(size=1000)
+    slopes[:400] += numpy.linspace(5, 50, 400)
+    assert slope_noise(slopes) == pytest.approx(1.0, rel=0.15)
+    assert slope_noise(numpy.column_stack((slopes, 2*slopes))) == \
+        pytest.approx([1.0, 2.0], rel=0.15)
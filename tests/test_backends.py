@@ -0,0 +1,16 @@
+from backends import SIM_INJECTION_MASK, open_devices
+
+
+def test_injection_shared_by_devices_opened_together():
+    first = open_devices('simulated', ["Sim1/ai1", "Sim2/ai1"], noise=0.0)
+    other = open_devices('simulated', ["Sim3/ai1", "Sim4/ai1"], noise=0.0)
+    try:
+        first[0].write_port(SIM_INJECTION_MASK)
+        assert first[1].injection.t == first[0].injection.t
+        assert first[1].injection.t is not None
+        # Devices opened apart are fed by another sample
+        assert other[0].injection.t is None
+        assert other[1].injection.t is None
+    finally:
+        for backend in first + other:
+            backend.close()
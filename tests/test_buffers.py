@@ -0,0 +1,129 @@
+import numpy
+
+from buffers import BlockQueue, CycleBuffer, RingBuffer, SharedRingBuffer
+
+
+def samples(start, n):
+    t = numpy.arange(start, start + n, dtype=float)
+    return t, 10*t
+
+
+def test_cycle_buffer_grows():
+    cycle = CycleBuffer(4)
+    cycle.extend(*samples(0, 3))
+    before = cycle.t
+    cycle.append(3.0, 30.0)
+    cycle.extend(*samples(4, 5))
+    assert cycle.capacity >= 9
+    assert cycle.t.tolist() == list(range(9))
+    numpy.testing.assert_array_equal(cycle.y, 10*cycle.t)
+    # Views taken before growing keep their contents
+    assert before.tolist() == [0, 1, 2]
+
+
+def test_cycle_buffer_reset_keeps_allocation():
+    cycle = CycleBuffer(4, channels=2)
+    t = numpy.arange(6.0)
+    cycle.extend(t, numpy.column_stack((t, -t)))
+    capacity = cycle.capacity
+    numpy.testing.assert_array_equal(cycle.channel(1), -t)
+    cycle.reset()
+    assert len(cycle) == 0
+    assert cycle.capacity == capacity
+    cycle.extend(t[:2], numpy.column_stack((t[:2], t[:2])))
+    assert cycle.y.shape == (2, 2)
+
+
+def test_ring_buffer_wraps():
+    ring = RingBuffer(10)
+    ring.write(*samples(0, 6))
+    assert ring.read(timeout=0)[0].tolist() == list(range(6))
+    ring.write(*samples(6, 8))
+    t, y = ring.read(timeout=0)
+    assert t.tolist() == list(range(6, 14))
+    numpy.testing.assert_array_equal(y, 10*t)
+    assert ring.overruns == 0
+
+
+def test_ring_buffer_overruns():
+    ring = RingBuffer(10)
+    ring.write(*samples(0, 8))
+    ring.write(*samples(8, 8))
+    assert len(ring) == 10
+    t, y = ring.read(timeout=0)
+    assert t.tolist() == list(range(6, 16))
+    assert ring.overruns == 6
+
+
+def test_ring_buffer_write_larger_than_capacity():
+    ring = RingBuffer(10)
+    ring.write(*samples(0, 3))
+    ring.write(*samples(3, 25))
+    t, y = ring.read(timeout=0)
+    assert t.tolist() == list(range(18, 28))
+    assert ring.overruns == 18
+
+
+def test_ring_buffer_channels():
+    ring = RingBuffer(4, channels=2)
+    t = numpy.arange(6.0)
+    y = numpy.column_stack((t, -t))
+    ring.write(t, y)
+    t, y = ring.read(timeout=0)
+    assert y.shape == (4, 2)
+    numpy.testing.assert_array_equal(y[:, 1], -t)
+
+
+def test_shared_ring_buffer_overruns():
+    ring = SharedRingBuffer(10)
+    try:
+        producer = SharedRingBuffer(10, name=ring.name)
+        producer.write(*samples(0, 6))
+        assert ring.read()[0].tolist() == list(range(6))
+        producer.write(*samples(6, 8))
+        producer.write(*samples(14, 8))
+        t, y = ring.read()
+        assert t.tolist() == list(range(12, 22))
+        numpy.testing.assert_array_equal(y, 10*t)
+        assert ring.overruns == 6
+        # Larger than the buffer, the oldest are lost as they are written
+        producer.write(*samples(22, 25))
+        t, y = ring.read()
+        assert t.tolist() == list(range(37, 47))
+        numpy.testing.assert_array_equal(y, 10*t)
+        assert ring.overruns == 6 + 15
+        producer.close()
+    finally:
+        ring.close()
+
+
+def test_shared_ring_buffer_write_in_progress():
+    ring = SharedRingBuffer(10)
+    try:
+        producer = SharedRingBuffer(10, name=ring.name)
+        producer.write(*samples(0, 10))
+        # A write of 4 samples has reserved its slots but not yet published
+        producer._reserved[0] = 14
+        t, y = ring.read()
+        assert t.tolist() == list(range(4, 10))
+        assert ring.overruns == 4
+        producer.close()
+    finally:
+        ring.close()
+
+
+def test_block_queue_next_cycle_pending():
+    blocks = BlockQueue()
+    blocks.put(numpy.arange(3.0), numpy.zeros(3), 1.0)
+    assert blocks.notify() == True
+    blocks.end_cycle()
+    blocks.put(numpy.arange(3.0, 5.0), numpy.ones(2), 2.0)
+    # Already notified, the samples of the next cycle wait for the consumer
+    assert blocks.notify() == False
+    t, y, t_first = blocks.take()
+    assert list(t) == [0.0, 1.0, 2.0]
+    assert blocks.next_cycle() == True
+    t, y, t_first = blocks.take()
+    assert list(t) == [3.0, 4.0]
+    assert t_first == 2.0
+    assert blocks.next_cycle() == False
@@ -0,0 +1,57 @@
+import io
+
+import daemon
+
+
+class Client:
+    """Stands in for daemon._Client, keeping the frames sent"""
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    def send(self, frame):
+        # None closes the connection
+        if frame is not None:
+            self.frames.append(frame)
+        return True
+
+    def messages(self):
+        f = io.BytesIO(b''.join(self.frames))
+        messages = []
+        while True:
+            frame = daemon.read_frame(f)
+            if frame is None:
+                return messages
+            messages.append((frame[0], daemon.decode(*frame)))
+
+
+def test_first_message_before_published():
+    publisher = daemon.Publisher()
+    status = {'running' : False}
+    client = Client()
+    try:
+        publisher.publish(daemon.MSG_TIME, 1.0)
+        publisher.add(client, first=lambda: (daemon.MSG_STATUS, dict(status)))
+        # A status change published right after the client was added
+        status['running'] = True
+        publisher.publish(daemon.MSG_STATUS, dict(status))
+        publisher.publish(daemon.MSG_TIME, 2.0)
+    finally:
+        publisher.close()
+    messages = client.messages()
+    assert messages[0][0] == daemon.MSG_STATUS
+    assert messages[1:] == [(daemon.MSG_STATUS, {'running' : True}),
+                            (daemon.MSG_TIME, 2.0)]
+
+
+def test_closed_client_not_added():
+    publisher = daemon.Publisher()
+    client = Client()
+    client.closed = True
+    try:
+        publisher.add(client)
+        publisher.publish(daemon.MSG_TIME, 1.0)
+    finally:
+        publisher.close()
+    assert client.frames == []
+    assert publisher.clients == []
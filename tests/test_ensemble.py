@@ -0,0 +1,50 @@
+import numpy
+
+from ensemble import Ensemble
+
+
+def test_welford_matches_numpy():
+    rng = numpy.random.default_rng(2)
+    cycles = [rng.normal(5, 2, size=n) for n in (50, 50, 30, 50, 45)]
+    ensemble = Ensemble(40)
+    for y in cycles:
+        ensemble.update(numpy.arange(len(y)), y)
+    assert len(ensemble) == 40
+    assert ensemble.cycles == 5
+    for i in range(40):
+        values = [y[i] for y in cycles if len(y) > i]
+        assert ensemble.count[i] == len(values)
+        numpy.testing.assert_allclose(ensemble.mean[i], numpy.mean(values))
+        numpy.testing.assert_allclose(ensemble.variance[i], numpy.var(values, ddof=1))
+
+
+def test_welford_channels():
+    rng = numpy.random.default_rng(3)
+    cycles = rng.normal(size=(4, 20, 2))
+    ensemble = Ensemble(20, channels=2)
+    for y in cycles:
+        ensemble.update(numpy.arange(20), y)
+    numpy.testing.assert_allclose(ensemble.mean, cycles.mean(axis=0))
+    numpy.testing.assert_allclose(ensemble.variance, cycles.var(axis=0, ddof=1))
+
+
+def test_single_cycle_variance_undefined():
+    ensemble = Ensemble(5)
+    ensemble.update(numpy.arange(5), numpy.ones(5))
+    assert numpy.isnan(ensemble.variance).all()
+    numpy.testing.assert_array_equal(ensemble.baseline, numpy.ones(5))
+
+
+def test_ewma_baseline_and_band():
+    ensemble = Ensemble(3, alpha=0.5)
+    for level in (1.0, 3.0, 5.0):
+        ensemble.update(numpy.arange(3), numpy.full(3, level))
+    # 1, then 1 + 0.5*(3 - 1) = 2, then 2 + 0.5*(5 - 2) = 3.5
+    numpy.testing.assert_allclose(ensemble.baseline, 3.5)
+    lower, upper = ensemble.band(z=1.0)
+    numpy.testing.assert_allclose(upper - ensemble.mean, 2/numpy.sqrt(3))
+    numpy.testing.assert_allclose(ensemble.mean - lower, 2/numpy.sqrt(3))
+    assert ensemble.table().shape == (3, 5)
+    ensemble.reset()
+    assert len(ensemble) == 0
+    assert ensemble.cycles == 0
@@ -0,0 +1,68 @@
+import numpy
+import pytest
+
+from filters import parse_filter
+
+SPECS = ["boxcar:10", "median:5,boxcar:4", "cic:16:3", "fir:4", "cic:8:3,fir:4"]
+
+
+def split(x, sizes):
+    bounds = numpy.cumsum(sizes)
+    return numpy.split(x, bounds[bounds < x.shape[-1]], axis=-1)
+
+
+@pytest.mark.parametrize("spec", SPECS)
+@pytest.mark.parametrize("sizes", [[1], [7, 1, 33], [100, 3, 250, 1000]])
+def test_block_invariance(spec, sizes):
+    x = numpy.random.default_rng(0).normal(size=2048)
+    whole = parse_filter(spec).process(x)
+    chain = parse_filter(spec)
+    blocks = [chain.process(block) for block in split(x, sizes*len(x))]
+    numpy.testing.assert_allclose(numpy.concatenate(blocks), whole)
+    assert len(whole) == len(x)//chain.decimation
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_channels_filtered_independently(spec):
+    x = numpy.random.default_rng(1).normal(size=(3, 512))
+    both = parse_filter(spec).process(x)
+    for i in range(3):
+        numpy.testing.assert_allclose(both[i], parse_filter(spec).process(x[i]))
+
+
+@pytest.mark.parametrize("spec", SPECS)
+def test_support(spec):
+    support = parse_filter(spec).support
+    decimation = parse_filter(spec).decimation
+    n = -(-support//decimation)*decimation
+    x = numpy.full(n, 2.0)
+    # Samples before the support do not reach the last output
+    x[:n - support] = 100.0
+    assert parse_filter(spec).process(x)[-1] == pytest.approx(2.0)
+    if spec.startswith("median"):
+        # Rejects the single spike
+        return
+    x[n - support] = 100.0
+    assert parse_filter(spec).process(x)[-1] != pytest.approx(2.0)
+
+
+def test_unknown_filter():
+    with pytest.raises(ValueError):
+        parse_filter("boxcar:4,gauss:3")
+
+
+@pytest.mark.parametrize("spec, samples", [(None, 10), ("cic:16:3,fir:4", 576)])
+def test_polled_reads_cover_support(spec, samples):
+    from backends import open_devices
+    import chromatographer as cg
+
+    channels = ["Sim1/ai1"]
+    worker = cg.Chromatographer("Sim1", 10, 2, 0.1, channels=channels,
+                                backend=open_devices('simulated', channels),
+                                filter=spec)
+    try:
+        assert worker.polled_samples == samples
+        assert worker.polled_samples >= worker.filter.support
+        assert worker.polled_samples % worker.oversample == 0
+    finally:
+        worker.close_tasks()
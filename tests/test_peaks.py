@@ -0,0 +1,61 @@
+import numpy
+import pytest
+
+from peaks import PeakDetector, integrate_peak
+
+AREA = 2.0
+WIDTH = 0.5
+
+
+def chromatogram(dt, duration=30.0, rt=(10.0, 20.0), noise=0.001, drift=0.01):
+    rng = numpy.random.default_rng(7)
+    t = numpy.arange(0, duration, dt)
+    y = rng.normal(0, noise, len(t)) + drift*t
+    for r in rt:
+        y += AREA/(WIDTH*numpy.sqrt(2*numpy.pi))*numpy.exp(-0.5*((t - r)/WIDTH)**2)
+    return t, y
+
+
+@pytest.mark.parametrize("dt", [0.001, 0.01, 0.1])
+def test_peaks_found_at_any_rate(dt):
+    t, y = chromatogram(dt)
+    peaks = PeakDetector(sample_delta=dt).finish(t, y)
+    assert len(peaks) == 2
+    numpy.testing.assert_allclose(peaks['retention_time'], [10.0, 20.0], atol=0.05)
+    numpy.testing.assert_allclose(peaks['area'], AREA, rtol=0.05)
+
+
+def test_incremental_matches_whole():
+    t, y = chromatogram(0.01)
+    whole = PeakDetector().finish(t, y)
+    detector = PeakDetector()
+    for n in range(1, len(t), 37):
+        detector.update(t[:n], y[:n])
+    numpy.testing.assert_array_equal(detector.finish(t, y), whole)
+
+
+def test_high_sample_rate():
+    # The smoothing spans more samples than the initial arrays
+    dt = 2e-5
+    # Averaged over many samples the noise is below the slope of any drift
+    t, y = chromatogram(dt, duration=5.0, rt=(3.0,), noise=1e-4, drift=0)
+    detector = PeakDetector(sample_delta=dt, baseline=0.5)
+    for n in range(5000, len(t), 50000):
+        detector.update(t[:n], y[:n])
+    peaks = detector.finish(t, y)
+    assert len(peaks) == 1
+    assert peaks['retention_time'][0] == pytest.approx(3.0, abs=0.01)
+
+
+def test_noise_only():
+    t, y = chromatogram(0.01, rt=())
+    assert len(PeakDetector().finish(t, y)) == 0
+
+
+def test_integrate_above_sloped_baseline():
+    t = numpy.linspace(0, 2, 201)
+    y = 1 + t + numpy.where(abs(t - 1) < 0.5, 0.5 - abs(t - 1), 0)
+    peak = integrate_peak(t, y, 0, 200)
+    assert peak['retention_time'] == pytest.approx(1.0)
+    assert peak['height'] == pytest.approx(0.5)
+    assert peak['area'] == pytest.approx(0.25, rel=1e-3)
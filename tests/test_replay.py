@@ -0,0 +1,24 @@
+import pytest
+
+from replay import Replay
+
+
+def test_settings_inferred_without_header(tmp_path):
+    path = tmp_path / "output.csv"
+    path.write_text("0, 0.0, 0.1\n0, 0.5, 0.2\n0, 1.0, 0.3\n1, 0.0, 0.1\n")
+    replay = Replay(str(path), speed=None)
+    assert replay.metadata['sample_delta'] == pytest.approx(0.5)
+    assert replay.metadata['sample_window'] == pytest.approx(1.5)
+    worker = replay.create_worker()
+    try:
+        replay.run(worker)
+    finally:
+        worker.close_tasks()
+
+
+@pytest.mark.parametrize("text", ["", "0, 0.0, 0.1\n"])
+def test_too_few_points(tmp_path, text):
+    path = tmp_path / "output.csv"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        Replay(str(path))
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Cancelled, Scheduler
+
+# Long enough that a wait overshooting on a loaded machine stays within the
+# period
+PERIOD = 0.2
+
+
+def test_overrun_keeps_to_grid():
+    scheduler = Scheduler(PERIOD)
+    scheduler.start(delay=0)
+    first = scheduler.next_start
+    # Overrun by more than two periods, more if the sleep overshoots
+    time.sleep(2.5*PERIOD)
+    assert scheduler.wait_for_cycle() == True
+    missed = scheduler.missed
+    assert missed >= 3
+    elapsed = scheduler.next_start - first
+    assert elapsed == pytest.approx((missed + 1)*PERIOD)
+    assert time.monotonic() >= first + missed*PERIOD
+
+
+def test_on_time_cycles_not_missed():
+    scheduler = Scheduler(PERIOD)
+    scheduler.start()
+    first = scheduler.next_start
+    for i in range(3):
+        assert scheduler.wait_for_cycle(tick=PERIOD/5) == True
+    assert scheduler.missed == 0
+    assert scheduler.next_start == pytest.approx(first + 3*PERIOD)
+
+
+def test_stop_wakes_wait():
+    scheduler = Scheduler(60)
+    scheduler.start()
+    threading.Timer(0.05, scheduler.stop).start()
+    t0 = time.monotonic()
+    assert scheduler.wait_for_cycle() == False
+    assert time.monotonic() - t0 < 5
+    with pytest.raises(Cancelled):
+        scheduler.check()
@@ -0,0 +1,230 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+import storage
+from storage import (ArchiveReader, OutputWriter, archive_path, archive_to_csv,
+                     csv_to_archive, iter_cycles, peaks_path,
+                     read_output_file, rebuild_index, split_cycles)
+
+METADATA = dict(date="Mon Jan  6 00:00:00 2025", sample_window=0.1,
+                sample_delta=0.5, cycle_time=1.0)
+
+
+def cycles(channels=1, n_cycles=3, n=40):
+    rng = numpy.random.default_rng(4)
+    shape = (n,) if channels == 1 else (n, channels)
+    return [(i, 0.5*numpy.arange(n), rng.normal(size=shape).round(6))
+            for i in range(n_cycles)]
+
+
+def record(path, runs, channels=1, **kwargs):
+    writer = OutputWriter(str(path), **kwargs)
+    for metadata, run in runs:
+        writer.begin_run(**metadata)
+        for cycle_id, t, y in run:
+            # Samples arrive in blocks
+            for start in range(0, len(t), 7):
+                writer.write_samples(cycle_id, t[start:start + 7], y[start:start + 7])
+            writer.write_peaks(cycle_id, [[(1.0, 0.5, 1.5, 0.2, 0.1, 0.5)]]*channels)
+            writer.end_cycle(cycle_id)
+    writer.close()
+    assert writer.error is None
+    return writer
+
+
+def assert_cycles_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for (id_a, t_a, y_a), (id_e, t_e, y_e) in zip(actual, expected):
+        assert id_a == id_e
+        numpy.testing.assert_allclose(t_a, t_e)
+        numpy.testing.assert_allclose(y_a, y_e)
+
+
+@pytest.mark.parametrize("channels", [1, 2])
+def test_output_writer_round_trip(tmp_path, channels):
+    path = tmp_path / "out.csv"
+    names = None if channels == 1 else ["ch{}".format(i) for i in range(channels)]
+    runs = [(dict(METADATA, channels=names), cycles(channels)),
+            (dict(METADATA, channels=names), cycles(channels, n_cycles=2, n=10))]
+    record(path, runs, channels=channels)
+
+    read = read_output_file(str(path))
+    assert len(read) == 2
+    for (metadata, data), (expected_metadata, expected) in zip(read, runs):
+        assert metadata['sample_delta'] == METADATA['sample_delta']
+        assert_cycles_equal(split_cycles(data), expected)
+
+    reader = ArchiveReader(archive_path(str(path)))
+    assert reader.runs() == [0, 1]
+    for run_id, (metadata, expected) in enumerate(runs):
+        assert reader.metadata(run_id)['cycle_time'] == METADATA['cycle_time']
+        assert_cycles_equal([(c,) + reader.read_cycle(run_id, c)
+                             for c in reader.cycles(run_id)], expected)
+    reader.close()
+
+    with open(peaks_path(str(path))) as f:
+        rows = [line for line in f if not line.startswith('#')]
+    assert len(rows) == channels*5
+
+
+def test_iter_cycles_joins_blocks(tmp_path):
+    path = tmp_path / "out.csv"
+    runs = [(METADATA, cycles()), (METADATA, cycles(n_cycles=2))]
+    record(path, runs)
+    # Blocks much smaller than a cycle
+    streamed = list(iter_cycles(str(path), block_size=256))
+    assert [(run, cycle_id) for run, _, cycle_id, _, _ in streamed] == \
+        [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1)]
+    assert_cycles_equal([row[2:] for row in streamed[:3]], runs[0][1])
+
+
+def test_csv_archive_conversion(tmp_path):
+    path = tmp_path / "out.csv"
+    expected = cycles()
+    record(path, [(METADATA, expected)])
+    converted = tmp_path / "converted.cga"
+    assert csv_to_archive(str(path), str(converted)) == 3
+    exported = tmp_path / "exported.csv"
+    assert archive_to_csv(str(converted), str(exported)) == 3
+    (metadata, data), = read_output_file(str(exported))
+    assert metadata['sample_window'] == METADATA['sample_window']
+    assert_cycles_equal(split_cycles(data), expected)
+
+
+def test_rebuild_index_drops_truncated_cycle(tmp_path):
+    path = tmp_path / "out.csv"
+    record(path, [(METADATA, cycles())])
+    archive = archive_path(str(path))
+    with open(archive, 'r+b') as f:
+        f.seek(-8, 2)
+        f.truncate()
+    index = rebuild_index(archive)
+    assert (index['cycle'] != storage.RUN_ENTRY).sum() == 2
+
+
+def test_rebuild_index_matches_written(tmp_path):
+    path = tmp_path / "out.csv"
+    record(path, [(METADATA, cycles(2)), (METADATA, cycles(2, n_cycles=2))],
+           channels=2)
+    archive = archive_path(str(path))
+    written = numpy.fromfile(archive + storage.INDEX_EXT,
+                             dtype=storage.INDEX_DTYPE)
+    numpy.testing.assert_array_equal(rebuild_index(archive), written)
+    reader = ArchiveReader(archive)
+    # Read out of order through the rebuilt index
+    t, y = reader.read_cycle(1, 1)
+    assert_cycles_equal([(1, t, y)], cycles(2, n_cycles=2)[1:])
+    reader.close()
+
+
+def test_stopped_cycle_archived(tmp_path):
+    path = tmp_path / "out.csv"
+    (_, t, y), (_, t_stopped, y_stopped) = cycles(n_cycles=2)
+    writer = OutputWriter(str(path))
+    writer.begin_run(**METADATA)
+    writer.write_samples(0, t, y)
+    writer.end_cycle(0)
+    # Stopped part way, without an end
+    writer.write_samples(1, t_stopped[:10], y_stopped[:10])
+    writer.close()
+    (metadata, data), = read_output_file(str(path))
+    expected = [(0, t, y), (1, t_stopped[:10], y_stopped[:10])]
+    assert_cycles_equal(split_cycles(data), expected)
+    reader = ArchiveReader(archive_path(str(path)))
+    assert_cycles_equal([(c,) + reader.read_cycle(0, c) for c in reader.cycles(0)],
+                        expected)
+    reader.close()
+
+
+def slow(write):
+    def slow_write(items):
+        time.sleep(0.02)
+        write(items)
+    return slow_write
+
+
+def test_full_queue_drops_samples_only(tmp_path):
+    path = tmp_path / "out.csv"
+    writer = OutputWriter(str(path), queue_size=1)
+    writer._write = slow(writer._write)
+    writer.begin_run(**METADATA)
+    for cycle_id, t, y in cycles(n_cycles=5):
+        for start in range(0, len(t), 4):
+            writer.write_samples(cycle_id, t[start:start + 4], y[start:start + 4])
+        writer.write_peaks(cycle_id, [[(1.0, 0.5, 1.5, 0.2, 0.1, 0.5)]])
+        writer.end_cycle(cycle_id)
+    writer.close()
+    assert writer.dropped > 0
+    assert writer.error is None
+    with open(peaks_path(str(path))) as f:
+        assert [line.split(',')[0] for line in f
+                if not line.startswith('#')] == ["0", "1", "2", "3", "4"]
+    (metadata, data), = read_output_file(str(path))
+    assert len(data) == 5*40 - 4*writer.dropped
+
+
+def test_rotation_before_run_adds_no_run(tmp_path):
+    path = tmp_path / "out.csv"
+    runs = [(METADATA, cycles(n_cycles=1)), (METADATA, cycles(n_cycles=2))]
+    # Every cycle end rotates
+    record(path, runs, max_bytes=1)
+    rotated = storage.rotated_path(str(path), 1)
+    (metadata, data), = read_output_file(rotated)
+    assert_cycles_equal(split_cycles(data), runs[1][1][:1])
+    reader = ArchiveReader(archive_path(rotated))
+    assert reader.runs() == [0]
+    reader.close()
+    assert [run for run, _, _, _, _ in iter_cycles(str(path))] == [0]
+
+
+def test_caller_never_waits(tmp_path):
+    path = tmp_path / "out.csv"
+    writer = OutputWriter(str(path), queue_size=2)
+    started, release = threading.Event(), threading.Event()
+    write = writer._write
+
+    def blocked(items):
+        started.set()
+        release.wait()
+        write(items)
+    writer._write = blocked
+    writer.begin_run(**METADATA)
+    assert started.wait(5)
+    # The disk is stuck, nothing below waits for it
+    t0 = time.monotonic()
+    for cycle_id, t, y in cycles(n_cycles=5):
+        writer.write_samples(cycle_id, t, y)
+        writer.write_peaks(cycle_id, [[(1.0, 0.5, 1.5, 0.2, 0.1, 0.5)]])
+        writer.end_cycle(cycle_id)
+    closed = threading.Event()
+    writer.close(wait=False, callback=lambda writer: closed.set())
+    assert time.monotonic() - t0 < 0.5
+    assert closed.is_set() == False
+    release.set()
+    assert closed.wait(5)
+    assert writer.dropped == 3
+    with open(peaks_path(str(path))) as f:
+        assert len([line for line in f if not line.startswith('#')]) == 5
+    (metadata, data), = read_output_file(str(path))
+    assert len(data) == 2*40
+
+
+def test_write_error_stops_output(tmp_path):
+    path = tmp_path / "out.csv"
+    writer = OutputWriter(str(path), queue_size=1)
+
+    def fail(items):
+        raise OSError("disk full")
+    writer._write = fail
+    writer.begin_run(**METADATA)
+    t0 = time.monotonic()
+    for cycle_id, t, y in cycles(n_cycles=20):
+        writer.write_samples(cycle_id, t, y)
+        writer.end_cycle(cycle_id)
+    writer.close()
+    assert isinstance(writer.error, OSError)
+    assert writer.dropped > 0
+    assert time.monotonic() - t0 < 5
@@ -0,0 +1,37 @@
+import os
+import signal
+import threading
+import time
+
+from supervisor import Supervisor
+
+INSTRUMENTS = {
+    'gc1': "-b simulated -c 3 -T 2 -t 0.01",
+    'gc2': "-b simulated -c 3 -T 2 -t 0.01",
+}
+
+
+def test_stop_after_interrupt(tmp_path):
+    supervisor = Supervisor(INSTRUMENTS, output=str(tmp_path))
+    supervisor.start()
+    try:
+        deadline = time.monotonic() + 60
+        while any(inst.state != "running" for inst in supervisor.instruments):
+            assert time.monotonic() < deadline
+            supervisor.poll()
+        # Ctrl-C is sent to the instruments as well as the supervisor
+        for inst in supervisor.instruments:
+            os.kill(inst.process.pid, signal.SIGINT)
+        t_end = time.monotonic() + 1
+        while time.monotonic() < t_end:
+            supervisor.poll()
+        assert all(inst.process.is_alive() for inst in supervisor.instruments)
+    finally:
+        stopping = threading.Thread(target=supervisor.stop, daemon=True)
+        stopping.start()
+        stopping.join(30)
+    assert stopping.is_alive() == False
+    for inst in supervisor.instruments:
+        assert inst.process.exitcode == 0
+        assert inst.state == "stopped"
+        assert os.path.exists(os.path.join(str(tmp_path), inst.name + ".csv"))
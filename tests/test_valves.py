@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+from valves import (VALVE_1, VALVE_2, VALVE_4, VALVE_ALL_OFF, ValveProgram,
+                    load_program, parse_valves)
+
+
+def test_waveform_rounds_on_elapsed_time():
+    # Each step is shorter than a sample, rounding each step would lose all
+    program = ValveProgram([(VALVE_1, 0.0004), (VALVE_2, 0.0004)]*5)
+    waveform = program.waveform(rate=1000.0)
+    assert len(waveform) == 4
+    assert set(waveform.tolist()) <= {VALVE_1, VALVE_2}
+
+
+def test_waveform_steps():
+    program = ValveProgram([(VALVE_1, 0.0016), (VALVE_2, 0.0016), (VALVE_ALL_OFF, 0.0018)])
+    waveform = program.waveform(rate=1000.0)
+    assert waveform.tolist() == [VALVE_1]*2 + [VALVE_2]*1 + [VALVE_ALL_OFF]*2
+    assert len(waveform) == round(program.duration*1000.0)
+
+
+def test_empty_program():
+    assert len(ValveProgram([]).waveform()) == 0
+    with pytest.raises(ValueError):
+        ValveProgram.from_dict({'steps': []})
+
+
+def test_negative_duration():
+    with pytest.raises(ValueError):
+        ValveProgram([(VALVE_1, -1)])
+
+
+def test_program_file_round_trip(tmp_path):
+    program = ValveProgram([("valve_4", 2), (["VALVE_1", VALVE_2], 0.5), ("0x00", 1)])
+    assert [valves for valves, duration in program.steps] == \
+        [VALVE_4, VALVE_1|VALVE_2, VALVE_ALL_OFF]
+    path = tmp_path / "flush.json"
+    path.write_text(json.dumps(program.to_dict()))
+    loaded = load_program(str(path))
+    assert loaded.name == "flush"
+    assert loaded.steps == program.steps
+
+
+def test_parse_valves_out_of_range():
+    with pytest.raises(ValueError):
+        parse_valves(0x100)
+    with pytest.raises(ValueError):
+        load_program("no such program")
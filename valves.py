@@ -0,0 +1,413 @@
+# Copyright (c) 2020 David Kalliecharan <david@david.science>
+# Copyright (c) 2020 Andrew George
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+=========
+valves.py
+=========
+
+Valve constants, valve programs and the valve port state.
+
+A valve program is a list of steps, each setting the valves to a mask for a
+duration. Programs are run as a sample clocked digital output waveform on the
+DAQ card when it supports it, otherwise the steps are timed on the host.
+Programs other than the built-in ones are JSON files such as
+
+    {
+        "name"  : "prime",
+        "steps" : [
+            {"valves" : [],                   "duration" : 5},
+            {"valves" : ["VALVE_4"],          "duration" : 2},
+            {"valves" : ["VALVE_4", 64],      "duration" : 5},
+            {"valves" : "0x28",               "duration" : 5}
+        ]
+    }
+
+where valves are given by name, number or a hex string, or a list of them.
+
+ValveState keeps a copy of the port state so that opening or closing single
+valves does not need to read the port first.
+"""
+
+from backends import BufferedOutputUnsupported
+from contextlib import contextmanager
+import glob
+import json
+import numpy
+import os.path
+import threading
+import time
+
+# Valve ID constants for bitwise write operations
+VALVE_ALL_OFF = 0x00
+VALVE_1       = 0x02
+VALVE_2       = 0x04
+VALVE_3       = 0x08
+VALVE_4       = 0x10
+VALVE_5       = 0x20
+VALVE_6       = 0x40
+VALVE_7       = 0x80
+VALVE_ALL_ON = VALVE_1|VALVE_2|VALVE_3|VALVE_4|VALVE_5|VALVE_6|VALVE_7
+
+VALVE_NAMES = {
+    'VALVE_ALL_OFF' : VALVE_ALL_OFF,
+    'VALVE_1'       : VALVE_1,
+    'VALVE_2'       : VALVE_2,
+    'VALVE_3'       : VALVE_3,
+    'VALVE_4'       : VALVE_4,
+    'VALVE_5'       : VALVE_5,
+    'VALVE_6'       : VALVE_6,
+    'VALVE_7'       : VALVE_7,
+    'VALVE_ALL_ON'  : VALVE_ALL_ON,
+}
+
+# Sample clock (Hz) of the digital output waveform, 1 ms resolution
+WAVEFORM_RATE = 1000.0
+
+# Directory searched for program files by name
+PROGRAM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "valve_programs")
+
+
+def parse_valves(valves):
+    """Valve mask from a name, number, hex string or a list of them"""
+    if isinstance(valves, (list, tuple)):
+        mask = VALVE_ALL_OFF
+        for valve in valves:
+            mask |= parse_valves(valve)
+        return mask
+    if isinstance(valves, str):
+        if valves.upper() in VALVE_NAMES:
+            return VALVE_NAMES[valves.upper()]
+        valves = int(valves, 0)
+    if not 0 <= valves <= 0xff:
+        raise ValueError("Valve mask out of range: {}".format(valves))
+    return int(valves)
+
+
+class ValveProgram:
+    """ValveProgram
+    Sequence of (valve mask, duration (s)) steps.
+
+    Each step sets the valves, opening the ones in the mask and closing the
+    rest, and holds them for its duration. The valves are left in the state
+    of the last step, a program without steps leaves them as they are.
+    """
+    def __init__(self, steps, name=None):
+        self.steps = [(parse_valves(valves), float(duration))
+                      for valves, duration in steps]
+        if any(duration < 0 for valves, duration in self.steps):
+            raise ValueError("Valve program step durations MUST NOT be negative")
+        self.name = name
+
+    def __str__(self):
+        return "ValveProgram {name} ({n} steps, {t:g} s)".format(
+            name=self.name, n=len(self.steps), t=self.duration)
+
+    @property
+    def duration(self):
+        """Total duration of the program (seconds)"""
+        return sum(duration for valves, duration in self.steps)
+
+    @classmethod
+    def from_dict(cls, program):
+        if len(program['steps']) == 0:
+            raise ValueError("Valve program has no steps")
+        return cls([(step['valves'], step['duration'])
+                    for step in program['steps']],
+                   name=program.get('name'))
+
+    @classmethod
+    def load(cls, path):
+        """Load a program from a JSON file"""
+        with open(path) as f:
+            program = cls.from_dict(json.load(f))
+        if program.name is None:
+            program.name = os.path.splitext(os.path.basename(path))[0]
+        return program
+
+    def to_dict(self):
+        return {'name'  : self.name,
+                'steps' : [{'valves' : "0x{:02x}".format(valves),
+                            'duration' : duration}
+                           for valves, duration in self.steps]}
+
+    def waveform(self, rate=WAVEFORM_RATE):
+        """Digital output samples of the program at the sample rate (Hz)
+
+        Step boundaries are rounded on the total elapsed time, so rounding
+        does not accumulate over the steps.
+        """
+        masks = numpy.array([valves for valves, duration in self.steps],
+                            dtype=numpy.uint32)
+        ends = numpy.round(numpy.cumsum([duration for valves, duration
+                                         in self.steps])*rate).astype(int)
+        counts = numpy.diff(numpy.concatenate(([0], ends)))
+        return numpy.repeat(masks, counts)
+
+    def execute(self, set_valve, cancel=None):
+        """Run the program on the host, calling set_valve(mask) per step
+        cancel : threading.Event abandoning the program when set
+
+        Steps are timed from monotonic deadlines rather than sleeping for each
+        duration, so the latency of set_valve does not accumulate. Returns
+        False if cancelled.
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        deadline = time.monotonic()
+        for valves, duration in self.steps:
+            if cancel.is_set():
+                return False
+            set_valve(valves)
+            deadline += duration
+            if cancel.wait(max(0.0, deadline - time.monotonic())):
+                return False
+        return True
+
+
+# Priming sequence outlined in the operation schematic
+PRIME_PROGRAM = ValveProgram([
+    (VALVE_ALL_OFF,     5),
+    (VALVE_4,           2),
+    (VALVE_4|VALVE_6,   5),
+    (VALVE_4,           2),
+    (VALVE_2|VALVE_4,   5),
+    (VALVE_4,           2),
+    (VALVE_3|VALVE_5,   5),
+], name="prime")
+
+# Leaves the valves as they are, e.g., when priming is done by hand
+NO_PROGRAM = ValveProgram([], name="none")
+
+PROGRAMS = {
+    PRIME_PROGRAM.name : PRIME_PROGRAM,
+    NO_PROGRAM.name    : NO_PROGRAM,
+}
+
+
+class LatencyCounter:
+    """LatencyCounter
+    Count, mean and maximum duration of an operation, durations are also
+    observed into histogram if given (see telemetry.Histogram).
+    """
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        self.max = max(self.max, dt)
+        self.last = dt
+        if self.histogram is not None:
+            self.histogram.observe(dt)
+
+    @property
+    def mean(self):
+        return self.total/self.count if self.count > 0 else 0.0
+
+    @contextmanager
+    def time(self):
+        """Time the body of a with statement"""
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - t_start)
+
+
+class ValveState:
+    """ValveState
+    Shadow register of the valve port of a DAQ backend.
+
+    Open, close and set are bit operations on the shadow, which is written to
+    the port once per call, or once per transaction when changes are grouped
+    in a transaction. The port is only read on resync.
+
+    Latency counters of each operation are kept in `latency`, and `writes`
+    and `reads` count the port accesses. With a telemetry registry the
+    durations are also recorded as valve_operation_seconds.
+
+    While the device clocks a valve program the port belongs to it: changes
+    made meanwhile are kept as valves to open and close, applied on top of
+    the last state of the program once it ends.
+    """
+    OPERATIONS = ('open', 'close', 'set', 'resync', 'program')
+
+    def __init__(self, daq, hardware_timed=True, telemetry=None):
+        self.daq = daq
+        # Valve programs are clocked by the device until it turns out not to
+        # support buffered digital output
+        self.hardware_timed = hardware_timed
+        self.state = VALVE_ALL_OFF
+        self.writes = 0
+        self.reads = 0
+        self.latency = {}
+        for op in self.OPERATIONS:
+            histogram = None
+            if telemetry is not None:
+                histogram = telemetry.histogram("valve_operation_seconds",
+                                                "Duration of valve operations",
+                                                operation=op)
+            self.latency[op] = LatencyCounter(histogram)
+        self._lock = threading.RLock()
+        # Held for the whole of a program, only one runs at a time
+        self._program_lock = threading.Lock()
+        self._depth = 0
+        self._dirty = False
+        # Valves opened and closed during a hardware timed program, None
+        # when no program is running on the device
+        self._deferred = None
+
+    def resync(self):
+        """Read the port into the shadow, returns the state"""
+        with self._lock, self.latency['resync'].time():
+            self.state = self.daq.read_port() & 0xff
+            self.reads += 1
+            self._dirty = False
+            return self.state
+
+    @contextmanager
+    def transaction(self):
+        """Group changes into a single port write at the end"""
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.flush()
+
+    def flush(self):
+        """Write the shadow to the port if it has changed"""
+        with self._lock:
+            if self._dirty == True and self._deferred is None:
+                self.daq.write_port(self.state)
+                self.writes += 1
+                self._dirty = False
+
+    def _update(self, op, opened, closed):
+        with self._lock, self.latency[op].time():
+            self.state = (self.state & ~closed | opened) & 0xff
+            self._dirty = True
+            if self._deferred is not None:
+                deferred_open, deferred_close = self._deferred
+                self._deferred = (deferred_open & ~closed | opened,
+                                  deferred_close & ~opened | closed)
+            if self._depth == 0:
+                self.flush()
+
+    def open(self, valves):
+        """Open the valves in the mask, leaving the others"""
+        self._update('open', valves, 0)
+
+    def close(self, valves):
+        """Close the valves in the mask, leaving the others"""
+        self._update('close', 0, valves)
+
+    def set(self, valves):
+        """Open the valves in the mask and close the rest"""
+        self._update('set', valves, ~valves & 0xff)
+
+    def is_open(self, valves):
+        """True if all valves in the mask are open"""
+        return (self.state & valves) == valves
+
+    def run_program(self, program, cancel=None):
+        """Run a valve program on the DAQ sample clock if possible
+        cancel : threading.Event abandoning the program when set
+
+        Falls back to timing the steps on the host on devices without
+        buffered digital output. Returns False if cancelled. The valves stay
+        available to other threads while the program runs.
+        """
+        if len(program.steps) == 0:
+            return True
+        with self._program_lock, self.latency['program'].time():
+            if self.hardware_timed == True:
+                with self._lock:
+                    self.flush()
+                    self._deferred = (0, 0)
+                try:
+                    done = self.daq.run_digital_waveform(
+                            program.waveform(WAVEFORM_RATE), WAVEFORM_RATE,
+                            cancel=cancel)
+                except BufferedOutputUnsupported as err:
+                    print("!! WARN: {err}, valve programs are software timed".format(err=err))
+                    self.hardware_timed = False
+                else:
+                    self._end_waveform(program, done)
+                    return done
+                finally:
+                    with self._lock:
+                        if self._deferred is not None:
+                            # Failed, the changes meanwhile are still written
+                            self._deferred = None
+                            self.flush()
+            return program.execute(self.set, cancel=cancel)
+
+    def _end_waveform(self, program, done):
+        """Take back the port from a program clocked by the device"""
+        with self._lock:
+            self.writes += 1
+            opened, closed = self._deferred
+            self._deferred = None
+            if done == True:
+                self.state = program.steps[-1][0]
+                self._dirty = False
+            else:
+                # Stopped part way through the waveform
+                self.resync()
+            if opened != 0 or closed != 0:
+                self._update('set', opened, closed)
+
+    def report(self):
+        """Latency statistics of the operations as text lines"""
+        lines = ["# Valves: port 0x{state:02x}, {w} writes, {r} reads".format(
+            state=self.state, w=self.writes, r=self.reads)]
+        for op, counter in self.latency.items():
+            if counter.count == 0:
+                continue
+            lines.append("#   {op:<8} n={n:<6} mean {mean:8.3f} ms, max {max:8.3f} ms".format(
+                op=op, n=counter.count, mean=counter.mean*1e3,
+                max=counter.max*1e3))
+        return "\n".join(lines)
+
+
+def list_programs():
+    """Names of the built-in programs and the program files in PROGRAM_DIR"""
+    names = list(PROGRAMS)
+    for path in sorted(glob.glob(os.path.join(PROGRAM_DIR, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def load_program(name):
+    """Load a built-in program, a program in PROGRAM_DIR or a program file"""
+    if name in PROGRAMS:
+        return PROGRAMS[name]
+    path = os.path.join(PROGRAM_DIR, name + ".json")
+    if os.path.exists(path):
+        return ValveProgram.load(path)
+    if os.path.exists(name):
+        return ValveProgram.load(name)
+    raise ValueError("Unknown valve program: {}".format(name))